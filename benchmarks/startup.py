@@ -0,0 +1,64 @@
+""" Measure the startup cost btsubscriptions adds to manage.py commands.
+
+    Every run starts a fresh interpreter which loads all models and the
+    management commands of the app, like manage.py does before running a
+    command, and reports the time taken and whether braintree got imported.
+    Pass several checkouts to compare them, e.g. before and after a change:
+
+        DJANGO_SETTINGS_MODULE=mysite.settings \\
+            python benchmarks/startup.py /path/to/old/checkout .
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import subprocess
+import sys
+
+
+SNIPPET = """
+import sys, time
+start = time.time()
+from django.db.models.loading import get_models
+get_models()
+from django.core.management import find_commands, load_command_class
+import btsubscriptions.management
+for name in find_commands(btsubscriptions.management.__path__[0]):
+    load_command_class('btsubscriptions', name)
+print('%f %d' % (time.time() - start, 'braintree' in sys.modules))
+"""
+
+
+def measure(path, runs):
+    timings = []
+    imported = False
+    for i in range(runs):
+        # python -c puts the working directory first on sys.path
+        output = subprocess.check_output(
+            [sys.executable, '-c', SNIPPET], cwd=os.path.abspath(path))
+        elapsed, braintree = output.split()[-2:]
+        timings.append(float(elapsed) * 1000)
+        imported = imported or bool(int(braintree))
+
+    timings.sort()
+    return timings[len(timings) // 2], timings[0], imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='*', default=['.'],
+        help='checkouts of django-braintree-subscriptions to compare')
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    row = '%-40s %12s %12s %20s'
+    print(row % ('checkout', 'median (ms)', 'min (ms)', 'imports braintree'))
+    for path in args.paths:
+        median, fastest, imported = measure(path, args.runs)
+        print(row % (path, '%.1f' % median, '%.1f' % fastest,
+            'yes' if imported else 'no'))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,16 @@
-import braintree
+def configure():
+    """ Configure the class-level braintree API with the 'default' tenant.
+        The app itself only uses btsubscriptions.gateways, call this if
+        project code relies on braintree.Configuration being set up.
+    """
+    import braintree
+    from .gateways import get_gateway
 
-from django.conf import settings
-
-if settings.BRAINTREE_ENV != 'PRODUCTION':
-    BRAINTREE_ENV = braintree.Environment.Sandbox
-else:
-    BRAINTREE_ENV = braintree.Environment.Production
-
-config = braintree.Configuration.configure(
-    BRAINTREE_ENV,
-    settings.BRAINTREE_MERCHANT,
-    settings.BRAINTREE_PUBLIC_KEY,
-    settings.BRAINTREE_PRIVATE_KEY
-)
\ No newline at end of file
+    config = get_gateway().config
+    braintree.Configuration.configure(
+        config.environment,
+        config.merchant_id,
+        config.public_key,
+        config.private_key
+    )
+    return config
@@ -1,19 +1,62 @@
-from django import forms
-from django.db.models import TextField
+from django.conf import settings
 from django.contrib import admin
 from django.contrib import messages
 from django.core.exceptions import ValidationError
+from django.db import connections
+from django.db.models.query import QuerySet
+from django.utils.html import format_html
 from django.utils.translation import ugettext_lazy as _
 
-import braintree
+import json
+import re
 
 import models
+from .jobs import run_operation
+
+
+class EstimatedCountQuerySet(QuerySet):
+    """ QuerySet which counts large unfiltered PostgreSQL tables with the
+        planner's row estimate instead of COUNT(*)
+    """
+
+    def count(self):
+        # Filtered lists are usually short, an EXPLAIN would only add a
+        # round trip to their COUNT(*)
+        if self._result_cache is None and not self.query.where:
+            estimate = self.estimated_count()
+            threshold = getattr(settings, 'BRAINTREE_ADMIN_COUNT_THRESHOLD',
+                10000)
+            if estimate is not None and estimate > threshold:
+                return estimate
+        return super(EstimatedCountQuerySet, self).count()
+
+    def estimated_count(self):
+        connection = connections[self.db]
+        if connection.vendor != 'postgresql':
+            return None
+
+        sql, params = self.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN ' + sql, params)
+        match = re.search(r'rows=(\d+)', cursor.fetchone()[0])
+        return int(match.group(1)) if match else None
+
+
+class LargeTableAdminMixin(object):
+    """ Changelist tuned for tables with many rows, the paginator of
+        unfiltered lists and the unfiltered total of filtered lists use
+        estimated counts
+    """
+
+    def get_queryset(self, request):
+        qs = super(LargeTableAdminMixin, self).get_queryset(request)
+        return qs._clone(klass=EstimatedCountQuerySet)
 
 
 class BTSyncedModelAdminMixin(object):
     def save_model(self, request, obj, form, change):
         try:
-            obj.push()
+            obj.push_or_defer()
         except ValidationError as e:
             msg = u'Braintree push error: %s' % e.messages[0]
             messages.error(request, msg)
@@ -37,26 +80,39 @@ class BTSyncedModelAdminMixin(object):
         obj.delete_from_vault()
         obj.delete()
 
+    def run_or_enqueue(self, request, queryset, operation, **params):
+        """ Apply a job operation to all objects of queryset, as background
+            job if BRAINTREE_BACKGROUND_ACTIONS is set
+        """
+        if getattr(settings, 'BRAINTREE_BACKGROUND_ACTIONS', False):
+            job = models.BTJob.objects.enqueue(operation, queryset, **params)
+            messages.info(request, _('Queued %(job)s for %(count)d objects') % {
+                'job': job,
+                'count': job.total,
+            })
+            return
+
+        for error in run_operation(operation, list(queryset), params):
+            messages.error(request, error)
+
     def bt_pull(self, request, queryset):
-        for instance in queryset:
-            instance.pull()
+        self.run_or_enqueue(request, queryset, 'pull')
     bt_pull.short_description = 'Pull data from braintree'
 
+    def bt_push(self, request, queryset):
+        self.run_or_enqueue(request, queryset, 'push')
+    bt_push.short_description = 'Push data to braintree'
+
 
 class BTMirroredModelAdminMixin(object):
     def get_readonly_fields(self, request, obj=None):
         """ show all cached fields as readonly in admin """
-        if hasattr(self, '_readonly_fields'):
-            return self._readonly_fields
-        self._readonly_fields = []
-
         excluded = getattr(self, 'readonly_excluded_fields', [])
 
-        for field in self.model._meta.fields:
-            if field.null and not field.editable and not field.name in excluded:
-                self._readonly_fields.append(field.name)
-
-        return self._readonly_fields
+        return [
+            field.name for field in self.model._meta.fields
+            if field.null and not field.editable and not field.name in excluded
+        ]
 
     def save_model(self, request, obj, form, change):
         obj.pull()
@@ -91,7 +147,7 @@ class BTCustomerAdmin(BTSyncedModelAdminMixin, admin.ModelAdmin):
     inlines = (BTAddressInlineAdmin, BTCreditCardInline)
     raw_id_fields = ('id',)
     readonly_fields = ('created', 'updated')
-    actions = ('bt_pull',)
+    actions = ('bt_pull', 'bt_push')
 
 
 class BTAddOnAdmin(BTMirroredModelAdminMixin, admin.ModelAdmin):
@@ -107,7 +163,7 @@ class BTPlanAdmin(BTMirroredModelAdminMixin, admin.ModelAdmin):
     actions = ('import_all',)
 
     def import_all(self, request, queryset):
-        plans = braintree.Plan.all()
+        plans = models.BTPlan.collection.all()
         for plan in plans:
             plan, created = models.Plan.objects_get_or_create(plan_id=plan.id)
             plan.import_data(plan)
@@ -131,7 +187,8 @@ class BTTransactionInlineAdmin(BTMirroredModelAdminMixin, admin.TabularInline):
     extra = 0
 
 
-class BTSubscriptionAdmin(BTSyncedModelAdminMixin, admin.ModelAdmin):
+class BTSubscriptionAdmin(LargeTableAdminMixin, BTSyncedModelAdminMixin,
+        admin.ModelAdmin):
     list_display = (
         'subscription_id',
         'status',
@@ -139,48 +196,38 @@ class BTSubscriptionAdmin(BTSyncedModelAdminMixin, admin.ModelAdmin):
         'plan'
     )
     list_filter = ('plan', 'status')
+    list_select_related = ('customer', 'plan')
+    search_fields = ('=subscription_id',)
+    ordering = ('-id',)
     filter_horizontal = ('add_ons', 'discounts')
     inlines = [
         BTSubscribedAddOnInline,
         BTSubscribedDiscountInline,
         BTTransactionInlineAdmin
     ]
-    actions = ('cancel_subscriptions',)
+    actions = ('cancel_subscriptions', 'bt_pull', 'bt_push')
 
     def cancel_subscriptions(self, request, queryset):
-        for subscription in queryset:
-            subscription.cancel()
+        self.run_or_enqueue(request, queryset, 'cancel')
 
     def save_related(self, request, form, formsets, change):
         form.save_m2m()
         for formset in formsets:
             self.save_formset(request, form, formset, change=change)
 
-        if change:
-            sub = form.instance
-
-            addons = [
-                {
-                    'inherited_from_id': a.add_on.addon_id,
-                    'quantity': a.quantity
-                } for a in sub.subscribed_addons.all()
-            ]
-
-            discounts = [
-                {
-                    'inherited_from_id': d.discount.discount_id,
-                    'quantity': d.quantity
-                } for d in sub.subscribed_discounts.all()
-            ]
-
-            result = braintree.Subscription.update(sub.subscription_id, {
-                "options": {
-                    "replace_all_add_ons_and_discounts": True
-                },
-                "add_ons": {"add": addons},
-                "discounts": {"add": discounts}
-            })
+        # Only the inlines change add-ons and discounts
+        if change and any(formset.has_changed() for formset in formsets):
+            from braintree.exceptions.not_found_error import NotFoundError
 
+            try:
+                result = form.instance.sync_modifiers()
+            except NotFoundError:
+                self.message_user(request, _('The subscription does not '
+                    'exist in the vault'), level=messages.ERROR)
+                return
+
+            if result is None:
+                return
             if result.is_success:
                 messages.info(request, _('Add-Ons and Discounts updated'))
             else:
@@ -202,17 +249,107 @@ class BTSubscriptionAdmin(BTSyncedModelAdminMixin, admin.ModelAdmin):
 
         return readonly_fields
 
-class BTWebhookLogAdmin(admin.ModelAdmin):
-    readonly_fields = ('received',)
-    formfield_overrides = {
-        TextField: {'widget': forms.Textarea(attrs={'cols': 120, 'rows': 30})},
-    }
-    list_display = ('kind', 'received', 'data', 'exception')
+
+class BTTransactionAdmin(LargeTableAdminMixin, BTMirroredModelAdminMixin,
+        admin.ModelAdmin):
+    list_display = (
+        'transaction_id',
+        'subscription',
+        'amount_display',
+        'status',
+        'type',
+        'created_at'
+    )
+    list_filter = ('status', 'type')
+    list_select_related = ('subscription',)
+    search_fields = ('=transaction_id', '=subscription__subscription_id')
+    raw_id_fields = ('subscription',)
+
+
+class BTWebhookLogAdmin(LargeTableAdminMixin, admin.ModelAdmin):
+    fields = ('kind', 'subscription_id', 'received', 'payload', 'exception')
+    readonly_fields = fields
+    list_display = ('kind', 'subscription_id', 'received', 'failed')
+    list_filter = ('kind',)
+    search_fields = ('=subscription_id',)
+
+    def get_queryset(self, request):
+        qs = super(BTWebhookLogAdmin, self).get_queryset(request)
+        # Never load the (potentially huge) payload for changelists
+        return qs.defer('data', 'bt_signature', 'bt_payload')
+
+    def payload(self, obj):
+        return format_html(u'<pre>{0}</pre>',
+            json.dumps(obj.get_data(), indent=2, sort_keys=True))
+
+    def failed(self, obj):
+        return bool(obj.exception)
+    failed.boolean = True
+
+class BTPushOutboxAdmin(admin.ModelAdmin):
+    list_display = (
+        'content_type',
+        'object_id',
+        'tenant',
+        'scheduled',
+        'next_attempt',
+        'attempts',
+        'last_error'
+    )
+    list_filter = ('content_type',)
+    readonly_fields = list_display
+
+class BTJobAdmin(admin.ModelAdmin):
+    list_display = (
+        '__unicode__',
+        'status',
+        'progress_display',
+        'failed',
+        'created',
+        'finished'
+    )
+    list_filter = ('status', 'operation')
+    list_select_related = ('content_type',)
+    readonly_fields = (
+        'operation',
+        'content_type',
+        'tenant',
+        'status',
+        'progress_display',
+        'failed',
+        'last_error',
+        'created',
+        'finished'
+    )
+    exclude = ('position', 'total', 'next_attempt')
+    actions = ('cancel_jobs',)
+
+    def has_add_permission(self, request):
+        return False
+
+    def progress_display(self, obj):
+        return u'%d/%d (%d%%)' % (obj.position, obj.total, obj.progress)
+    progress_display.short_description = _('progress')
+
+    def cancel_jobs(self, request, queryset):
+        queryset.exclude(status=models.BTJob.DONE)\
+            .update(status=models.BTJob.CANCELED)
+
+class BTWorkerLeaseAdmin(admin.ModelAdmin):
+    list_display = ('worker', 'started', 'expires')
+    readonly_fields = list_display
+
+    def has_add_permission(self, request):
+        return False
 
 admin.site.register(models.BTCustomer, BTCustomerAdmin)
 admin.site.register(models.BTPlan, BTPlanAdmin)
 admin.site.register(models.BTAddOn, BTAddOnAdmin)
 admin.site.register(models.BTDiscount, BTDiscountAdmin)
 admin.site.register(models.BTSubscription, BTSubscriptionAdmin)
+admin.site.register(models.BTTransaction, BTTransactionAdmin)
 
 admin.site.register(models.BTWebhookLog, BTWebhookLogAdmin)
+admin.site.register(models.BTPushOutbox, BTPushOutboxAdmin)
+admin.site.register(models.BTJob, BTJobAdmin)
+admin.site.register(models.BTWorkerLease, BTWorkerLeaseAdmin)
@@ -0,0 +1,157 @@
+""" Revenue analytics computed with database aggregates.
+
+    Nothing here iterates over subscriptions in Python, only over the grouped
+    rows (one per plan, add-on or discount) returned by the database.
+"""
+import operator
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db.models import Count, Q, Sum
+from django.utils.timezone import now
+
+from .encoding import encode
+from .models import BTSubscription, BTSubscribedAddOn, BTSubscribedDiscount
+from .models import BTSubscriptionHistory
+
+
+# Subscriptions which generate recurring revenue
+BILLED_STATUSES = (BTSubscription.ACTIVE, BTSubscription.PAST_DUE)
+CHURNED_STATUSES = (BTSubscription.CANCELED, BTSubscription.EXPIRED)
+
+ZERO = Decimal('0.00')
+
+
+def billed_subscriptions():
+    return BTSubscription.objects.filter(status__in=BILLED_STATUSES)
+
+
+def plan_revenue(subscriptions=None):
+    """ Subscriptions and monthly recurring revenue per plan """
+    if subscriptions is None:
+        subscriptions = billed_subscriptions()
+
+    # next_billing_period_amount includes add-ons and discounts, the price
+    # is used for subscriptions where it is not cached (yet)
+    amounts = subscriptions.exclude(next_billing_period_amount=None)\
+        .values('plan__plan_id')\
+        .annotate(amount=Sum('next_billing_period_amount'), count=Count('id'))
+    fallbacks = subscriptions.filter(next_billing_period_amount=None)\
+        .values('plan__plan_id')\
+        .annotate(amount=Sum('price'), count=Count('id'))
+
+    plans = dict(
+        (plan['plan__plan_id'], plan) for plan in subscriptions
+        .values('plan__plan_id', 'plan__currency_iso_code',
+            'plan__billing_frequency')
+        .distinct()
+    )
+
+    revenue = {}
+    for row in list(amounts) + list(fallbacks):
+        plan = plans[row['plan__plan_id']]
+        entry = revenue.setdefault(row['plan__plan_id'], {
+            'currency': plan['plan__currency_iso_code'],
+            'subscriptions': 0,
+            'mrr': ZERO,
+        })
+        frequency = plan['plan__billing_frequency'] or 1
+        entry['subscriptions'] += row['count']
+        entry['mrr'] += (row['amount'] or ZERO) / frequency
+
+    for entry in revenue.values():
+        entry['mrr'] = entry['mrr'].quantize(ZERO)
+    return revenue
+
+
+def mrr(subscriptions=None, plans=None):
+    """ Monthly recurring revenue per currency """
+    if plans is None:
+        plans = plan_revenue(subscriptions)
+
+    totals = defaultdict(lambda: ZERO)
+    for entry in plans.values():
+        totals[entry['currency']] += entry['mrr']
+    return dict(totals)
+
+
+def arpu(subscriptions=None, totals=None):
+    """ Average monthly revenue per paying customer, per currency """
+    if subscriptions is None:
+        subscriptions = billed_subscriptions()
+    if totals is None:
+        totals = mrr(subscriptions)
+
+    customers = subscriptions.values('plan__currency_iso_code')\
+        .annotate(customers=Count('customer', distinct=True))
+    customers = dict(
+        (row['plan__currency_iso_code'], row['customers'])
+        for row in customers
+    )
+
+    return dict(
+        (currency, (amount / customers[currency]).quantize(ZERO))
+        for currency, amount in totals.items()
+        if customers.get(currency)
+    )
+
+
+def churn(start, end):
+    """ Share of subscriptions which were canceled or expired between
+        start and end, according to the history row recording the change
+        of their status
+    """
+    # History changes are compact JSON, match the status key of them
+    transitions = reduce(operator.or_, [
+        Q(changes__contains=encode({'status': status})[1:-1])
+        for status in CHURNED_STATUSES
+    ])
+    churned = BTSubscriptionHistory.objects.filter(transitions,
+        recorded__gte=start, recorded__lt=end)\
+        .aggregate(count=Count('subscription', distinct=True))['count']
+    running = billed_subscriptions().filter(created__lt=start).count()
+
+    if not churned + running:
+        return 0.0
+    return float(churned) / (churned + running)
+
+
+def modifier_impact(subscriptions=None):
+    """ Amount add-ons and discounts add to each billing cycle """
+    if subscriptions is None:
+        subscriptions = billed_subscriptions()
+
+    add_ons = BTSubscribedAddOn.objects.filter(subscription__in=subscriptions)\
+        .values('add_on__addon_id', 'add_on__amount')\
+        .annotate(quantity=Sum('quantity'), count=Count('subscription'))
+    discounts = BTSubscribedDiscount.objects\
+        .filter(subscription__in=subscriptions)\
+        .values('discount__discount_id', 'discount__amount')\
+        .annotate(quantity=Sum('quantity'), count=Count('subscription'))
+
+    return {
+        'add_ons': dict((row['add_on__addon_id'], {
+            'subscriptions': row['count'],
+            'amount': (row['add_on__amount'] or ZERO) * row['quantity'],
+        }) for row in add_ons),
+        'discounts': dict((row['discount__discount_id'], {
+            'subscriptions': row['count'],
+            'amount': -(row['discount__amount'] or ZERO) * row['quantity'],
+        }) for row in discounts),
+    }
+
+
+def report(days=30):
+    """ All metrics, churn is computed over the last days """
+    end = now()
+    subscriptions = billed_subscriptions()
+    plans = plan_revenue(subscriptions)
+    totals = mrr(plans=plans)
+    return {
+        'mrr': totals,
+        'arpu': arpu(subscriptions, totals=totals),
+        'churn': churn(end - timedelta(days=days), end),
+        'plans': plans,
+        'modifiers': modifier_impact(subscriptions),
+    }
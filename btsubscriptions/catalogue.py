@@ -0,0 +1,104 @@
+""" The plan, add-on and discount catalogue as a cached JSON document.
+
+    The serialized body is cached under a catalogue version, which is
+    replaced whenever a plan, add-on or discount is saved or deleted, e.g.
+    by import_braintree or the admin. The ETag of the catalogue view is a
+    hash of the body, so clients revalidate without the body being
+    regenerated or sent.
+
+    The version is replaced before the change is committed. A body that a
+    concurrent request serializes in between still carries the old content
+    under the new version, so bodies are only cached for BODY_TIMEOUT.
+    Their ETag always matches the content actually served.
+"""
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+from .encoding import encode
+from .models import BTPlan, BTAddOn, BTDiscount
+
+
+VERSION_KEY = 'btsubscriptions:catalogue:version'
+BODY_KEY = 'btsubscriptions:catalogue:%s'
+
+# Unchanged catalogues are kept for a day
+CACHE_TIMEOUT = 24 * 3600
+
+# Seconds a serialized body is served before it is regenerated
+BODY_TIMEOUT = 300
+
+SECTIONS = (
+    ('plans', BTPlan, (
+        'plan_id',
+        'name',
+        'description',
+        'price',
+        'currency_iso_code',
+        'billing_frequency',
+        'number_of_billing_cycles',
+        'trial_period',
+        'trial_duration',
+        'trial_duration_unit',
+    )),
+    ('add_ons', BTAddOn, (
+        'addon_id',
+        'name',
+        'description',
+        'amount',
+        'number_of_billing_cycles',
+    )),
+    ('discounts', BTDiscount, (
+        'discount_id',
+        'name',
+        'description',
+        'amount',
+        'number_of_billing_cycles',
+    )),
+)
+
+
+def get_catalogue_cache():
+    return get_cache(getattr(settings, 'BRAINTREE_CATALOGUE_CACHE',
+        'default'))
+
+
+def bump_version():
+    """ Invalidate the cached catalogue """
+    get_catalogue_cache().set(VERSION_KEY, uuid.uuid4().hex, CACHE_TIMEOUT)
+
+
+def get_version():
+    """ The current catalogue version, a new one if it was evicted """
+    cache = get_catalogue_cache()
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        # Another process may have set one in the meantime
+        if not cache.add(VERSION_KEY, version, CACHE_TIMEOUT):
+            version = cache.get(VERSION_KEY, version)
+    return version
+
+
+def serialize():
+    """ The catalogue as JSON, with one query per section """
+    return encode(dict(
+        (name, list(model.objects.values(*fields)))
+        for name, model, fields in SECTIONS
+    ))
+
+
+def get_catalogue(version=None):
+    """ Return (etag, body) of the catalogue, serializing it only if the
+        body of the version is not cached yet
+    """
+    cache = get_catalogue_cache()
+    version = version or get_version()
+    catalogue = cache.get(BODY_KEY % version)
+    if catalogue is None:
+        body = serialize()
+        catalogue = (hashlib.md5(body).hexdigest(), body)
+        cache.set(BODY_KEY % version, catalogue, BODY_TIMEOUT)
+    return catalogue
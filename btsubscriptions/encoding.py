@@ -0,0 +1,36 @@
+import base64
+import json
+import zlib
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+class VaultJSONEncoder(DjangoJSONEncoder):
+    """ JSON encoder that understands braintree resources """
+
+    # Attributes of braintree resources that are never encoded
+    excluded_attributes = ('gateway',)
+
+    def default(self, o):
+        if hasattr(o, '__dict__'):
+            return dict(
+                (key, value) for key, value in o.__dict__.iteritems()
+                if not key.startswith('_')
+                and key not in self.excluded_attributes
+            )
+        return super(VaultJSONEncoder, self).default(o)
+
+
+def encode(data, compress=False):
+    """ Encode data as compact JSON, optionally zlib compressed """
+    text = json.dumps(data, cls=VaultJSONEncoder, separators=(',', ':'))
+    if compress:
+        text = base64.b64encode(zlib.compress(text))
+    return text
+
+
+def decode(text, compressed=False):
+    """ Decode text created by encode() """
+    if compressed:
+        text = zlib.decompress(base64.b64decode(text))
+    return json.loads(text)
@@ -0,0 +1,183 @@
+""" Streaming CSV and JSON lines exports for accounting.
+
+    Rows are read with values_list() in chunks using keyset pagination, so
+    memory stays flat regardless of the table size. Without a date range the
+    chunks are ordered by primary key; with a range they are ordered by the
+    export's date field and primary key, which is served by the
+    (date, id) indexes of the exported models.
+"""
+import csv
+from datetime import date, datetime, time
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_date
+from django.utils.timezone import get_current_timezone, make_aware
+
+from .encoding import encode, decode
+from .models import BTSubscription, BTTransaction, BTWebhookLog
+
+
+def webhook_log_row(row):
+    """ Replace the stored (possibly compressed) payload by its data """
+    row = list(row)
+    data, compressed = row[-2:]
+    try:
+        row[-2:] = [decode(data, compressed) if data else None]
+    except ValueError:
+        # Logs written before payloads were stored as JSON
+        row[-2:] = [data]
+    return row
+
+
+EXPORTS = {
+    'subscriptions': {
+        'model': BTSubscription,
+        'date_field': 'created',
+        'fields': (
+            'id',
+            'subscription_id',
+            'customer',
+            'plan__plan_id',
+            'status',
+            'price',
+            'balance',
+            'next_billing_period_amount',
+            'first_billing_date',
+            'next_billing_date',
+            'current_billing_cycle',
+            'days_past_due',
+            'created',
+            'updated',
+        ),
+    },
+    'transactions': {
+        'model': BTTransaction,
+        'date_field': 'created_at',
+        'fields': (
+            'id',
+            'transaction_id',
+            'subscription__subscription_id',
+            'type',
+            'status',
+            'amount',
+            'currency_iso_code',
+            'credit_card',
+            'created_at',
+            'updated_at',
+        ),
+    },
+    'webhook_logs': {
+        'model': BTWebhookLog,
+        'date_field': 'received',
+        'fields': ('id', 'kind', 'received', 'exception', 'data', 'compressed'),
+        'header': ('id', 'kind', 'received', 'exception', 'data'),
+        'convert': webhook_log_row,
+    },
+}
+
+
+def parse_day(value):
+    """ Return the start of the day given as date or YYYY-MM-DD """
+    if isinstance(value, datetime):
+        return value
+
+    day = parse_date(value) if isinstance(value, basestring) else value
+    if day is None:
+        raise ValueError('Invalid date %r, expected YYYY-MM-DD' % value)
+
+    start = datetime.combine(day, time())
+    if settings.USE_TZ:
+        start = make_aware(start, get_current_timezone())
+    return start
+
+
+def chunks(name, start=None, end=None, chunk_size=1000):
+    """ Yield lists of rows of the export name created between start
+        (inclusive) and end (exclusive)
+    """
+    export = EXPORTS[name]
+    date_field = export['date_field']
+    queryset = export['model'].objects.all()
+
+    if start is not None:
+        queryset = queryset.filter(**{date_field + '__gte': parse_day(start)})
+    if end is not None:
+        queryset = queryset.filter(**{date_field + '__lt': parse_day(end)})
+    ordered_by_date = start is not None or end is not None
+
+    fields = export['fields']
+    if ordered_by_date:
+        queryset = queryset.order_by(date_field, 'pk')
+        fields += (date_field,)
+    else:
+        queryset = queryset.order_by('pk')
+
+    convert = export.get('convert')
+    last = None
+    while True:
+        chunk = queryset
+        if last is not None and ordered_by_date:
+            chunk = chunk.filter(Q(**{date_field + '__gt': last[-1]})
+                | Q(**{date_field: last[-1], 'pk__gt': last[0]}))
+        elif last is not None:
+            chunk = chunk.filter(pk__gt=last[0])
+
+        rows = list(chunk.values_list(*fields)[:chunk_size])
+        if not rows:
+            return
+        last = rows[-1]
+
+        if ordered_by_date:
+            rows = [row[:-1] for row in rows]
+        if convert:
+            rows = [convert(row) for row in rows]
+        yield rows
+
+
+def header(name):
+    export = EXPORTS[name]
+    return export.get('header', export['fields'])
+
+
+class Echo(object):
+    """ File-like object returning what is written to it """
+
+    def write(self, value):
+        return value
+
+
+def csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, (dict, list)):
+        return encode(value)
+    return unicode(value).encode('utf-8')
+
+
+def csv_lines(name, start=None, end=None, chunk_size=1000):
+    """ Yield the export as lines of CSV """
+    writer = csv.writer(Echo())
+    yield writer.writerow(header(name))
+    for rows in chunks(name, start, end, chunk_size):
+        yield ''.join(
+            writer.writerow([csv_value(value) for value in row])
+            for row in rows
+        )
+
+
+def jsonl_lines(name, start=None, end=None, chunk_size=1000):
+    """ Yield the export as lines of JSON objects """
+    fields = header(name)
+    for rows in chunks(name, start, end, chunk_size):
+        yield ''.join(
+            encode(dict(zip(fields, row))) + '\n' for row in rows
+        )
+
+
+FORMATS = {
+    'csv': (csv_lines, 'text/csv'),
+    'jsonl': (jsonl_lines, 'application/x-ndjson'),
+}
@@ -0,0 +1,143 @@
+""" Forecast of upcoming charges from the local subscription mirror.
+
+    Running subscriptions are read in primary key ordered chunks with
+    values_list() and expanded into charge events, without calling braintree.
+    The first charge uses the cached next billing amount (including the
+    balance, like BTSubscription.next_billing_amount), later charges the
+    price plus subscribed add-ons minus discounts.
+"""
+import calendar
+from collections import defaultdict
+from datetime import date, timedelta
+from decimal import Decimal
+
+from django.utils.timezone import localtime, now
+
+from .models import BTSubscription, BTSubscribedAddOn, BTSubscribedDiscount
+
+
+ZERO = Decimal('0.00')
+
+FIELDS = (
+    'pk',
+    'subscription_id',
+    'next_billing_date',
+    'billing_day_of_month',
+    'number_of_billing_cycles',
+    'current_billing_cycle',
+    'next_billing_period_amount',
+    'balance',
+    'price',
+    'plan__price',
+    'plan__billing_frequency',
+    'plan__currency_iso_code',
+)
+
+
+def add_months(day, months, day_of_month=None):
+    """ Add months to day, clamping to the end of shorter months """
+    month = day.month - 1 + months
+    year = day.year + month // 12
+    month = month % 12 + 1
+    last_day = calendar.monthrange(year, month)[1]
+    return date(year, month, min(day_of_month or day.day, last_day))
+
+
+def modifier_amounts(subscription_pks):
+    """ Sum of add-ons minus discounts per billing cycle, by subscription """
+    amounts = defaultdict(lambda: ZERO)
+
+    add_ons = BTSubscribedAddOn.objects.filter(
+        subscription__in=subscription_pks
+    ).values_list('subscription', 'add_on__amount', 'quantity')
+    for pk, amount, quantity in add_ons:
+        amounts[pk] += (amount or ZERO) * quantity
+
+    discounts = BTSubscribedDiscount.objects.filter(
+        subscription__in=subscription_pks
+    ).values_list('subscription', 'discount__amount', 'quantity')
+    for pk, amount, quantity in discounts:
+        amounts[pk] -= (amount or ZERO) * quantity
+
+    return amounts
+
+
+def running_chunks(chunk_size=2000):
+    """ Yield lists of running subscription rows, ordered by primary key """
+    queryset = BTSubscription.objects.running()\
+        .exclude(next_billing_date=None).order_by('pk')
+    last_pk = 0
+    while True:
+        rows = list(queryset.filter(pk__gt=last_pk)
+            .values_list(*FIELDS)[:chunk_size])
+        if not rows:
+            return
+        yield rows
+        last_pk = rows[-1][0]
+
+
+def expand(row, modifiers, start, end):
+    """ Yield (date, amount) of all charges of a subscription row """
+    (pk, subscription_id, next_billing_date, day_of_month, cycles,
+        current_cycle, next_amount, balance, price, plan_price, frequency,
+        currency) = row
+
+    remaining = None
+    if cycles:
+        remaining = cycles - (current_cycle or 0)
+
+    recurring = (price if price is not None else plan_price or ZERO)
+    recurring = max(recurring + modifiers.get(pk, ZERO), ZERO)
+
+    # Vault dates are stored as local midnight
+    first = localtime(next_billing_date).date()
+    charge = 0
+    while remaining is None or charge < remaining:
+        if charge == 0:
+            day = first
+        else:
+            day = add_months(first, charge * (frequency or 1), day_of_month)
+        if day >= end:
+            return
+
+        if charge == 0 and next_amount is not None:
+            amount = max(next_amount + (balance or ZERO), ZERO)
+        else:
+            amount = recurring
+
+        if day >= start:
+            yield day, amount
+        charge += 1
+
+
+def charge_events(days=90, start=None, chunk_size=2000):
+    """ Yield (date, subscription_id, currency, amount) of projected charges
+        in the next days, grouped by subscription
+    """
+    start = start or localtime(now()).date()
+    end = start + timedelta(days=days)
+
+    for rows in running_chunks(chunk_size):
+        modifiers = modifier_amounts([row[0] for row in rows])
+        for row in rows:
+            for day, amount in expand(row, modifiers, start, end):
+                yield day, row[1], row[-1], amount
+
+
+def daily_totals(days=90, start=None, chunk_size=2000):
+    """ Return a list of (date, currency, number of charges, amount) per
+        day. Charge events arrive grouped by subscription, so the totals of
+        all days are summed up before the first is known; they take memory
+        per day and currency, not per subscription.
+    """
+    totals = defaultdict(lambda: [0, ZERO])
+    for day, subscription_id, currency, amount in charge_events(
+            days, start, chunk_size):
+        total = totals[(day, currency)]
+        total[0] += 1
+        total[1] += amount
+
+    return [
+        (day, currency) + tuple(totals[(day, currency)])
+        for day, currency in sorted(totals)
+    ]
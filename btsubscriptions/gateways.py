@@ -0,0 +1,150 @@
+""" Braintree gateways per merchant account (tenant).
+
+    Merchant accounts are configured in BRAINTREE_MERCHANTS:
+
+        BRAINTREE_MERCHANTS = {
+            'acme': {
+                'environment': 'PRODUCTION',
+                'merchant_id': '...',
+                'public_key': '...',
+                'private_key': '...',
+            },
+        }
+
+    The classic BRAINTREE_ENV/BRAINTREE_MERCHANT/... settings configure the
+    'default' tenant. Every tenant gets its own BraintreeGateway (and thus its
+    own configuration and http strategy), created on first use; neither
+    settings nor the braintree library are touched before. The tenant of the
+    current thread is set with activate() or GatewayMiddleware.
+"""
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_by_path
+
+from . import ratelimit
+
+
+DEFAULT_TENANT = 'default'
+
+_gateways = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def merchant_settings():
+    """ Return the merchant account settings of all tenants """
+    merchants = dict(getattr(settings, 'BRAINTREE_MERCHANTS', {}))
+    if getattr(settings, 'BRAINTREE_MERCHANT', None):
+        merchants.setdefault(DEFAULT_TENANT, {
+            'environment': settings.BRAINTREE_ENV,
+            'merchant_id': settings.BRAINTREE_MERCHANT,
+            'public_key': settings.BRAINTREE_PUBLIC_KEY,
+            'private_key': settings.BRAINTREE_PRIVATE_KEY,
+        })
+    return merchants
+
+
+def create_gateway(tenant):
+    """ Create a new gateway from the merchant settings of tenant """
+    import braintree
+
+    try:
+        options = dict(merchant_settings()[tenant])
+    except KeyError:
+        raise ImproperlyConfigured(
+            'No braintree merchant configured for tenant %r' % tenant)
+
+    if options.pop('environment', None) == 'PRODUCTION':
+        environment = braintree.Environment.Production
+    else:
+        environment = braintree.Environment.Sandbox
+
+    config = braintree.Configuration(
+        environment,
+        options.pop('merchant_id'),
+        options.pop('public_key'),
+        options.pop('private_key'),
+        **options
+    )
+    return braintree.BraintreeGateway(config)
+
+
+def get_gateway(tenant=None):
+    """ Return the gateway of tenant, or of the active tenant """
+    tenant = tenant or get_tenant()
+    try:
+        return _gateways[tenant]
+    except KeyError:
+        with _lock:
+            if tenant not in _gateways:
+                _gateways[tenant] = create_gateway(tenant)
+            return _gateways[tenant]
+
+
+def register_gateway(tenant, gateway):
+    """ Use gateway for tenant. Returns the previously used gateway or None """
+    with _lock:
+        previous = _gateways.get(tenant)
+        _gateways[tenant] = gateway
+    return previous
+
+
+def unregister_gateway(tenant):
+    with _lock:
+        _gateways.pop(tenant, None)
+
+
+def get_collection(name):
+    """ The collection name of the active tenant's gateway, rate limited if
+        BRAINTREE_RATE_LIMIT is set
+    """
+    collection = getattr(get_gateway(), name)
+    if ratelimit.is_enabled():
+        return ratelimit.RateLimitedCollection(collection, get_tenant())
+    return collection
+
+
+def get_tenant():
+    return getattr(_local, 'tenant', None) or DEFAULT_TENANT
+
+
+def activate(tenant):
+    """ Make tenant the active tenant of the current thread """
+    _local.tenant = tenant
+
+
+def deactivate():
+    _local.tenant = None
+
+
+class GatewayCollection(object):
+    """ Resolves to a collection of the active tenant's gateway, e.g.
+        GatewayCollection('customer') is get_collection('customer').
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        return get_collection(self.name)
+
+
+class GatewayMiddleware(object):
+    """ Activate the tenant returned by BRAINTREE_TENANT_RESOLVER, a dotted
+        path to a function taking the request and returning a tenant name.
+    """
+
+    def __init__(self):
+        self.resolver = import_by_path(settings.BRAINTREE_TENANT_RESOLVER)
+
+    def process_request(self, request):
+        activate(self.resolver(request))
+
+    def process_response(self, request, response):
+        deactivate()
+        return response
+
+    def process_exception(self, request, exception):
+        deactivate()
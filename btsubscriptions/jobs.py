@@ -0,0 +1,96 @@
+""" Bulk operations on many objects, run in chunks by a background worker.
+
+    BTJob.objects.enqueue('cancel', queryset) stores the primary keys of the
+    queryset; manage.py run_jobs works through them chunk by chunk and saves
+    the position after every chunk, so interrupted jobs resume where they
+    stopped. Operations are functions taking an instance and the job
+    parameters, registered in OPERATIONS.
+"""
+from multiprocessing.pool import ThreadPool
+
+from django.core.exceptions import ValidationError
+from django.db import connection
+
+from .gateways import activate, deactivate, get_tenant
+from .models import BTPlan
+
+
+def pull(instance, params):
+    instance.pull()
+    instance.save()
+
+
+def push(instance, params):
+    instance.push()
+    instance.save()
+
+
+def cancel(instance, params):
+    result = instance.cancel()
+    if not result.is_success:
+        raise ValidationError(result.message)
+
+
+def change_plan(instance, params):
+    """ Move a subscription to params['plan_id'] at the plan's price """
+    plan = BTPlan.objects.get(plan_id=params['plan_id'])
+    instance.plan = plan
+    instance.price = plan.price
+    instance.number_of_billing_cycles = None
+
+    result = instance.push()
+    instance.import_data(result.subscription)
+    instance.save()
+
+
+OPERATIONS = {
+    'pull': pull,
+    'push': push,
+    'cancel': cancel,
+    'change_plan': change_plan,
+}
+
+
+def error_message(instance, error):
+    if isinstance(error, ValidationError):
+        error = u'; '.join(error.messages)
+    return u'%s: %s' % (instance, error)
+
+
+def apply_operation(function, instances, params):
+    errors = []
+    for instance in instances:
+        try:
+            function(instance, params)
+        except Exception as e:
+            errors.append(error_message(instance, e))
+    return errors
+
+
+def run_operation(operation, instances, params, concurrency=1, tenant=None):
+    """ Apply operation to instances, using up to concurrency threads.
+        Returns the error messages of the instances which failed.
+    """
+    function = OPERATIONS[operation]
+    if concurrency < 2 or len(instances) < 2:
+        return apply_operation(function, instances, params)
+
+    tenant = tenant or get_tenant()
+
+    def run(instances):
+        # Threads don't inherit the active tenant
+        activate(tenant)
+        try:
+            return apply_operation(function, instances, params)
+        finally:
+            deactivate()
+            connection.close()
+
+    slices = [instances[i::concurrency] for i in range(concurrency)]
+    pool = ThreadPool(concurrency)
+    try:
+        results = pool.map(run, [s for s in slices if s])
+    finally:
+        pool.close()
+        pool.join()
+    return sum(results, [])
@@ -0,0 +1,78 @@
+""" Per-customer locks serializing vault writes of one customer.
+
+    Double clicks and concurrent tabs must not push the same customer,
+    card or subscription twice. customer_lock() runs a block in a
+    transaction holding an exclusive lock of the customer: a transaction
+    level advisory lock on PostgreSQL, a row lock of the customer
+    elsewhere. Locks which can't be taken within the timeout raise
+    CustomerLocked, so callers can answer right away instead of queueing.
+"""
+import time
+import zlib
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections, router, transaction, DatabaseError
+
+from .models import BTCustomer
+
+
+# First key of the two-key advisory locks, keeps them apart from other apps
+LOCK_NAMESPACE = zlib.crc32('btsubscriptions.customer') & 0x7fffffff
+
+# Seconds between attempts to take a busy lock
+RETRY_INTERVAL = 0.05
+
+
+class CustomerLocked(Exception):
+    """ Another operation holds the lock of the customer """
+
+
+def customer_model():
+    # BTCustomer shares the primary key of the project's customer, which
+    # exists before the first sync created the BTCustomer
+    return BTCustomer._meta.get_field('id').rel.to
+
+
+def try_lock(connection, pk):
+    """ Try once to lock the customer pk in the current transaction """
+    if connection.vendor == 'postgresql':
+        cursor = connection.cursor()
+        cursor.execute('SELECT pg_try_advisory_xact_lock(%s, %s)',
+            [LOCK_NAMESPACE, pk])
+        return cursor.fetchone()[0]
+
+    customers = customer_model()._default_manager.using(connection.alias)
+    if not connection.features.has_select_for_update_nowait:
+        # Waits for the lock, e.g. up to innodb_lock_wait_timeout
+        list(customers.select_for_update().filter(pk=pk))
+        return True
+    try:
+        # A failed NOWAIT aborts the transaction, keep it in a savepoint
+        with transaction.atomic(using=connection.alias):
+            list(customers.select_for_update(nowait=True).filter(pk=pk))
+        return True
+    except DatabaseError:
+        return False
+
+
+@contextmanager
+def customer_lock(customer, timeout=None):
+    """ Run the block in a transaction holding the lock of customer (an
+        instance or primary key). Raises CustomerLocked if the lock isn't
+        free within timeout, by default BRAINTREE_CUSTOMER_LOCK_TIMEOUT
+        seconds.
+    """
+    pk = getattr(customer, 'pk', customer)
+    if timeout is None:
+        timeout = getattr(settings, 'BRAINTREE_CUSTOMER_LOCK_TIMEOUT', 2)
+    using = router.db_for_write(BTCustomer)
+
+    with transaction.atomic(using=using):
+        connection = connections[using]
+        deadline = time.time() + timeout
+        while not try_lock(connection, pk):
+            if time.time() >= deadline:
+                raise CustomerLocked(pk)
+            time.sleep(RETRY_INTERVAL)
+        yield
@@ -0,0 +1,44 @@
+from django.db import connections
+from django.db.models import signals
+
+from btsubscriptions import models
+
+
+def partial_index_sql(connection):
+    """ PostgreSQL partial indexes for the hot billing lookups """
+    if connection.vendor != 'postgresql':
+        return []
+
+    qn = connection.ops.quote_name
+    subscription_table = models.BTSubscription._meta.db_table
+    card_table = models.BTCreditCard._meta.db_table
+
+    running = ', '.join("'%s'" % status for status in (
+        models.BTSubscription.PENDING,
+        models.BTSubscription.ACTIVE,
+        models.BTSubscription.PAST_DUE,
+    ))
+
+    return [
+        'CREATE INDEX %s ON %s (%s) WHERE %s IN (%s);' % (
+            qn('%s_running' % subscription_table), qn(subscription_table),
+            qn('customer_id'), qn('status'), running
+        ),
+        'CREATE INDEX %s ON %s (%s) WHERE %s;' % (
+            qn('%s_default' % card_table), qn(card_table),
+            qn('customer_id'), qn('default')
+        ),
+    ]
+
+
+def create_partial_indexes(sender, created_models, db, **kwargs):
+    """ Add the partial indexes when syncdb creates our tables """
+    if models.BTSubscription not in created_models:
+        return
+
+    connection = connections[db]
+    cursor = connection.cursor()
+    for sql in partial_index_sql(connection):
+        cursor.execute(sql)
+
+signals.post_syncdb.connect(create_partial_indexes, sender=models)
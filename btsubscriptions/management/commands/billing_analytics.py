@@ -0,0 +1,20 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.core.serializers.json import DjangoJSONEncoder
+
+from btsubscriptions.analytics import report
+
+
+class Command(NoArgsCommand):
+    help = 'Print MRR, ARPU, churn, per-plan and add-on/discount revenue'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--days', type='int', default=30,
+            help='Compute churn over this many days'),
+    )
+
+    def handle_noargs(self, **options):
+        self.stdout.write(json.dumps(report(days=options['days']),
+            cls=DjangoJSONEncoder, indent=2, sort_keys=True))
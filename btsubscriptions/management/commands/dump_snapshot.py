@@ -0,0 +1,24 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from btsubscriptions.snapshots import dump
+
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = 'Write a compressed snapshot of the local braintree mirror'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', default=1000,
+            help='Number of rows read per query'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Pass the file to write the snapshot to')
+
+        counts = dump(args[0], chunk_size=options['chunk_size'])
+        if int(options['verbosity']) > 0:
+            for label, count in sorted(counts.iteritems()):
+                self.stdout.write(u'%s: %d rows' % (label, count))
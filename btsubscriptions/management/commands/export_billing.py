@@ -0,0 +1,47 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from btsubscriptions.exports import EXPORTS, FORMATS, parse_day
+
+
+class Command(BaseCommand):
+    args = '<%s>' % '|'.join(sorted(EXPORTS))
+    help = 'Export subscriptions, transactions or webhook logs as CSV or JSONL'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', choices=sorted(FORMATS), default='csv',
+            help='Output format'),
+        make_option('--start', metavar='YYYY-MM-DD',
+            help='Only export rows created on or after this day'),
+        make_option('--end', metavar='YYYY-MM-DD',
+            help='Only export rows created before this day'),
+        make_option('--output', metavar='FILE',
+            help='Write the export to FILE instead of stdout'),
+        make_option('--chunk-size', type='int', default=1000,
+            help='Number of rows read per query'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or args[0] not in EXPORTS:
+            raise CommandError('Choose one of: %s' % ', '.join(sorted(EXPORTS)))
+
+        try:
+            start, end = [
+                parse_day(options[key]) if options[key] else None
+                for key in ('start', 'end')
+            ]
+        except ValueError as e:
+            raise CommandError(e)
+
+        lines = FORMATS[options['format']][0](args[0], start, end,
+            options['chunk_size'])
+
+        if not options['output']:
+            for line in lines:
+                self.stdout.write(line, ending='')
+            return
+
+        with open(options['output'], 'wb') as output:
+            for line in lines:
+                output.write(line)
@@ -0,0 +1,33 @@
+import csv
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from btsubscriptions.forecast import charge_events, daily_totals
+
+
+class Command(NoArgsCommand):
+    help = 'Print the projected charges of all running subscriptions as CSV'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--days', type='int', default=90,
+            help='Forecast this many days ahead'),
+        make_option('--events', action='store_true', default=False,
+            help='Print every single charge instead of daily totals'),
+        make_option('--chunk-size', type='int', default=2000,
+            help='Number of subscriptions read per query'),
+    )
+
+    def handle_noargs(self, **options):
+        writer = csv.writer(self.stdout)
+        if options['events']:
+            writer.writerow(('date', 'subscription', 'currency', 'amount'))
+            rows = charge_events(options['days'],
+                chunk_size=options['chunk_size'])
+        else:
+            writer.writerow(('date', 'currency', 'charges', 'amount'))
+            rows = daily_totals(options['days'],
+                chunk_size=options['chunk_size'])
+
+        for row in rows:
+            writer.writerow(row)
@@ -1,6 +1,7 @@
 from django.core.management.base import NoArgsCommand
 
 from btsubscriptions.models import BTPlan, BTAddOn, BTDiscount
+from btsubscriptions.ratelimit import BACKGROUND, set_default_priority
 
 
 class Command(NoArgsCommand):
@@ -23,6 +24,7 @@ class Command(NoArgsCommand):
             btobject.save()
 
     def handle_noargs(self, **options):
+        set_default_priority(BACKGROUND)
         self.import_from_vault(BTPlan, 'plan_id')
         self.import_from_vault(BTAddOn, 'addon_id')
         self.import_from_vault(BTDiscount, 'discount_id')
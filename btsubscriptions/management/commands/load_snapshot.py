@@ -0,0 +1,36 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction, IntegrityError
+
+from btsubscriptions.snapshots import clear, load
+
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = 'Load a snapshot written by dump_snapshot into empty mirror tables'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', default=1000,
+            help='Number of rows inserted per batch'),
+        make_option('--clear', action='store_true', default=False,
+            help='Delete all mirrored rows before loading'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Pass the snapshot file to load')
+
+        try:
+            with transaction.atomic():
+                if options['clear']:
+                    clear()
+                counts = load(args[0], chunk_size=options['chunk_size'])
+        except ValueError as e:
+            raise CommandError(e)
+        except IntegrityError as e:
+            raise CommandError(u'%s (use --clear to replace existing rows)' % e)
+
+        if int(options['verbosity']) > 0:
+            for label, count in sorted(counts.iteritems()):
+                self.stdout.write(u'%s: %d rows' % (label, count))
@@ -0,0 +1,94 @@
+import gzip
+from datetime import timedelta
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+
+from btsubscriptions.encoding import encode
+from btsubscriptions.models import BTWebhookLog
+
+
+class Command(BaseCommand):
+    help = 'Delete, archive or compact old webhook logs in batches'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int',
+            default=getattr(settings, 'BRAINTREE_WEBHOOK_LOG_RETENTION', 90),
+            help='Process logs older than this many days'),
+        make_option('--batch-size', type='int', default=1000,
+            help='Number of rows handled per batch'),
+        make_option('--archive', metavar='FILE',
+            help='Append deleted rows as gzipped JSON lines to FILE'),
+        make_option('--keep-exceptions', action='store_true', default=False,
+            help='Do not delete logs which recorded an exception'),
+        make_option('--compact', action='store_true', default=False,
+            help='Compress old logs instead of deleting them'),
+    )
+
+    def handle(self, **options):
+        queryset = BTWebhookLog.objects.filter(
+            received__lt=now() - timedelta(days=options['days'])
+        ).order_by('pk')
+
+        if options['compact']:
+            total = self.compact(queryset, options['batch_size'])
+            self.stdout.write(u'Compacted %d webhook logs' % total)
+            return
+
+        if options['keep_exceptions']:
+            queryset = queryset.filter(exception='')
+
+        archive = None
+        if options['archive']:
+            archive = gzip.open(options['archive'], 'ab')
+
+        try:
+            total = self.prune(queryset, options['batch_size'], archive)
+        finally:
+            if archive is not None:
+                archive.close()
+
+        self.stdout.write(u'Deleted %d webhook logs' % total)
+
+    def prune(self, queryset, batch_size, archive=None):
+        total = 0
+        while True:
+            batch = list(queryset[:batch_size])
+            if not batch:
+                return total
+
+            if archive is not None:
+                for log in batch:
+                    archive.write(encode({
+                        'received': log.received,
+                        'kind': log.kind,
+                        'data': log.get_data(),
+                        'exception': log.exception,
+                        'subscription_id': log.subscription_id,
+                        'bt_signature': log.bt_signature,
+                        'bt_payload': log.bt_payload,
+                    }) + '\n')
+
+            BTWebhookLog.objects.filter(
+                pk__in=[log.pk for log in batch]
+            ).delete()
+            total += len(batch)
+
+    def compact(self, queryset, batch_size):
+        queryset = queryset.filter(compressed=False).exclude(data='')
+        last_pk = 0
+        total = 0
+        while True:
+            batch = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                return total
+
+            for log in batch:
+                BTWebhookLog.objects.filter(pk=log.pk).update(
+                    data=encode(log.get_data(), compress=True),
+                    compressed=True
+                )
+            last_pk = batch[-1].pk
+            total += len(batch)
@@ -0,0 +1,48 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from btsubscriptions.models import BTPushOutbox
+from btsubscriptions.ratelimit import BACKGROUND, set_default_priority
+
+
+class Command(NoArgsCommand):
+    help = 'Push pending changes from the outbox into the braintree vault'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', default=100,
+            help='Number of pending pushes fetched per batch'),
+        make_option('--max-attempts', type='int', default=5,
+            help='Give up on a push after this many failures'),
+        make_option('--loop', type='int', metavar='SECONDS',
+            help='Keep running, polling the outbox every SECONDS'),
+    )
+
+    def handle_noargs(self, **options):
+        set_default_priority(BACKGROUND)
+        while True:
+            pushed, failed = self.drain(options['batch_size'],
+                options['max_attempts'])
+
+            if pushed or failed or int(options['verbosity']) > 1:
+                self.stdout.write(u'Pushed %d, failed %d' % (pushed, failed))
+
+            if not options['loop']:
+                return
+            time.sleep(options['loop'])
+
+    def drain(self, batch_size, max_attempts):
+        pushed = failed = 0
+        while True:
+            batch = list(BTPushOutbox.objects.due(max_attempts)[:batch_size])
+            if not batch:
+                return pushed, failed
+
+            for entry in batch:
+                if not entry.claim():
+                    continue
+                if entry.process():
+                    pushed += 1
+                else:
+                    failed += 1
@@ -0,0 +1,68 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from btsubscriptions.exports import parse_day
+from btsubscriptions.webhooks import replay
+from btsubscriptions.ratelimit import BACKGROUND, set_default_priority
+
+
+class Command(BaseCommand):
+    args = '[subscription_id ...]'
+    help = ('Re-apply stored webhook notifications to rebuild subscription '
+        'state, for all or the given subscriptions')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--start', metavar='YYYY-MM-DD',
+            help='Only replay notifications received on or after this day'),
+        make_option('--end', metavar='YYYY-MM-DD',
+            help='Only replay notifications received before this day'),
+        make_option('--threads', type='int',
+            help='Number of subscription partitions replayed in parallel, '
+                'defaults to BRAINTREE_MAX_CONCURRENT_CALLS'),
+        make_option('--dry-run', action='store_true', default=False,
+            help='Print the changes without saving them'),
+    )
+
+    def handle(self, *args, **options):
+        set_default_priority(BACKGROUND)
+        try:
+            start, end = [
+                parse_day(options[key]) if options[key] else None
+                for key in ('start', 'end')
+            ]
+        except ValueError as e:
+            raise CommandError(e)
+
+        rate = getattr(settings, 'BRAINTREE_WEBHOOK_LOG_SAMPLE_RATE', 1.0)
+        if rate < 1:
+            self.stderr.write(u'Warning: BRAINTREE_WEBHOOK_LOG_SAMPLE_RATE is '
+                u'%s, successful notifications which were not sampled are '
+                u'missing from the replay' % rate)
+
+        self.verbosity = int(options['verbosity'])
+        self.dry_run = options['dry_run']
+        threads = options['threads'] or getattr(settings,
+            'BRAINTREE_MAX_CONCURRENT_CALLS', 4)
+
+        totals = replay(start, end, subscription_ids=args or None,
+            threads=threads, dry_run=self.dry_run, report=self.report)
+
+        seconds = max(totals['seconds'], 0.001)
+        self.stdout.write(u'%s %d notifications of %d subscriptions in '
+            u'%.1fs (%.1f notifications/s), %d changed, %d failed' % (
+                'Checked' if self.dry_run else 'Replayed',
+                totals['notifications'], totals['subscriptions'], seconds,
+                totals['notifications'] / seconds, totals['changed'],
+                totals['errors']))
+
+    def report(self, subscription_id, notifications, changes, error):
+        if error is not None:
+            self.stderr.write(u'%s: %s' % (subscription_id, error))
+        elif changes and (self.dry_run or self.verbosity > 1):
+            lines = [u'%s (%d notifications):' % (
+                subscription_id, notifications)]
+            for name, (before, after) in sorted(changes.iteritems()):
+                lines.append(u'  %s: %r -> %r' % (name, before, after))
+            self.stdout.write(u'\n'.join(lines))
@@ -0,0 +1,65 @@
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+
+from btsubscriptions.models import BTJob
+from btsubscriptions.ratelimit import BACKGROUND, set_default_priority
+
+
+class Command(NoArgsCommand):
+    help = 'Process pending background jobs in chunks'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', type='int', default=100,
+            help='Number of objects processed before the position is saved'),
+        make_option('--concurrency', type='int',
+            help='Number of threads calling the vault, defaults to '
+                'BRAINTREE_MAX_CONCURRENT_CALLS'),
+        make_option('--rate', type='float', default=0,
+            help='Maximum number of objects processed per second. An object '
+                'may take several vault calls, BRAINTREE_RATE_LIMIT limits '
+                'the calls themselves'),
+        make_option('--loop', type='int', metavar='SECONDS',
+            help='Keep running, polling for new jobs every SECONDS'),
+    )
+
+    def handle_noargs(self, **options):
+        set_default_priority(BACKGROUND)
+        self.verbosity = int(options['verbosity'])
+        concurrency = options['concurrency'] or getattr(settings,
+            'BRAINTREE_MAX_CONCURRENT_CALLS', 4)
+
+        while True:
+            for job in BTJob.objects.due():
+                if not job.claim():
+                    continue
+                self.run(job, options['chunk_size'], concurrency,
+                    options['rate'])
+
+            if not options['loop']:
+                return
+            time.sleep(options['loop'])
+
+    def run(self, job, chunk_size, concurrency, rate):
+        running = True
+        while running:
+            start = time.time()
+            position = job.position
+            running = job.process_chunk(chunk_size, concurrency)
+
+            if self.verbosity > 1:
+                self.stdout.write(u'%s: %d/%d, %d failed' % (
+                    job, job.position, job.total, job.failed))
+
+            if rate:
+                # Wait until this chunk fits into the rate
+                remaining = (job.position - position) / rate \
+                    - (time.time() - start)
+                if running and remaining > 0:
+                    time.sleep(remaining)
+
+        self.stdout.write(u'%s: %s, %d/%d processed, %d failed' % (
+            job, job.get_status_display(), job.position, job.total,
+            job.failed))
@@ -0,0 +1,104 @@
+from collections import defaultdict
+from datetime import timedelta
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from django.db.models import Q
+from django.utils.timezone import localtime, now
+
+from btsubscriptions.models import BTScanCursor, BTSubscription
+from btsubscriptions.scanning import scan
+from btsubscriptions.signals import subscription_dunning
+from btsubscriptions.ratelimit import BACKGROUND, set_default_priority
+
+
+# Minimum days past due for each dunning stage
+DEFAULT_STAGES = (
+    (1, 'reminder'),
+    (7, 'warning'),
+    (21, 'final'),
+)
+
+
+def days_past_due(subscription, today):
+    """ Days since the first unpaid billing date. The cached days_past_due
+        only changes with a webhook or pull, so count from the paid through
+        date as well.
+    """
+    days = subscription.days_past_due or 0
+    if subscription.paid_through_date is not None:
+        paid_through = localtime(subscription.paid_through_date).date()
+        days = max(days, (today - paid_through).days - 1)
+    return days
+
+
+def crossed_stages(stages, since):
+    """ Q of the subscriptions which reached a stage after since """
+    crossed = Q(pk__in=[])
+    for threshold, name in stages:
+        # paid_through_date + threshold + 1 days lies in (since, now]
+        offset = timedelta(days=threshold + 1)
+        crossed |= Q(paid_through_date__gt=since - offset,
+            paid_through_date__lte=now() - offset)
+    return crossed
+
+
+def dunning_stage(days_past_due, stages):
+    """ Return the name of the highest stage reached, or None """
+    reached = None
+    for threshold, name in sorted(stages):
+        if days_past_due is not None and days_past_due >= threshold:
+            reached = name
+    return reached
+
+
+class Command(NoArgsCommand):
+    help = ('Send the subscription_dunning signal for past due subscriptions, '
+        'grouped by dunning stage')
+
+    cursor_name = 'dunning'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', default=500,
+            help='Number of subscriptions per batch and signal'),
+        make_option('--limit', type='int',
+            help='Stop after this many subscriptions, the next run continues'),
+        make_option('--reset', action='store_true', default=False,
+            help='Forget the cursor and scan all past due subscriptions'),
+    )
+
+    def handle_noargs(self, **options):
+        set_default_priority(BACKGROUND)
+        if options['reset']:
+            BTScanCursor.objects.filter(name=self.cursor_name).delete()
+
+        stages = getattr(settings, 'BRAINTREE_DUNNING_STAGES', DEFAULT_STAGES)
+        self.counts = defaultdict(int)
+
+        today = localtime(now()).date()
+
+        def handle_batch(subscriptions):
+            groups = defaultdict(list)
+            for subscription in subscriptions:
+                stage = dunning_stage(days_past_due(subscription, today),
+                    stages)
+                if stage:
+                    groups[stage].append(subscription)
+
+            for stage, members in groups.items():
+                subscription_dunning.send(sender=BTSubscription, stage=stage,
+                    subscriptions=members)
+                self.counts[stage] += len(members)
+
+        scanned = scan(self.cursor_name,
+            BTSubscription.objects.filter(status=BTSubscription.PAST_DUE),
+            handle_batch,
+            batch_size=options['batch_size'],
+            limit=options['limit'],
+            changed_field='updated',
+            changed=lambda since: crossed_stages(stages, since))
+
+        self.stdout.write(u'Scanned %d past due subscriptions' % scanned)
+        for stage, count in sorted(self.counts.items()):
+            self.stdout.write(u'  %s: %d' % (stage, count))
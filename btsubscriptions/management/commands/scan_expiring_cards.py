@@ -0,0 +1,64 @@
+from datetime import timedelta
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db.models import Q
+from django.utils.timezone import now
+
+from btsubscriptions.models import BTCreditCard, BTScanCursor
+from btsubscriptions.scanning import scan
+from btsubscriptions.signals import cards_expiring
+
+
+def entered_window(days, since):
+    """ Q of the cards whose next charge moved into the window of days
+        after since
+    """
+    return Q(customer__subscriptions__next_billing_date__gte=since +
+        timedelta(days=days))
+
+
+class Command(NoArgsCommand):
+    help = ('Send the cards_expiring signal for default cards which expire '
+        'before the next charge of a running subscription')
+
+    cursor_name = 'expiring_cards'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--days', type='int', default=30,
+            help='Only consider charges within this many days'),
+        make_option('--batch-size', type='int', default=500,
+            help='Number of cards per batch and signal'),
+        make_option('--limit', type='int',
+            help='Stop after this many cards, the next run continues'),
+        make_option('--reset', action='store_true', default=False,
+            help='Forget the cursor and signal all expiring cards again'),
+    )
+
+    def handle_noargs(self, **options):
+        if options['reset']:
+            BTScanCursor.objects.filter(name=self.cursor_name).delete()
+
+        filled = BTCreditCard.objects.fill_expires_on()
+        if filled:
+            self.stdout.write(u'Set the expiry date of %d cards' % filled)
+
+        self.count = 0
+
+        def handle_batch(cards):
+            cards_expiring.send(sender=BTCreditCard, cards=cards)
+            self.count += len(cards)
+
+        until = now() + timedelta(days=options['days'])
+        scan(self.cursor_name,
+            BTCreditCard.objects.expiring_before_next_charge(until),
+            handle_batch,
+            batch_size=options['batch_size'],
+            limit=options['limit'],
+            # Cards are signalled again when a subscription of their
+            # customer changed, e.g. was switched to a new card
+            changed_field='customer__subscriptions__updated',
+            changed=lambda since: entered_window(options['days'], since))
+
+        self.stdout.write(u'%d cards expire before their next charge'
+            % self.count)
@@ -0,0 +1,20 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from btsubscriptions.management import partial_index_sql
+
+
+class Command(NoArgsCommand):
+    help = ('Prints the CREATE INDEX statements of the PostgreSQL partial '
+        'indexes, for databases created before they were introduced')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--database', default=DEFAULT_DB_ALIAS,
+            help='Nominates a database to print the SQL for.'),
+    )
+
+    def handle_noargs(self, **options):
+        connection = connections[options['database']]
+        return u'\n'.join(partial_index_sql(connection))
@@ -0,0 +1,61 @@
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+
+from btsubscriptions.jobs import run_operation
+from btsubscriptions.models import BTCustomer, BTSubscription
+from btsubscriptions.ratelimit import BACKGROUND, set_default_priority
+from btsubscriptions.sharding import Shard
+
+
+class Command(NoArgsCommand):
+    help = ('Pull the customers of this worker\'s shard and their running '
+        'subscriptions from the vault')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--worker',
+            help='Name of this worker, defaults to hostname:pid'),
+        make_option('--chunk-size', type='int', default=100,
+            help='Number of customers looked at between lease renewals'),
+        make_option('--concurrency', type='int',
+            help='Number of threads calling the vault, defaults to '
+                'BRAINTREE_MAX_CONCURRENT_CALLS'),
+        make_option('--loop', type='int', metavar='SECONDS',
+            help='Keep running, starting a new pass every SECONDS'),
+    )
+
+    def handle_noargs(self, **options):
+        set_default_priority(BACKGROUND)
+        self.verbosity = int(options['verbosity'])
+        concurrency = options['concurrency'] or getattr(settings,
+            'BRAINTREE_MAX_CONCURRENT_CALLS', 4)
+
+        shard = Shard(options['worker'])
+        try:
+            while True:
+                self.sync(shard, options['chunk_size'], concurrency)
+                if not options['loop']:
+                    return
+                time.sleep(options['loop'])
+        finally:
+            shard.leave()
+
+    def sync(self, shard, chunk_size, concurrency):
+        synced = failed = 0
+        for customers in shard.chunks(BTCustomer.objects.all(), chunk_size):
+            subscriptions = list(BTSubscription.objects.running()
+                .filter(customer__in=customers))
+            errors = run_operation('pull', customers + subscriptions, {},
+                concurrency=concurrency)
+
+            synced += len(customers)
+            failed += len(errors)
+            for error in errors:
+                self.stderr.write(error)
+
+        if synced or self.verbosity > 1:
+            self.stdout.write(u'%s: synced %d customers of %d workers, '
+                '%d failed' % (shard.worker, synced, len(shard.ring.workers),
+                    failed))
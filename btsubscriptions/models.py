@@ -1,13 +1,22 @@
-import braintree
-
-from datetime import timedelta
-
-from django.db import models
-from django.utils.timezone import now
+import random
+
+from collections import defaultdict
+from datetime import date, timedelta
+from decimal import Decimal
+from itertools import groupby
+
+from django.conf import settings
+from django.contrib.contenttypes.generic import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
+from django.db import models, transaction, IntegrityError
+from django.db.models.signals import post_save, post_delete
+from django.utils.timezone import localtime, now
 from django.core.exceptions import ValidationError
 from django.utils.translation import ugettext_lazy as _
 
-from .sync import BTSyncedModel, BTMirroredModel
+from .encoding import encode, decode
+from .gateways import GatewayCollection, activate, get_tenant
+from .sync import BTSyncedModel, BTMirroredModel, normalize_datetime
 
 
 # Common attributes sets for fields
@@ -16,7 +25,7 @@ CACHED = {'editable': False, 'blank': True, 'null': True}
 
 
 class BTCustomer(BTSyncedModel):
-    collection = braintree.Customer
+    collection = GatewayCollection('customer')
 
     id = models.OneToOneField('customers.Customer',
         related_name='braintree', primary_key=True)
@@ -46,7 +55,7 @@ class BTCustomer(BTSyncedModel):
 
     def push_related(self):
         for address in self.addresses.all():
-            address.push()
+            address.push_or_defer()
             address.save()
 
     @property
@@ -55,7 +64,7 @@ class BTCustomer(BTSyncedModel):
 
 
 class BTAddress(BTSyncedModel):
-    collection = braintree.Address
+    collection = GatewayCollection('address')
 
     code = models.CharField(max_length=100, unique=True)
     customer = models.ForeignKey(BTCustomer, related_name='addresses')
@@ -105,6 +114,13 @@ class BTAddress(BTSyncedModel):
             self.code = result.address.id
 
 
+def expiry_date(month, year):
+    """ The first day of the month after the expiration month """
+    if not month or not year:
+        return None
+    return date(int(year) + int(month) // 12, int(month) % 12 + 1, 1)
+
+
 class BTCreditCardManager(models.Manager):
     def has_default(self):
         return self.filter(default=True).count() == 1
@@ -115,9 +131,52 @@ class BTCreditCardManager(models.Manager):
         except self.model.DoesNotExist:
             return None
 
+    def expiring_before_next_charge(self, until=None):
+        """ Default cards which expire before the next charge of a running
+            subscription of their customer, optionally only for charges
+            before until
+        """
+        # next_billing_date holds local midnight of the charge day, while
+        # databases compare the date expires_on as midnight UTC. Move it to
+        # local noon, which stays within the charge day whatever the offset
+        # or daylight saving time of that day.
+        shift = timedelta(hours=12)
+        if settings.USE_TZ:
+            shift += localtime(now()).utcoffset()
+
+        # One filter() call, so all conditions apply to the same
+        # subscription instead of joining the subscriptions again
+        conditions = {
+            'customer__subscriptions__status__in': (
+                BTSubscription.PENDING,
+                BTSubscription.ACTIVE,
+                BTSubscription.PAST_DUE,
+            ),
+            'expires_on__lt': models.F(
+                'customer__subscriptions__next_billing_date') + shift,
+        }
+        if until is not None:
+            conditions['customer__subscriptions__next_billing_date__lt'] = \
+                until
+        return self.filter(default=True, **conditions).distinct()
+
+    def fill_expires_on(self):
+        """ Set expires_on of cards saved before it existed, with one update
+            per expiration month. Returns the number of updated cards.
+        """
+        missing = self.filter(expires_on=None)\
+            .exclude(expiration_month=None).exclude(expiration_year=None)
+        updated = 0
+        for month, year in set(missing.values_list(
+                'expiration_month', 'expiration_year')):
+            updated += missing.filter(expiration_month=month,
+                expiration_year=year).update(
+                expires_on=expiry_date(month, year))
+        return updated
+
 
 class BTCreditCard(BTMirroredModel):
-    collection = braintree.CreditCard
+    collection = GatewayCollection('credit_card')
     pull_excluded_fields = ('id', 'customer_id')
 
     token = models.CharField(max_length=100, unique=True)
@@ -138,12 +197,16 @@ class BTCreditCard(BTMirroredModel):
     country_of_issuance = models.CharField(max_length=255, **CACHED)
     issuing_bank = models.CharField(max_length=255, **CACHED)
 
+    expires_on = models.DateField(db_index=True,
+        help_text=_('First day the card is no longer valid.'), **CACHED)
+
     objects = BTCreditCardManager()
 
     # There are more boolean fields in braintree available, yet i don't think
     # We need them for now
 
     class Meta:
+        index_together = (('customer', 'default'),)
         verbose_name = _('credit card')
         verbose_name_plural = _('credit cards')
 
@@ -162,13 +225,18 @@ class BTCreditCard(BTMirroredModel):
     def braintree_key(self):
         return (self.token or '0',)
 
+    def save(self, *args, **kwargs):
+        self.expires_on = expiry_date(self.expiration_month,
+            self.expiration_year)
+        super(BTCreditCard, self).save(*args, **kwargs)
+
     def import_data(self, data):
         super(BTCreditCard, self).import_data(data)
         self.customer_id = int(data.customer_id)
 
 
 class BTPlan(BTMirroredModel):
-    collection = braintree.Plan
+    collection = GatewayCollection('plan')
 
     plan_id = models.CharField(max_length=100, unique=True)
 
@@ -210,7 +278,7 @@ class BTPlan(BTMirroredModel):
 
 
 class BTAddOn(BTMirroredModel):
-    collection = braintree.AddOn
+    collection = GatewayCollection('add_on')
     #plan = models.ForeignKey(BTPlan, related_name='add_ons')
     addon_id = models.CharField(max_length=255, unique=True)
 
@@ -232,7 +300,7 @@ class BTAddOn(BTMirroredModel):
 
 
 class BTDiscount(BTMirroredModel):
-    collection = braintree.Discount
+    collection = GatewayCollection('discount')
     #plan = models.ForeignKey(BTPlan, related_name='discounts')
     discount_id = models.CharField(max_length=255, unique=True)
 
@@ -260,9 +328,41 @@ class BTSubscriptionManager(models.Manager):
             self.model.PAST_DUE,
             ))
 
+    def upsert(self, data, source=None, **fields):
+        """ Create or update the subscription of the vault data atomically,
+            setting fields on it. The view and the webhook may import the
+            same new subscription concurrently: an existing row is locked
+            with select_for_update(), losing the race to insert it raises
+            an IntegrityError on the unique subscription_id and is retried
+            as update. Data older than the stored state (by updated_at) is
+            ignored. Returns the subscription.
+        """
+        updated_at = getattr(data, 'updated_at', None)
+        if updated_at is not None:
+            updated_at = normalize_datetime(updated_at)
+
+        for retry in (False, True):
+            try:
+                with transaction.atomic():
+                    try:
+                        subscription = self.select_for_update().get(
+                            subscription_id=data.id)
+                    except self.model.DoesNotExist:
+                        subscription = self.model(subscription_id=data.id)
+                    else:
+                        # A webhook may have stored newer state meanwhile
+                        if None not in (updated_at, subscription.updated_at) \
+                                and updated_at < subscription.updated_at:
+                            return subscription
+                    subscription.apply_data(data, source, **fields)
+                    return subscription
+            except IntegrityError:
+                if retry:
+                    raise
+
 
 class BTSubscription(BTSyncedModel):
-    collection = braintree.Subscription
+    collection = GatewayCollection('subscription')
     pull_excluded_fields = (
         'id',
         'plan_id',
@@ -334,9 +434,31 @@ class BTSubscription(BTSyncedModel):
 
     days_past_due = models.IntegerField(**CACHED)
 
+    # Timestamp from braintree
+    updated_at = models.DateTimeField(**CACHED)
+
     # Manager
     objects = BTSubscriptionManager()
 
+    # Changes of these fields are recorded in BTSubscriptionHistory
+    history_fields = (
+        'status',
+        'plan_id',
+        'price',
+        'balance',
+        'next_billing_period_amount',
+        'billing_period_start_date',
+        'billing_period_end_date',
+        'paid_through_date',
+        'next_billing_date',
+        'current_billing_cycle',
+        'number_of_billing_cycles',
+        'days_past_due',
+    )
+
+    # What caused the changes of the next save(): local, pull, push or webhook
+    history_source = 'local'
+
     updateable_fields = (
         'plan_id',
         'payment_method_token',
@@ -346,19 +468,90 @@ class BTSubscription(BTSyncedModel):
     )
 
     class Meta:
+        index_together = (
+            ('customer', 'status'),
+            ('status', 'updated'),
+            ('created', 'id'),
+        )
         verbose_name = _('subscription')
         verbose_name_plural = _('subscriptions')
 
+    def __init__(self, *args, **kwargs):
+        super(BTSubscription, self).__init__(*args, **kwargs)
+        # New subscriptions record their complete initial state
+        self._history_state = self.history_state() if self.pk else {}
+
     def __unicode__(self):
         return self.subscription_id
 
+    def history_state(self):
+        # Deferred fields are not loaded just for the history
+        return dict(
+            (name, self.__dict__[name]) for name in self.history_fields
+            if name in self.__dict__
+        )
+
+    def history_changes(self):
+        """ Tracked fields which changed since the last save or load """
+        return dict(
+            (name, value) for name, value in self.history_state().iteritems()
+            if name not in self._history_state
+            or self._history_state[name] != value
+        )
+
+    def save(self, *args, **kwargs):
+        changes = self.history_changes()
+        if not changes:
+            super(BTSubscription, self).save(*args, **kwargs)
+        else:
+            # The history row shares the fate of the change, no savepoint
+            with transaction.atomic(savepoint=False):
+                super(BTSubscription, self).save(*args, **kwargs)
+                BTSubscriptionHistory.objects.record(self, changes,
+                    self.history_source)
+
+        self._history_state = self.history_state()
+        self.history_source = BTSubscription.history_source
+
+    def import_data(self, data, source=None):
+        if source:
+            self.history_source = source
+        super(BTSubscription, self).import_data(data)
+
+    def pull(self):
+        self.history_source = 'pull'
+        super(BTSubscription, self).pull()
+
+    def apply_data(self, data, source=None, **fields):
+        """ Set fields and import the vault data, saving only new or changed
+            subscriptions. Returns whether the subscription was saved.
+        """
+        names = [
+            field.attname for field in self._meta.concrete_fields
+            if field.name not in self.always_exclude
+        ]
+        before = [getattr(self, name) for name in names]
+
+        for name, value in fields.iteritems():
+            setattr(self, name, value)
+        self.import_data(data, source=source)
+
+        # import_data() normalizes vault dates, so they compare equal
+        if self.pk is not None \
+                and before == [getattr(self, name) for name in names]:
+            return False
+        self.save()
+        return True
+
     def clean(self):
+        from braintree import SubscriptionSearch
+
         if not self.subscription_id:
             customer_payment_tokens = self.customer.credit_cards.values_list(
                 'token', flat=True
             )
             search_results = self.collection.search(
-                braintree.SubscriptionSearch.status == BTSubscription.ACTIVE
+                SubscriptionSearch.status == BTSubscription.ACTIVE
             )
 
             for subscription in search_results.items:
@@ -378,14 +571,69 @@ class BTSubscription(BTSyncedModel):
     def braintree_key(self):
         return (self.subscription_id,)
 
+    def modifier_changes(self, data):
+        """ Update params which turn the add-ons and discounts of the vault
+            subscription data into the local ones, None if they match
+        """
+        params = {}
+        for key, local in (
+            ('add_ons', self.subscribed_addons.values_list(
+                'add_on__addon_id', 'quantity')),
+            ('discounts', self.subscribed_discounts.values_list(
+                'discount__discount_id', 'quantity')),
+        ):
+            local = dict(local)
+            remote = dict((m.id, m.quantity) for m in getattr(data, key, []))
+
+            changes = {}
+            add = [
+                {'inherited_from_id': id, 'quantity': quantity}
+                for id, quantity in sorted(local.iteritems())
+                if id not in remote
+            ]
+            update = [
+                {'existing_id': id, 'quantity': quantity}
+                for id, quantity in sorted(local.iteritems())
+                if id in remote and remote[id] != quantity
+            ]
+            remove = sorted(id for id in remote if id not in local)
+
+            if add:
+                changes['add'] = add
+            if update:
+                changes['update'] = update
+            if remove:
+                changes['remove'] = remove
+            if changes:
+                params[key] = changes
+
+        return params or None
+
+    def sync_modifiers(self):
+        """ Push only the add-on and discount changes since the vault state
+            and import the updated subscription. Returns the result of the
+            update or None if nothing changed.
+        """
+        params = self.modifier_changes(
+            self.collection.find(self.subscription_id))
+        if params is None:
+            return None
+
+        result = self.collection.update(self.subscription_id, params)
+        if result.is_success:
+            self.import_data(result.subscription, source='push')
+            self.save()
+        return result
+
     def pull_related(self):
-        for transaction in self.transactions.all():
-            transaction.pull()
-            transaction.save()
+        for bt_transaction in self.transactions.all():
+            bt_transaction.pull()
+            bt_transaction.save()
 
     def on_pushed(self, result):
         self.subscription_id = result.subscription.id
         self.status = result.subscription.status
+        self.history_source = 'push'
 
     def serialize_base(self):
         # Intentionally raise DoesNotExist here if 0 or >1 default cards
@@ -485,6 +733,87 @@ class BTSubscribedDiscount(models.Model):
         return u'%s -> %s' % (self.subscription, self.discount)
 
 
+class BTSubscriptionHistoryManager(models.Manager):
+    def record(self, subscription, changes, source):
+        return self.create(subscription=subscription, source=source,
+            changes=encode(changes))
+
+    def as_of(self, subscription, timestamp):
+        """ State of the tracked fields of subscription at timestamp, None if
+            nothing was recorded before
+        """
+        entries = self.filter(subscription=subscription,
+            recorded__lte=timestamp).order_by('recorded', 'pk')
+        return self.model.fold(entries.values_list('changes', flat=True))
+
+    def states_as_of(self, timestamp, chunk_size=1000):
+        """ Yield (subscription pk, state) of all subscriptions with recorded
+            changes at timestamp, reading chunk_size subscriptions at a time
+        """
+        subscriptions = BTSubscription.objects.order_by('pk')
+        last_pk = 0
+        while True:
+            pks = list(subscriptions.filter(pk__gt=last_pk)
+                .values_list('pk', flat=True)[:chunk_size])
+            if not pks:
+                return
+            last_pk = pks[-1]
+
+            entries = self.filter(subscription__in=pks,
+                recorded__lte=timestamp)\
+                .order_by('subscription', 'recorded', 'pk')\
+                .values_list('subscription', 'changes')
+            for pk, group in groupby(entries, key=lambda entry: entry[0]):
+                yield pk, self.model.fold(changes for _, changes in group)
+
+    def rollup(self, timestamp, group_by='status', total='balance'):
+        """ Number of subscriptions and sum of total per value of group_by,
+            as they were at timestamp
+        """
+        rollup = defaultdict(lambda: {'subscriptions': 0, total: Decimal(0)})
+        for pk, state in self.states_as_of(timestamp):
+            entry = rollup[state.get(group_by)]
+            entry['subscriptions'] += 1
+            entry[total] += state.get(total) or 0
+        return dict(rollup)
+
+
+class BTSubscriptionHistory(models.Model):
+    """ Append-only record of the changed fields of a subscription """
+
+    subscription = models.ForeignKey(BTSubscription, related_name='history')
+    recorded = models.DateTimeField(default=now)
+    source = models.CharField(max_length=20)
+
+    # The new values of the changed fields, as JSON
+    changes = models.TextField()
+
+    objects = BTSubscriptionHistoryManager()
+
+    class Meta:
+        index_together = (('subscription', 'recorded'),)
+        verbose_name = _('subscription history')
+        verbose_name_plural = _('subscription history')
+
+    def __unicode__(self):
+        return u'%s %s' % (self.subscription_id, self.recorded)
+
+    @staticmethod
+    def fold(changes):
+        """ Apply encoded changes in order, returns the state or None """
+        fields = dict(
+            (field.attname, field) for field in BTSubscription._meta.fields)
+        state = None
+        for encoded in changes:
+            state = state or {}
+            for name, value in decode(encoded).iteritems():
+                state[name] = fields[name].to_python(value)
+        return state
+
+    def get_changes(self):
+        return self.fold([self.changes])
+
+
 class BTTransactionManager(models.Manager):
     def for_customer(self, customer):
         return self.filter(subscription__customer=customer)
@@ -499,7 +828,7 @@ class BTTransaction(BTMirroredModel):
         (CREDIT, _('credit')),
     )
 
-    collection = braintree.Transaction
+    collection = GatewayCollection('transaction')
     pull_excluded_fields = ('id', 'subscription', 'subscription_id')
 
     transaction_id = models.CharField(max_length=255, unique=True)
@@ -520,6 +849,7 @@ class BTTransaction(BTMirroredModel):
 
     class Meta:
         ordering = ('-created_at',)
+        index_together = (('subscription', 'created_at'), ('created_at', 'id'))
         verbose_name = _('transaction')
         verbose_name_plural = _('transactions')
 
@@ -544,11 +874,350 @@ class BTWebhookLog(models.Model):
     received = models.DateTimeField(auto_now=True)
     kind = models.CharField(max_length=255)
     data = models.TextField(blank=True)
+    compressed = models.BooleanField(default=False, editable=False)
     exception = models.TextField(blank=True)
 
+    # The raw notification, to replay it with manage.py replay_webhooks
+    subscription_id = models.CharField(max_length=255, blank=True)
+    bt_signature = models.TextField(blank=True, editable=False)
+    bt_payload = models.TextField(blank=True, editable=False)
+
     class Meta:
+        index_together = (
+            ('kind', 'received'),
+            ('received', 'id'),
+            ('subscription_id', 'received'),
+        )
         verbose_name = _('webhook log')
         verbose_name_plural = _('webhook logs')
 
     def __unicode__(self):
         return self.kind
+
+    @classmethod
+    def is_sampled(cls):
+        """ Decide if a successful notification should be logged """
+        rate = getattr(settings, 'BRAINTREE_WEBHOOK_LOG_SAMPLE_RATE', 1.0)
+        return rate >= 1 or random.random() < rate
+
+    def set_data(self, data):
+        """ Store data as compact (and optionally compressed) JSON """
+        compress = getattr(settings, 'BRAINTREE_WEBHOOK_LOG_COMPRESS', False)
+        self.data = encode(data, compress=compress)
+        self.compressed = compress
+
+    def get_data(self):
+        """ Return the decoded data, or the raw text for legacy rows """
+        if not self.data:
+            return None
+        try:
+            return decode(self.data, compressed=self.compressed)
+        except ValueError:
+            return self.data
+
+
+class BTPushOutboxManager(models.Manager):
+    def schedule(self, instance):
+        """ Record a pending push, coalescing with an already pending one.
+            A coalesced push keeps the attempts and backoff of failures.
+        """
+        content_type = ContentType.objects.get_for_model(instance)
+        pending = self.filter(content_type=content_type,
+            object_id=str(instance.pk))
+        tenant = get_tenant()
+
+        if pending.update(scheduled=now(), tenant=tenant):
+            return
+        try:
+            with transaction.atomic():
+                self.create(content_type=content_type,
+                    object_id=str(instance.pk), tenant=tenant)
+        except IntegrityError:
+            # Scheduled concurrently, coalesce with that one
+            pending.update(scheduled=now(), tenant=tenant)
+
+    def due(self, max_attempts):
+        return self.filter(next_attempt__lte=now(),
+            attempts__lt=max_attempts).order_by('scheduled')
+
+
+class BTPushOutbox(models.Model):
+    """ A pending push of a BTSyncedModel into the vault.
+        There is at most one entry per object, later changes are coalesced.
+    """
+
+    # Seconds a worker may hold an entry before others retry it
+    LEASE = 300
+
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.CharField(max_length=255)
+    instance = GenericForeignKey('content_type', 'object_id')
+    tenant = models.CharField(max_length=100)
+
+    scheduled = models.DateTimeField(default=now)
+    next_attempt = models.DateTimeField(default=now, db_index=True)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    objects = BTPushOutboxManager()
+
+    class Meta:
+        unique_together = (('content_type', 'object_id'),)
+        verbose_name = _('pending push')
+        verbose_name_plural = _('pending pushes')
+
+    def __unicode__(self):
+        return u'%s %s' % (self.content_type, self.object_id)
+
+    def claim(self):
+        """ Lease this entry, returns False if another worker was faster """
+        lease = now() + timedelta(seconds=self.LEASE)
+        claimed = BTPushOutbox.objects.filter(pk=self.pk,
+            next_attempt=self.next_attempt).update(next_attempt=lease)
+        if claimed:
+            self.next_attempt = lease
+        return bool(claimed)
+
+    def process(self):
+        """ Push the object into the vault of the tenant which deferred the
+            change, returns True on success
+        """
+        instance = self.instance
+        if instance is None:
+            # The object has been deleted in the meantime
+            self.delete()
+            return True
+
+        previous = get_tenant()
+        activate(self.tenant)
+        try:
+            instance.push()
+        except Exception as e:
+            self.attempts += 1
+            BTPushOutbox.objects.filter(pk=self.pk).update(
+                attempts=self.attempts,
+                last_error=unicode(e),
+                next_attempt=now() + timedelta(minutes=2 ** self.attempts),
+            )
+            return False
+        finally:
+            activate(previous)
+
+        instance.save()
+
+        # Only remove the entry if no new change was scheduled meanwhile
+        pending = BTPushOutbox.objects.filter(pk=self.pk)
+        if not pending.exclude(scheduled=self.scheduled).update(
+                next_attempt=now()):
+            pending.filter(scheduled=self.scheduled).delete()
+        return True
+
+
+class BTScanCursorManager(models.Manager):
+    def for_name(self, name):
+        cursor, created = self.get_or_create(name=name)
+        return cursor
+
+
+class BTScanCursor(models.Model):
+    """ Progress of a batched scan over a table, see scanning.scan() """
+
+    name = models.CharField(max_length=100, unique=True)
+
+    # Primary key of the last processed object of the current pass
+    position = models.BigIntegerField(default=0)
+
+    # Start of the current and of the last completed pass
+    started = models.DateTimeField(**NULLABLE)
+    completed = models.DateTimeField(**NULLABLE)
+
+    objects = BTScanCursorManager()
+
+    class Meta:
+        verbose_name = _('scan cursor')
+        verbose_name_plural = _('scan cursors')
+
+    def __unicode__(self):
+        return self.name
+
+    def finish(self):
+        """ Complete the current pass, the next one starts from the top """
+        self.completed = self.started
+        self.started = None
+        self.position = 0
+        self.save()
+
+
+class BTWorkerLeaseManager(models.Manager):
+    def renew(self, worker, duration):
+        """ Take or extend the lease of worker for duration seconds """
+        expires = now() + timedelta(seconds=duration)
+        if self.filter(worker=worker).update(expires=expires):
+            return
+        try:
+            with transaction.atomic():
+                self.create(worker=worker, expires=expires)
+        except IntegrityError:
+            self.filter(worker=worker).update(expires=expires)
+
+    def live(self):
+        return self.filter(expires__gt=now())
+
+    def expire(self):
+        """ Delete the leases of workers which stopped renewing them """
+        self.filter(expires__lte=now()).delete()
+
+
+class BTWorkerLease(models.Model):
+    """ A worker sharing the sync work, see sharding.Shard """
+
+    worker = models.CharField(max_length=255, unique=True)
+    started = models.DateTimeField(default=now)
+
+    # Workers which don't renew their lease in time drop out of the ring
+    expires = models.DateTimeField(db_index=True)
+
+    objects = BTWorkerLeaseManager()
+
+    class Meta:
+        verbose_name = _('worker lease')
+        verbose_name_plural = _('worker leases')
+
+    def __unicode__(self):
+        return self.worker
+
+
+class BTJobManager(models.Manager):
+    def enqueue(self, operation, queryset, **params):
+        """ Create a job applying operation to all objects of queryset """
+        pks = list(queryset.order_by('pk').values_list('pk', flat=True))
+        return self.create(
+            operation=operation,
+            content_type=ContentType.objects.get_for_model(queryset.model),
+            tenant=get_tenant(),
+            object_ids=encode(pks),
+            params=encode(params),
+            total=len(pks),
+        )
+
+    def due(self):
+        return self.filter(status__in=(BTJob.PENDING, BTJob.RUNNING),
+            next_attempt__lte=now()).order_by('created')
+
+
+class BTJob(models.Model):
+    """ A bulk operation on many objects, processed in chunks by
+        manage.py run_jobs. See jobs.py for the available operations.
+    """
+
+    # Seconds a worker may spend on a chunk before others take over the job
+    LEASE = 300
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    CANCELED = 'canceled'
+
+    STATUS_CHOICES = (
+        (PENDING, _('pending')),
+        (RUNNING, _('running')),
+        (DONE, _('done')),
+        (CANCELED, _('canceled')),
+    )
+
+    operation = models.CharField(max_length=50)
+    content_type = models.ForeignKey(ContentType)
+    tenant = models.CharField(max_length=100)
+
+    # Primary keys of all objects and operation parameters, as JSON
+    object_ids = models.TextField(editable=False)
+    params = models.TextField(editable=False)
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES,
+        default=PENDING)
+
+    # Number of objects processed so far, the cursor into object_ids
+    position = models.IntegerField(default=0)
+    total = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    next_attempt = models.DateTimeField(default=now, db_index=True)
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(**NULLABLE)
+
+    objects = BTJobManager()
+
+    class Meta:
+        verbose_name = _('job')
+        verbose_name_plural = _('jobs')
+
+    def __unicode__(self):
+        return u'%s %s #%s' % (self.operation, self.content_type, self.pk)
+
+    @property
+    def progress(self):
+        """ Share of processed objects in percent """
+        if not self.total:
+            return 100
+        return 100 * self.position // self.total
+
+    def claim(self):
+        """ Lease this job, returns False if another worker was faster """
+        lease = now() + timedelta(seconds=self.LEASE)
+        claimed = BTJob.objects.filter(pk=self.pk,
+            next_attempt=self.next_attempt).update(next_attempt=lease)
+        if claimed:
+            self.next_attempt = lease
+        return bool(claimed)
+
+    def process_chunk(self, chunk_size=100, concurrency=1):
+        """ Apply the operation to the next chunk of objects and save the
+            position. Returns False when the job is done or was canceled.
+        """
+        from .jobs import run_operation
+
+        if not hasattr(self, '_object_ids'):
+            self._object_ids = decode(self.object_ids)
+        pks = self._object_ids[self.position:self.position + chunk_size]
+
+        # Objects deleted since the job was enqueued are skipped
+        model = self.content_type.model_class()
+        instances = list(model.objects.filter(pk__in=pks).order_by('pk'))
+        errors = run_operation(self.operation, instances,
+            decode(self.params), concurrency=concurrency, tenant=self.tenant)
+
+        self.position += len(pks)
+        self.failed += len(errors)
+        if errors:
+            self.last_error = errors[-1]
+        if self.position >= self.total:
+            self.status = BTJob.DONE
+            self.finished = now()
+        else:
+            self.status = BTJob.RUNNING
+        self.next_attempt = now() + timedelta(seconds=self.LEASE)
+
+        # Don't overwrite a cancellation from the admin
+        updated = BTJob.objects.filter(pk=self.pk)\
+            .exclude(status=BTJob.CANCELED).update(
+                status=self.status,
+                position=self.position,
+                failed=self.failed,
+                last_error=self.last_error,
+                next_attempt=self.next_attempt,
+                finished=self.finished,
+            )
+        if not updated:
+            self.status = BTJob.CANCELED
+        return self.status == BTJob.RUNNING
+
+
+def catalogue_changed(sender, **kwargs):
+    from .catalogue import bump_version
+    bump_version()
+
+
+for model in (BTPlan, BTAddOn, BTDiscount):
+    post_save.connect(catalogue_changed, sender=model)
+    post_delete.connect(catalogue_changed, sender=model)
@@ -0,0 +1,66 @@
+""" Local preview of what a plan change with prorate_charges costs.
+
+    Braintree prorates the price difference over the days left in the
+    current billing period, counting today. Upgrades are charged right away,
+    less any credit (negative balance) of the subscription; downgrades are
+    credited to the balance. Previews are computed from the subscription
+    mirror and the plan prices, without calling braintree.
+"""
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.utils.timezone import is_aware, localtime, now
+
+
+ZERO = Decimal('0.00')
+CENT = Decimal('0.01')
+
+
+def as_date(value):
+    """ The local date of value. Vault dates are stored as local midnight,
+        their UTC date is a day earlier east of UTC.
+    """
+    if isinstance(value, datetime):
+        return (localtime(value) if is_aware(value) else value).date()
+    return value
+
+
+def prorate(subscription, plan, today=None):
+    """ Preview the change of subscription to plan as a dict of the
+        prorated amount, the immediate charge and the resulting balance.
+        None if the subscription has no current billing period, e.g. during
+        a trial.
+    """
+    start = as_date(subscription.billing_period_start_date)
+    end = as_date(subscription.billing_period_end_date)
+    today = today or localtime(now()).date()
+    if start is None or end is None or not start <= today <= end:
+        return None
+
+    price = subscription.price or ZERO
+    balance = subscription.balance or ZERO
+    days = (end - start).days + 1
+    remaining = (end - today).days + 1
+
+    amount = ((plan.price or ZERO) - price) * remaining / days
+    amount = amount.quantize(CENT, rounding=ROUND_HALF_UP)
+
+    charge = ZERO
+    if amount > 0:
+        charge = max(amount + min(balance, ZERO), ZERO)
+
+    return {
+        'plan': plan,
+        'amount': amount,
+        'charge': charge,
+        'balance': balance + amount - charge,
+    }
+
+
+def previews(subscription, plans, today=None):
+    """ prorate() of subscription for each of plans, by plan_id """
+    today = today or localtime(now()).date()
+    return dict(
+        (plan.plan_id, prorate(subscription, plan, today)) for plan in plans
+        if plan.pk != subscription.plan_id
+    )
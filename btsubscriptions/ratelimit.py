@@ -0,0 +1,123 @@
+""" Token bucket rate limiting of vault calls, shared through the cache.
+
+    Enabled with BRAINTREE_RATE_LIMIT (calls per second per tenant). All
+    processes using the same cache share one bucket per tenant holding up to
+    BRAINTREE_RATE_LIMIT_BURST tokens. Every call through a model collection
+    takes a token, waiting for the bucket to refill when it is empty.
+
+    Interactive callers (the default) may empty the bucket, background
+    callers leave BRAINTREE_RATE_LIMIT_RESERVE (a fraction of the burst) for
+    them. Background work sets its priority with background() or, for a
+    whole process such as a management command, set_default_priority().
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+# Idle buckets are forgotten and start full again
+BUCKET_TIMEOUT = 3600
+
+_local = threading.local()
+_default_priority = INTERACTIVE
+
+
+def get_priority():
+    return getattr(_local, 'priority', None) or _default_priority
+
+
+def set_default_priority(priority):
+    """ Set the priority of all threads without an explicit priority """
+    global _default_priority
+    _default_priority = priority
+
+
+@contextmanager
+def background():
+    """ Run the vault calls of the block with background priority """
+    previous = getattr(_local, 'priority', None)
+    _local.priority = BACKGROUND
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+def is_enabled():
+    return bool(getattr(settings, 'BRAINTREE_RATE_LIMIT', None))
+
+
+def get_bucket_cache():
+    return get_cache(getattr(settings, 'BRAINTREE_RATE_LIMIT_CACHE', 'default'))
+
+
+@contextmanager
+def cache_lock(cache, key, timeout=1):
+    """ A short lived mutex for the read-modify-write of a bucket """
+    while not cache.add(key, 1, timeout):
+        time.sleep(0.001)
+    try:
+        yield
+    finally:
+        cache.delete(key)
+
+
+def take(tenant, priority=None):
+    """ Take a token from the bucket of tenant. Returns 0 on success or the
+        number of seconds until a token will be available
+    """
+    rate = float(settings.BRAINTREE_RATE_LIMIT)
+    # A bucket must hold at least one token, and background callers need
+    # one above the reserve, or they would wait forever
+    burst = max(getattr(settings, 'BRAINTREE_RATE_LIMIT_BURST', rate), 1)
+    floor = 0
+    if (priority or get_priority()) == BACKGROUND:
+        floor = min(burst - 1, burst * getattr(settings,
+            'BRAINTREE_RATE_LIMIT_RESERVE', 0.2))
+
+    cache = get_bucket_cache()
+    key = 'btsubscriptions:bucket:%s' % tenant
+    with cache_lock(cache, key + ':lock'):
+        current = time.time()
+        tokens, updated = cache.get(key) or (burst, current)
+        tokens = min(burst, tokens + (current - updated) * rate)
+
+        if tokens - 1 < floor:
+            cache.set(key, (tokens, current), BUCKET_TIMEOUT)
+            return (floor + 1 - tokens) / rate
+
+        cache.set(key, (tokens - 1, current), BUCKET_TIMEOUT)
+        return 0
+
+
+def acquire(tenant, priority=None):
+    """ Wait until a vault call of tenant is allowed """
+    while True:
+        wait = take(tenant, priority)
+        if not wait:
+            return
+        time.sleep(wait)
+
+
+class RateLimitedCollection(object):
+    """ Proxy of a gateway collection taking a token before each call """
+
+    def __init__(self, collection, tenant):
+        self.collection = collection
+        self.tenant = tenant
+
+    def __getattr__(self, name):
+        attr = getattr(self.collection, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            acquire(self.tenant)
+            return attr(*args, **kwargs)
+        return call
@@ -0,0 +1,46 @@
+from django.db.models import Q
+from django.utils.timezone import now
+
+from .models import BTScanCursor
+
+
+def scan(name, queryset, handle_batch, batch_size=500, limit=None,
+        changed_field=None, changed=None):
+    """ Walk queryset in primary key order and call handle_batch with lists
+        of up to batch_size objects. Progress is stored in the BTScanCursor
+        called name, so a scan stopped after limit objects (or by an error)
+        continues where it left off. With changed_field, a pass only visits
+        objects changed since the previous pass started; changed is a
+        function of that start returning a Q of further objects to visit.
+        Returns the number of processed objects.
+    """
+    cursor = BTScanCursor.objects.for_name(name)
+    if cursor.started is None:
+        cursor.started = now()
+        cursor.save()
+
+    if changed_field and cursor.completed:
+        since = Q(**{'%s__gte' % changed_field: cursor.completed})
+        if changed is not None:
+            since |= changed(cursor.completed)
+        queryset = queryset.filter(since)
+    queryset = queryset.order_by('pk')
+
+    processed = 0
+    while limit is None or processed < limit:
+        size = batch_size
+        if limit is not None:
+            size = min(batch_size, limit - processed)
+
+        batch = list(queryset.filter(pk__gt=cursor.position)[:size])
+        if not batch:
+            cursor.finish()
+            break
+
+        handle_batch(batch)
+
+        cursor.position = batch[-1].pk
+        cursor.save()
+        processed += len(batch)
+
+    return processed
@@ -0,0 +1,105 @@
+""" Partitioning of background sync work over several workers.
+
+    Every worker holds a BTWorkerLease which it renews while it runs. The
+    live leases form a consistent hash ring; a customer belongs to the
+    worker owning the ring position of its primary key. When a worker joins
+    or its lease expires, only the customers of the neighbouring ring
+    segments change hands, and every worker picks the change up with the
+    next chunk. Workers which see the same set of leases never process the
+    same customer.
+"""
+import bisect
+import os
+import socket
+import zlib
+
+from django.conf import settings
+
+from .models import BTWorkerLease
+
+
+# Ring positions per worker, more even out the shard sizes
+REPLICAS = 100
+
+
+def position(key):
+    if isinstance(key, unicode):
+        # Worker names come from the database as unicode
+        key = key.encode('utf-8')
+    return zlib.crc32(key) & 0xffffffff
+
+
+class HashRing(object):
+    """ Consistent hashing of keys onto workers """
+
+    def __init__(self, workers, replicas=REPLICAS):
+        self.workers = sorted(workers)
+        points = sorted(
+            (position('%s#%d' % (worker, i)), worker)
+            for worker in self.workers for i in range(replicas)
+        )
+        self.positions = [point for point, _ in points]
+        self.owners = [worker for _, worker in points]
+
+    def owner(self, key):
+        """ The worker of key, None if there are no workers """
+        if not self.owners:
+            return None
+        index = bisect.bisect(self.positions, position(unicode(key)))
+        return self.owners[index % len(self.owners)]
+
+
+def default_worker():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+class Shard(object):
+    """ The part of the customers a worker is responsible for. The lease
+        (BRAINTREE_WORKER_LEASE seconds) must outlast processing a chunk.
+    """
+
+    def __init__(self, worker=None, lease=None):
+        self.worker = worker or default_worker()
+        self.lease = lease or getattr(settings, 'BRAINTREE_WORKER_LEASE', 60)
+        self.ring = None
+
+    def refresh(self):
+        """ Renew the lease, drop expired ones and rebuild the ring from the
+            live workers. Returns whether the workers changed.
+        """
+        BTWorkerLease.objects.renew(self.worker, self.lease)
+        BTWorkerLease.objects.expire()
+        workers = sorted(BTWorkerLease.objects.live()
+            .values_list('worker', flat=True))
+        if self.ring is not None and self.ring.workers == workers:
+            return False
+        self.ring = HashRing(workers)
+        return True
+
+    def leave(self):
+        """ Hand the shard over to the other workers """
+        BTWorkerLease.objects.filter(worker=self.worker).delete()
+        self.ring = None
+
+    def owns(self, pk):
+        return self.ring.owner(pk) == self.worker
+
+    def chunks(self, queryset, chunk_size=100):
+        """ Yield lists of the objects of queryset owned by this worker in
+            primary key order, refreshing the ring before each chunk
+        """
+        queryset = queryset.order_by('pk')
+        last_pk = None
+        while True:
+            self.refresh()
+            chunk = queryset
+            if last_pk is not None:
+                chunk = chunk.filter(pk__gt=last_pk)
+            pks = list(chunk.values_list('pk', flat=True)[:chunk_size])
+            if not pks:
+                return
+            last_pk = pks[-1]
+
+            owned = [pk for pk in pks if self.owns(pk)]
+            if owned:
+                yield list(queryset.filter(pk__in=owned))
@@ -0,0 +1,9 @@
+from django.dispatch import Signal
+
+
+# Sent by scan_dunning for each batch of past due subscriptions per stage
+subscription_dunning = Signal(providing_args=['stage', 'subscriptions'])
+
+# Sent by scan_expiring_cards for each batch of default cards which expire
+# before the next charge of their customer's subscription
+cards_expiring = Signal(providing_args=['cards'])
@@ -0,0 +1,207 @@
+""" Snapshots of the local braintree mirror.
+
+    A snapshot is a gzip compressed file of JSON lines: a header with the
+    format version, then one section per model in dependency order. A
+    section starts with {"model": ..., "fields": [...]}, followed by one
+    JSON array per row and {"end": ..., "rows": n}. Rows are read and written
+    in chunks, so neither dump() nor load() holds a whole table in memory.
+
+    The project's customer rows which BTCustomer shares its primary key
+    with are not part of a snapshot, load() refuses snapshots of customers
+    missing in the target database.
+"""
+import gzip
+import json
+from datetime import datetime
+
+from django.core.management.color import no_style
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.utils.timezone import now
+
+from .locking import customer_model
+from .models import BTPlan, BTAddOn, BTDiscount, BTCustomer, BTAddress
+from .models import BTCreditCard, BTSubscription, BTSubscribedAddOn
+from .models import BTSubscribedDiscount, BTSubscriptionHistory, BTTransaction
+
+
+FORMAT = 'btsubscriptions-snapshot'
+VERSION = 1
+
+# Referenced models come first
+MODELS = (
+    BTPlan,
+    BTAddOn,
+    BTDiscount,
+    BTCustomer,
+    BTAddress,
+    BTCreditCard,
+    BTSubscription,
+    BTSubscribedAddOn,
+    BTSubscribedDiscount,
+    BTSubscriptionHistory,
+    BTTransaction,
+)
+
+
+def model_label(model):
+    return model._meta.object_name
+
+
+def columns(model):
+    return [field.attname for field in model._meta.local_fields]
+
+
+def write_line(output, data):
+    output.write(json.dumps(data, cls=DjangoJSONEncoder,
+        separators=(',', ':')))
+    output.write('\n')
+
+
+def dump_value(value):
+    # DjangoJSONEncoder would drop the microseconds
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def dump(path, chunk_size=1000, using=DEFAULT_DB_ALIAS):
+    """ Write a snapshot of all mirrored models to path.
+        Returns the number of rows per model.
+    """
+    counts = {}
+    output = gzip.open(path, 'wb')
+    try:
+        write_line(output, {
+            'format': FORMAT,
+            'version': VERSION,
+            'created': now(),
+            'models': [model_label(model) for model in MODELS],
+        })
+
+        for model in MODELS:
+            label = model_label(model)
+            fields = columns(model)
+            write_line(output, {'model': label, 'fields': fields})
+
+            queryset = model._default_manager.using(using).order_by('pk')
+            pk = model._meta.pk.attname
+            count = 0
+            last_pk = None
+            while True:
+                chunk = queryset
+                if last_pk is not None:
+                    chunk = chunk.filter(pk__gt=last_pk)
+                rows = list(chunk.values_list(*fields)[:chunk_size])
+                if not rows:
+                    break
+
+                for row in rows:
+                    write_line(output, [dump_value(value) for value in row])
+                count += len(rows)
+                last_pk = rows[-1][fields.index(pk)]
+
+            write_line(output, {'end': label, 'rows': count})
+            counts[label] = count
+    finally:
+        output.close()
+    return counts
+
+
+def read_header(lines):
+    header = json.loads(next(lines))
+    if header.get('format') != FORMAT:
+        raise ValueError('Not a btsubscriptions snapshot')
+    if header.get('version') != VERSION:
+        raise ValueError('Unsupported snapshot version %r, expected %d' % (
+            header.get('version'), VERSION))
+    return header
+
+
+def insert(model, objects, using):
+    """ Insert objects in batches the database can handle """
+    connection = connections[using]
+    fields = model._meta.local_concrete_fields
+    batch_size = max(connection.ops.bulk_batch_size(fields, objects), 1)
+    for i in range(0, len(objects), batch_size):
+        # Unlike bulk_create(), raw inserts keep auto_now(_add) timestamps
+        model._base_manager._insert(objects[i:i + batch_size],
+            fields=fields, using=using, raw=True)
+
+
+def clear(using=DEFAULT_DB_ALIAS):
+    """ Delete all mirrored rows, referencing models first """
+    for model in reversed(MODELS):
+        model._default_manager.using(using).all().delete()
+
+
+def load_section(model, names, lines, chunk_size, using):
+    """ Insert the rows of a section, returns the number of rows """
+    fields = dict((field.attname, field) for field in model._meta.local_fields)
+    unknown = set(names) - set(fields)
+    if unknown:
+        raise ValueError('Unknown fields %s of %s' % (
+            ', '.join(sorted(unknown)), model_label(model)))
+
+    count = 0
+    objects = []
+    for line in lines:
+        row = json.loads(line)
+        if isinstance(row, dict):
+            if row['rows'] != count + len(objects):
+                raise ValueError('Incomplete section %s' % row['end'])
+            insert(model, objects, using)
+            return row['rows']
+
+        objects.append(model(**dict(
+            (name, fields[name].to_python(value))
+            for name, value in zip(names, row)
+        )))
+        if len(objects) >= chunk_size:
+            insert(model, objects, using)
+            count += len(objects)
+            objects = []
+
+    raise ValueError('Truncated snapshot in section %s' % model_label(model))
+
+
+def check_customers(using):
+    """ Raise ValueError if a BTCustomer lacks its project customer """
+    customers = customer_model()._default_manager.using(using)
+    missing = list(BTCustomer.objects.using(using)
+        .exclude(pk__in=customers.values('pk'))
+        .values_list('pk', flat=True)[:10])
+    if missing:
+        raise ValueError('Customers %s of the snapshot do not exist, load '
+            'them before the snapshot' % ', '.join(map(str, missing)))
+
+
+def load(path, chunk_size=1000, using=DEFAULT_DB_ALIAS):
+    """ Insert all rows of the snapshot at path in a single transaction.
+        Returns the number of rows per model.
+    """
+    models = dict((model_label(model), model) for model in MODELS)
+    counts = {}
+    snapshot = gzip.open(path, 'rb')
+    try:
+        lines = iter(snapshot)
+        read_header(lines)
+
+        with transaction.atomic(using=using):
+            for line in lines:
+                section = json.loads(line)
+                model = models[section['model']]
+                counts[section['model']] = load_section(model,
+                    section['fields'], lines, chunk_size, using)
+            check_customers(using)
+
+            # Explicit primary keys leave PostgreSQL sequences behind
+            connection = connections[using]
+            statements = connection.ops.sequence_reset_sql(no_style(), MODELS)
+            if statements:
+                cursor = connection.cursor()
+                for statement in statements:
+                    cursor.execute(statement)
+    finally:
+        snapshot.close()
+    return counts
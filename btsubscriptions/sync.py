@@ -1,13 +1,27 @@
 from datetime import date, datetime
+from multiprocessing.pool import ThreadPool
 
-from braintree.exceptions.not_found_error import NotFoundError
-from braintree.exceptions.unexpected_error import UnexpectedError
-
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
 from django.db.models.fields.related import RelatedObject
 from django.core.exceptions import ValidationError
 from django.forms.models import model_to_dict
-from django.utils.timezone import now, utc, make_aware
+from django.utils.timezone import now, utc, make_aware, is_aware
+from django.utils.timezone import get_default_timezone
+
+
+def normalize_datetime(value):
+    """ Turn vault dates and naive (UTC) datetimes into the aware datetime
+        a DateTimeField loads from the database, so they compare equal
+    """
+    if isinstance(value, date) and not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+        if settings.USE_TZ:
+            value = make_aware(value, get_default_timezone())
+    elif isinstance(value, datetime) and settings.USE_TZ \
+            and not is_aware(value):
+        value = make_aware(value, utc)
+    return value
 
 
 class BTSyncedModel(models.Model):
@@ -66,6 +80,9 @@ class BTSyncedModel(models.Model):
 
     def push(self):
         """ Push this instance into the vault """
+        from braintree.exceptions.not_found_error import NotFoundError
+        from braintree.exceptions.unexpected_error import UnexpectedError
+
         key = self.braintree_key()
 
         try:
@@ -76,6 +93,10 @@ class BTSyncedModel(models.Model):
             result = self.collection.create(data)
             self.created = now()
 
+        return self.handle_push_result(result)
+
+    def handle_push_result(self, result):
+        """ Apply the result of a vault update or create to the instance """
         if result.is_success:
             self.on_pushed(result)
             self.updated = now()
@@ -83,6 +104,31 @@ class BTSyncedModel(models.Model):
         else:
             raise ValidationError(result.message)
 
+    def push_or_defer(self):
+        """ Push this instance into the vault. With BRAINTREE_PUSH_MODE set to
+            'outbox', instances which were saved before are not pushed;
+            instead the next save() records a pending push in the same
+            transaction. Returns the push result or None if it was deferred.
+        """
+        outbox = getattr(settings, 'BRAINTREE_PUSH_MODE', '') == 'outbox'
+        if self.created and outbox:
+            # The pending push carries the change, don't defer it again
+            self.updated = now()
+            self._push_deferred = True
+            return None
+        return self.push()
+
+    def save(self, *args, **kwargs):
+        if not getattr(self, '_push_deferred', False):
+            return super(BTSyncedModel, self).save(*args, **kwargs)
+
+        from .models import BTPushOutbox
+
+        with transaction.atomic():
+            super(BTSyncedModel, self).save(*args, **kwargs)
+            BTPushOutbox.objects.schedule(self)
+        self._push_deferred = False
+
     def push_related(self):
         """ Implement this to automatically push related BTSyncedModels """
         pass
@@ -103,6 +149,8 @@ class BTSyncedModel(models.Model):
         for key, value in data.__dict__.iteritems():
             if hasattr(self, key) and key not in self.pull_excluded_fields:
                 field = self._meta.get_field_by_name(key)[0]
+                if isinstance(field, models.DateTimeField):
+                    value = normalize_datetime(value)
                 if not issubclass(field.__class__, RelatedObject):
                     setattr(self, key, value)
         self.updated = now()
@@ -121,6 +169,8 @@ class BTSyncedModel(models.Model):
 
     def delete_from_vault(self):
         """ Remove object from vault """
+        from braintree.exceptions.not_found_error import NotFoundError
+
         if hasattr(self.collection, 'delete'):
             try:
                 self.collection.delete(*self.braintree_key())
@@ -177,6 +227,8 @@ class BTMirroredModel(models.Model):
 
     def get_data_from_vault(self):
         """ Get object data from vault """
+        from braintree.exceptions.not_found_error import NotFoundError
+
         key = self.braintree_key()
         if hasattr(self.collection, 'find'):
             try:
@@ -199,8 +251,80 @@ class BTMirroredModel(models.Model):
 
     def delete_from_vault(self):
         """ Remove object from vault if present """
+        from braintree.exceptions.not_found_error import NotFoundError
+
         if hasattr(self.collection, 'delete'):
             try:
                 self.collection.delete(*self.braintree_key())
             except (NotFoundError, KeyError):
                 pass
+
+
+def push_concurrently(instances, errors=None):
+    """ Push several BTSyncedModels, sending the vault updates concurrently.
+        Serialization and result handling stay in the calling thread, so no
+        database access happens in the worker threads. Instances which are
+        not present in the vault yet are created with a regular push().
+        Returns the pushed instances in their order. Failures are appended
+        to errors as (instance, exception) if a list is passed, otherwise
+        the first one is raised after all results were handled.
+    """
+    from braintree.exceptions.not_found_error import NotFoundError
+    from braintree.exceptions.unexpected_error import UnexpectedError
+
+    from .gateways import activate, deactivate, get_tenant
+
+    instances = list(instances)
+    failures = []
+
+    if len(instances) < 2:
+        results = [None] * len(instances)
+    else:
+        # Resolve the collections here, the tenant is only active in this
+        # thread
+        requests = [
+            (instance.collection, instance.braintree_key(),
+                instance.serialize_update())
+            for instance in instances
+        ]
+        tenant = get_tenant()
+
+        def update(request):
+            collection, key, data = request
+            # Threads don't inherit the active tenant
+            activate(tenant)
+            try:
+                return collection.update(*key, params=data)
+            except (NotFoundError, KeyError, UnexpectedError):
+                return None
+            except Exception as e:
+                return e
+            finally:
+                deactivate()
+
+        workers = getattr(settings, 'BRAINTREE_MAX_CONCURRENT_CALLS', 4)
+        pool = ThreadPool(min(workers, len(requests)))
+        try:
+            results = pool.map(update, requests)
+        finally:
+            pool.close()
+
+    pushed = []
+    for instance, result in zip(instances, results):
+        try:
+            if isinstance(result, Exception):
+                raise result
+            elif result is None:
+                instance.push()
+            else:
+                instance.handle_push_result(result)
+        except Exception as e:
+            failures.append((instance, e))
+        else:
+            pushed.append(instance)
+
+    if errors is not None:
+        errors.extend(failures)
+    elif failures:
+        raise failures[0][1]
+    return pushed
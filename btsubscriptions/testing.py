@@ -0,0 +1,280 @@
+""" Helpers for testing the payment views without talking to braintree.
+
+    ViewBudgetTestCase runs views against a FakeVault and checks the number of
+    SQL queries, vault calls and the wall time of each view against a stored
+    baseline (budgets.json). Set BTSUBSCRIPTIONS_UPDATE_BUDGETS=1 to write the
+    measured values as new baseline.
+"""
+import json
+import os
+import sys
+import time
+
+from braintree.attribute_getter import AttributeGetter
+
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.contrib.sessions.backends.cache import SessionStore
+from django.core.urlresolvers import resolve, reverse
+from django.db import connection
+from django.db.models.query import QuerySet
+from django.http import HttpResponse
+from django.test import TestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from . import views
+from .gateways import DEFAULT_TENANT, register_gateway, unregister_gateway
+
+
+BUDGETS_FILE = os.path.join(os.path.dirname(__file__), 'budgets.json')
+
+
+def resource(**attributes):
+    """ A fake braintree resource """
+    return AttributeGetter(attributes)
+
+
+def success(**attributes):
+    """ A fake successful braintree result """
+    return resource(is_success=True, **attributes)
+
+
+class FakeCollection(object):
+    """ A gateway collection whose methods are recorded by a FakeVault """
+
+    def __init__(self, vault, name):
+        self.vault = vault
+        self.name = name
+
+    def __getattr__(self, attr):
+        return self.vault.recorder('%s.%s' % (self.name, attr))
+
+
+class FakeVault(object):
+    """ Replaces the gateway of a tenant and records all calls """
+
+    collections = (
+        'address',
+        'add_on',
+        'credit_card',
+        'customer',
+        'discount',
+        'plan',
+        'subscription',
+        'transaction',
+        'transparent_redirect',
+        'webhook_notification',
+    )
+
+    # These are computed locally by the braintree library, no HTTP involved
+    local_calls = (
+        'credit_card.tr_data_for_create',
+        'transparent_redirect.url',
+        'webhook_notification.parse',
+        'webhook_notification.verify',
+    )
+
+    def __init__(self, responses=None, tenant=DEFAULT_TENANT):
+        self.calls = []
+        self.tenant = tenant
+        self.responses = self.default_responses()
+        self.responses.update(responses or {})
+        for name in self.collections:
+            setattr(self, name, FakeCollection(self, name))
+
+    def default_responses(self):
+        subscription = lambda sub_id: resource(
+            id=sub_id,
+            status=u'Active',
+            trial_period=False,
+            balance=0,
+            add_ons=[],
+            discounts=[],
+            transactions=[],
+        )
+        return {
+            'credit_card.tr_data_for_create': lambda *args: u'tr_data',
+            'subscription.cancel': lambda sub_id: success(
+                subscription=subscription(sub_id)),
+            'subscription.create': lambda params: success(
+                subscription=subscription(u'new')),
+            'subscription.find': subscription,
+            'subscription.search': lambda *query: resource(items=[]),
+            'subscription.update': lambda sub_id, params={}: success(
+                subscription=subscription(sub_id)),
+            'transparent_redirect.url': lambda: u'https://vault.invalid/',
+            'webhook_notification.verify': lambda challenge: challenge,
+        }
+
+    @property
+    def vault_calls(self):
+        return [c for c in self.calls if c[0] not in self.local_calls]
+
+    def recorder(self, name):
+        def call(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            if name in self.responses:
+                return self.responses[name](*args, **kwargs)
+            return success()
+        return call
+
+    def __enter__(self):
+        self._previous = register_gateway(self.tenant, self)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._previous is None:
+            unregister_gateway(self.tenant)
+        else:
+            register_gateway(self.tenant, self._previous)
+
+
+class FakeCustomer(object):
+    """ Stands in for the customer object provided by request.access """
+
+    def __init__(self, braintree_customer, **attributes):
+        self.braintree = braintree_customer
+        self.id = self.pk = braintree_customer.pk
+        self.first_name = braintree_customer.first_name
+        self.last_name = braintree_customer.last_name
+        self.company = braintree_customer.company
+        self.modified = braintree_customer.updated
+        for key, value in attributes.items():
+            setattr(self, key, value)
+
+
+class FakeAccess(object):
+    def __init__(self, customer):
+        self.customer = customer
+
+
+def fake_render(request, template_name, context=None, *args, **kwargs):
+    """ Evaluate the context like a template would, but skip rendering """
+    for value in (context or {}).values():
+        if isinstance(value, (QuerySet, list)):
+            list(value)
+    return HttpResponse(template_name)
+
+
+class ViewBudgetTestCase(TestCase):
+    """ Measure views against the budgets stored in budgets_file """
+
+    budgets_file = BUDGETS_FILE
+
+    # Factor the measured wall time may exceed the stored time, but never
+    # fail a view for taking less than minimum_time milliseconds
+    time_tolerance = 2.0
+    minimum_time = 50
+
+    # Set to True to measure the real templates of the project
+    render_templates = False
+
+    @classmethod
+    def setUpClass(cls):
+        super(ViewBudgetTestCase, cls).setUpClass()
+        cls.measurements = {}
+        try:
+            with open(cls.budgets_file) as budgets:
+                cls.budgets = json.load(budgets)
+        except IOError:
+            cls.budgets = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        sys.stderr.write(cls.comparison_table())
+        if os.environ.get('BTSUBSCRIPTIONS_UPDATE_BUDGETS'):
+            budgets = dict(cls.budgets, **cls.measurements)
+            with open(cls.budgets_file, 'w') as f:
+                json.dump(budgets, f, indent=4, sort_keys=True,
+                    separators=(',', ': '))
+                f.write('\n')
+        super(ViewBudgetTestCase, cls).tearDownClass()
+
+    @classmethod
+    def comparison_table(cls):
+        row = u'%-34s %12s %12s %12s  %s\n'
+        lines = [u'\n', row % ('view', 'queries', 'vault calls', 'time (ms)',
+            'baseline')]
+        for name in sorted(cls.measurements):
+            measured = cls.measurements[name]
+            budget = cls.budgets.get(name)
+            if budget is None:
+                baseline = u'missing'
+            else:
+                status = u'ok'
+                if cls.exceeds_budget(measured, budget):
+                    status = u'REGRESSION'
+                baseline = u'%s (%s / %s / %s)' % (status, budget['queries'],
+                    budget['vault_calls'], budget['time'])
+            lines.append(row % (name, measured['queries'],
+                measured['vault_calls'], measured['time'], baseline))
+        return u''.join(lines)
+
+    @classmethod
+    def time_budget(cls, budget):
+        return max(budget['time'] * cls.time_tolerance, cls.minimum_time)
+
+    @classmethod
+    def exceeds_budget(cls, measured, budget):
+        return (measured['queries'] > budget['queries']
+            or measured['vault_calls'] > budget['vault_calls']
+            or measured['time'] > cls.time_budget(budget))
+
+    def request(self, name, args=(), data=None, method='get', customer=None,
+            user=None):
+        path = reverse(name, args=args)
+        request = getattr(RequestFactory(), method)(path, data or {})
+        request.user = user or AnonymousUser()
+        request.session = SessionStore()
+        request._messages = FallbackStorage(request)
+        if customer is not None:
+            request.access = FakeAccess(customer)
+        return request
+
+    def measure(self, name, request, vault=None):
+        """ Run the view for request and return the response """
+        vault = vault or FakeVault()
+        match = resolve(request.path)
+
+        original_render = views.render
+        if not self.render_templates:
+            views.render = fake_render
+
+        try:
+            with vault, CaptureQueriesContext(connection) as queries:
+                start = time.time()
+                response = match.func(request, *match.args, **match.kwargs)
+                if response.streaming:
+                    # Streamed content is generated after the view returned
+                    response.streaming_content = list(
+                        response.streaming_content)
+                elapsed = time.time() - start
+        finally:
+            views.render = original_render
+
+        self.measurements[name] = {
+            'queries': len(queries),
+            'vault_calls': len(vault.vault_calls),
+            'time': int(round(elapsed * 1000)),
+        }
+        return response
+
+    def assertWithinBudget(self, name):
+        """ Compare the last measurement of name against its budget """
+        measured = self.measurements[name]
+
+        if os.environ.get('BTSUBSCRIPTIONS_UPDATE_BUDGETS'):
+            return
+
+        budget = self.budgets.get(name)
+        self.assertTrue(budget, u'No budget stored for %s' % name)
+
+        self.assertLessEqual(measured['queries'], budget['queries'],
+            u'%s: %d queries, budget is %d' % (
+                name, measured['queries'], budget['queries']))
+        self.assertLessEqual(measured['vault_calls'], budget['vault_calls'],
+            u'%s: %d vault calls, budget is %d' % (
+                name, measured['vault_calls'], budget['vault_calls']))
+        self.assertLessEqual(measured['time'], self.time_budget(budget),
+            u'%s: took %d ms, budget is %d ms' % (
+                name, measured['time'], self.time_budget(budget)))
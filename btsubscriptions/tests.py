@@ -0,0 +1,1519 @@
+import gzip
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+from StringIO import StringIO
+from decimal import Decimal
+
+from django.contrib import messages
+from django.contrib.admin.sites import AdminSite
+from django.contrib.auth.models import User
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.contrib.sessions.backends.cache import SessionStore
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.urlresolvers import resolve
+from django.db import connection
+from django.http import HttpResponse
+from django.test import TestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils.timezone import get_default_timezone, make_aware, now
+from django.utils.timezone import utc
+from django.utils.unittest import skipUnless
+
+from . import analytics, forecast, gateways, locking, ratelimit, snapshots
+from . import urls
+from . import models, views, webhooks
+from .admin import BTSubscriptionAdmin, EstimatedCountQuerySet
+from .catalogue import bump_version
+from .encoding import decode
+from .models import BTCustomer, BTAddress, BTCreditCard, BTPlan, BTAddOn
+from .models import BTDiscount, BTSubscription, BTSubscribedAddOn
+from .models import BTScanCursor, BTSubscriptionHistory, BTTransaction
+from .models import BTPushOutbox, BTSubscribedDiscount, BTWebhookLog
+from .models import BTJob, BTWorkerLease
+from .proration import prorate, previews
+from .sharding import HashRing, Shard, position
+from .signals import cards_expiring, subscription_dunning
+from .snapshots import MODELS, columns, model_label
+from .sync import push_concurrently
+from .testing import ViewBudgetTestCase, FakeAccess, FakeVault, FakeCustomer
+from .testing import resource, success
+from .utils import sync_customer
+
+
+def not_found(*args, **kwargs):
+    raise KeyError(args)
+
+
+@skipUnless(connection.vendor == 'sqlite', 'Query plans are SQLite specific')
+class QueryPlanTest(TestCase):
+    """ Make sure the hot billing lookups are served by an index """
+
+    def explain(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return u' '.join(row[-1] for row in cursor.fetchall())
+
+    def test_running_subscriptions(self):
+        plan = self.explain(BTSubscription.objects.running().filter(customer=1))
+        self.assertIn('(customer_id=? AND status=?)', plan)
+
+    def test_default_credit_card(self):
+        plan = self.explain(
+            BTCreditCard.objects.filter(customer=1, default=True))
+        self.assertIn('(customer_id=? AND default=?)', plan)
+
+    def test_subscription_transactions(self):
+        plan = self.explain(BTTransaction.objects.filter(subscription=1))
+        self.assertIn('(subscription_id=?)', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_customer_transactions(self):
+        # Only the transactions of the customer's subscriptions are sorted
+        plan = self.explain(BTTransaction.objects.for_customer(1))
+        self.assertIn('(customer_id=?)', plan)
+        self.assertIn('(subscription_id=?)', plan)
+        self.assertNotIn('SCAN', plan)
+
+    def test_webhook_logs_by_kind(self):
+        BTWebhookLog.objects.create(kind='subscription_went_active')
+        BTWebhookLog.objects.create(kind='subscription_canceled')
+
+        plan = self.explain(BTWebhookLog.objects.filter(
+            kind='subscription_canceled').order_by('received'))
+        self.assertIn('(kind=?)', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_subscription_history_as_of(self):
+        plan = self.explain(BTSubscriptionHistory.objects.filter(
+            subscription=1, recorded__lte=now()).order_by('recorded', 'pk'))
+        self.assertIn('(subscription_id=? AND recorded<?)', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_transaction_export_chunks(self):
+        start = now() - timedelta(days=30)
+        plan = self.explain(BTTransaction.objects.filter(
+            created_at__gte=start, created_at__lt=now()
+        ).order_by('created_at', 'pk'))
+        self.assertIn('(created_at>? AND created_at<?)', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_expiring_cards(self):
+        plan = self.explain(
+            BTCreditCard.objects.filter(expires_on__lt=now().date()))
+        self.assertIn('(expires_on<?)', plan)
+
+
+def vault_subscription(**attributes):
+    """ Subscription data as parsed by braintree, with date fields """
+    data = dict(
+        id=u'sub1',
+        status=u'Active',
+        plan_id=u'plan1',
+        price=Decimal('10.00'),
+        balance=Decimal('0.00'),
+        trial_period=False,
+        billing_period_start_date=date(2014, 6, 1),
+        billing_period_end_date=date(2014, 6, 30),
+        paid_through_date=date(2014, 6, 30),
+        next_billing_date=date(2014, 7, 1),
+        first_billing_date=date(2014, 5, 1),
+        current_billing_cycle=2,
+        add_ons=[],
+        discounts=[],
+        transactions=[],
+    )
+    data.update(attributes)
+    return resource(**data)
+
+
+class SubscriptionHistoryTest(TestCase):
+
+    def setUp(self):
+        self.customer = BTCustomer(id_id=1)
+        self.customer.save()
+        self.plan = BTPlan.objects.create(plan_id=u'plan1')
+
+    def test_unchanged_dates_are_not_recorded(self):
+        subscription = BTSubscription(subscription_id=u'sub1',
+            customer=self.customer, plan=self.plan)
+        subscription.import_data(vault_subscription(), source='webhook')
+        subscription.save()
+
+        subscription = BTSubscription.objects.get(pk=subscription.pk)
+        subscription.import_data(vault_subscription(), source='webhook')
+        self.assertEqual({}, subscription.history_changes())
+        subscription.save()
+        self.assertEqual(1, subscription.history.count())
+
+        subscription.import_data(vault_subscription(
+            next_billing_date=date(2014, 8, 1)), source='webhook')
+        self.assertEqual(['next_billing_date'],
+            subscription.history_changes().keys())
+
+
+def charged(subscription_id, *transaction_ids, **attributes):
+    """ A parsed subscription_charged_successfully notification """
+    transactions = [
+        resource(id=transaction_id, amount=Decimal('10.00'),
+            credit_card={'bin': u'411111', 'last_4': u'1111'})
+        for transaction_id in transaction_ids
+    ]
+    attributes.setdefault('payment_method_token', u'card1')
+    return resource(kind=u'subscription_charged_successfully',
+        subscription=vault_subscription(id=subscription_id,
+            transactions=transactions, **attributes))
+
+
+class ModifierTest(TestCase):
+
+    def setUp(self):
+        customer = BTCustomer(id_id=1)
+        customer.save()
+        self.subscription = BTSubscription.objects.create(
+            subscription_id=u'sub1', customer=customer,
+            plan=BTPlan.objects.create(plan_id=u'plan1'), trial_period=False)
+        for i in (1, 2, 3):
+            BTSubscribedAddOn.objects.create(subscription=self.subscription,
+                add_on=BTAddOn.objects.create(addon_id=u'addon%d' % i),
+                quantity=i)
+        BTSubscribedDiscount.objects.create(subscription=self.subscription,
+            discount=BTDiscount.objects.create(discount_id=u'discount1'))
+
+    def vault(self, add_ons=(), discounts=()):
+        return resource(
+            add_ons=[resource(id=id, quantity=quantity)
+                for id, quantity in add_ons],
+            discounts=[resource(id=id, quantity=quantity)
+                for id, quantity in discounts],
+        )
+
+    def test_unchanged(self):
+        data = self.vault(
+            add_ons=[(u'addon1', 1), (u'addon2', 2), (u'addon3', 3)],
+            discounts=[(u'discount1', 1)])
+        self.assertIsNone(self.subscription.modifier_changes(data))
+
+    def test_changes(self):
+        data = self.vault(
+            add_ons=[(u'addon1', 1), (u'addon2', 5), (u'addon9', 1)],
+            discounts=[(u'discount2', 1)])
+        self.assertEqual({
+            'add_ons': {
+                'add': [{'inherited_from_id': u'addon3', 'quantity': 3}],
+                'update': [{'existing_id': u'addon2', 'quantity': 2}],
+                'remove': [u'addon9'],
+            },
+            'discounts': {
+                'add': [{'inherited_from_id': u'discount1', 'quantity': 1}],
+                'remove': [u'discount2'],
+            },
+        }, self.subscription.modifier_changes(data))
+
+    def test_missing_in_vault(self):
+        from braintree.exceptions.not_found_error import NotFoundError
+
+        def find(subscription_id):
+            raise NotFoundError()
+
+        class ChangedFormset(object):
+            def has_changed(self):
+                return True
+
+        class Form(object):
+            instance = self.subscription
+
+            def save_m2m(self):
+                pass
+
+        subscription_admin = BTSubscriptionAdmin(BTSubscription, AdminSite())
+        subscription_admin.save_formset = lambda *args, **kwargs: None
+        request = RequestFactory().post('/')
+        request.session = SessionStore()
+        request._messages = FallbackStorage(request)
+        with FakeVault({'subscription.find': find}) as vault:
+            subscription_admin.save_related(request, Form(),
+                [ChangedFormset()], change=True)
+
+        self.assertEqual([u'subscription.find'],
+            [name for name, args, kwargs in vault.calls])
+        self.assertEqual([messages.ERROR],
+            [message.level for message in request._messages])
+
+
+class WebhookLogTest(TestCase):
+
+    def tearDown(self):
+        models.random = random
+
+    def log(self, days, payload=None, **fields):
+        log = BTWebhookLog(kind=u'subscription_went_active', **fields)
+        if payload is not None:
+            log.set_data(payload)
+        log.save()
+        BTWebhookLog.objects.filter(pk=log.pk).update(
+            received=now() - timedelta(days=days))
+        return log
+
+    def test_payload(self):
+        data = {u'id': u'sub1', u'price': u'10.00'}
+        for compress in (False, True):
+            with self.settings(BRAINTREE_WEBHOOK_LOG_COMPRESS=compress):
+                log = self.log(0, data)
+            log = BTWebhookLog.objects.get(pk=log.pk)
+            self.assertEqual(compress, log.compressed)
+            self.assertEqual(data, log.get_data())
+
+        # Rows written before payloads were encoded keep their text
+        self.assertEqual(u'<Subscription sub1>',
+            self.log(0, data=u'<Subscription sub1>').get_data())
+
+    def test_sampling(self):
+        class Random(object):
+            value = 0.4
+
+            def random(self):
+                return self.value
+
+        models.random = Random()
+        with self.settings(BRAINTREE_WEBHOOK_LOG_SAMPLE_RATE=0.5):
+            self.assertTrue(BTWebhookLog.is_sampled())
+            models.random.value = 0.6
+            self.assertFalse(BTWebhookLog.is_sampled())
+        with self.settings(BRAINTREE_WEBHOOK_LOG_SAMPLE_RATE=1.0):
+            self.assertTrue(BTWebhookLog.is_sampled())
+
+        # Failures are logged regardless of sampling
+        with self.settings(BRAINTREE_WEBHOOK_LOG_SAMPLE_RATE=0.0):
+            webhooks.log_notifications([
+                (charged(u'sub1'), u'signature', u'payload'),
+                (charged(u'sub2'), u'signature', u'payload'),
+            ], [None, u'Plan not present'])
+        self.assertEqual([u'sub2'], list(BTWebhookLog.objects
+            .values_list('subscription_id', flat=True)))
+
+    def test_unencodable_data_does_not_hide_errors(self):
+        class Unencodable(object):
+            __slots__ = ('id',)
+
+        subscription = Unencodable()
+        subscription.id = u'sub1'
+        notification = resource(kind=u'subscription_went_active',
+            subscription=subscription)
+        with self.assertRaises(AttributeError):
+            webhooks.handle_notifications(
+                [(notification, u'signature', u'payload')])
+
+        log = BTWebhookLog.objects.get()
+        self.assertIn('AttributeError', log.exception)
+        self.assertIn('TypeError', log.exception)
+
+    def test_check(self):
+        notification = resource(kind=u'check')
+        self.assertEqual([None], webhooks.handle_notifications(
+            [(notification, u'signature', u'payload')]))
+
+        log = BTWebhookLog.objects.get()
+        self.assertEqual((u'check', u'', u''),
+            (log.kind, log.subscription_id, log.exception))
+        self.assertEqual(u'payload', log.bt_payload)
+
+    def prune(self, **options):
+        call_command('prune_webhook_logs', stdout=StringIO(), **options)
+        return sorted(BTWebhookLog.objects.values_list('pk', flat=True))
+
+    def test_prune(self):
+        recent = self.log(10, {u'id': u'sub1'})
+        old = self.log(100, {u'id': u'sub2'})
+        failed = self.log(100, {u'id': u'sub3'}, exception=u'Plan not present')
+
+        self.assertEqual(sorted([recent.pk, failed.pk]),
+            self.prune(days=90, keep_exceptions=True, batch_size=1))
+        self.assertFalse(BTWebhookLog.objects.filter(pk=old.pk).exists())
+
+        handle, path = tempfile.mkstemp(suffix='.jsonl.gz')
+        os.close(handle)
+        try:
+            self.assertEqual([recent.pk], self.prune(days=90, archive=path))
+            archive = gzip.open(path)
+            try:
+                archived = [decode(line) for line in archive]
+            finally:
+                archive.close()
+        finally:
+            os.remove(path)
+        self.assertEqual([{u'id': u'sub3'}],
+            [entry['data'] for entry in archived])
+        self.assertEqual(u'Plan not present', archived[0]['exception'])
+
+        self.assertEqual([recent.pk], self.prune(days=5, compact=True))
+        recent = BTWebhookLog.objects.get()
+        self.assertTrue(recent.compressed)
+        self.assertEqual({u'id': u'sub1'}, recent.get_data())
+
+
+class WebhookBatchTest(TestCase):
+
+    def setUp(self):
+        customer = BTCustomer(id_id=1)
+        customer.save()
+        BTCreditCard.objects.create(token=u'card1', customer=customer)
+        BTPlan.objects.create(plan_id=u'plan1')
+
+    def handle(self, *notifications):
+        return webhooks.handle_notifications([
+            (notification, u'signature', u'payload')
+            for notification in notifications
+        ])
+
+    def test_batch(self):
+        with CaptureQueriesContext(connection) as queries:
+            results = self.handle(
+                charged(u'sub1', u'trans1'),
+                charged(u'sub2', u'trans2', u'trans3'),
+                charged(u'sub3', payment_method_token=u'missing'),
+                charged(u'sub1', u'trans1', u'trans4'),
+            )
+
+        self.assertEqual([u'sub1', u'sub2', u'sub1'], [
+            result.subscription_id for result in results
+            if not isinstance(result, Exception)])
+        self.assertIsInstance(results[2], BTCreditCard.DoesNotExist)
+        self.assertEqual([u'trans1', u'trans2', u'trans3', u'trans4'],
+            list(BTTransaction.objects.order_by('transaction_id')
+                .values_list('transaction_id', flat=True)))
+
+        # New transactions and the log rows are inserted at once
+        for table in ('bttransaction', 'btwebhooklog'):
+            insert = 'INSERT INTO "btsubscriptions_%s"' % table
+            self.assertEqual(1, len([query for query in
+                queries.captured_queries if insert in query['sql']]))
+        self.assertEqual([u'', u'', u'Credit Card not present', u''],
+            list(BTWebhookLog.objects.order_by('pk')
+                .values_list('exception', flat=True)))
+
+    def test_concurrently_created_transactions(self):
+        self.handle(charged(u'sub1'))
+        subscription = BTSubscription.objects.get()
+        BTTransaction.objects.create(transaction_id=u'trans1',
+            subscription=subscription, amount=Decimal('1.00'))
+
+        def racing_filter(*args, **kwargs):
+            # Another process creates trans1 right after this lookup
+            del BTTransaction.objects.filter
+            return BTTransaction.objects.none()
+
+        BTTransaction.objects.filter = racing_filter
+        try:
+            self.handle(charged(u'sub1', u'trans1', u'trans2'))
+        finally:
+            BTTransaction.objects.__dict__.pop('filter', None)
+
+        self.assertEqual([(u'trans1', Decimal('10.00')),
+            (u'trans2', Decimal('10.00'))],
+            list(BTTransaction.objects.order_by('transaction_id')
+                .values_list('transaction_id', 'amount')))
+
+    def test_failed_batch_is_rolled_back_and_logged(self):
+        def broken(charges):
+            raise RuntimeError('database gone')
+
+        import_transactions = webhooks.import_transactions
+        webhooks.import_transactions = broken
+        try:
+            with self.assertRaises(RuntimeError):
+                self.handle(charged(u'sub1', u'trans1'),
+                    charged(u'sub2', u'trans2'))
+        finally:
+            webhooks.import_transactions = import_transactions
+
+        self.assertFalse(BTSubscription.objects.exists())
+        logs = BTWebhookLog.objects.order_by('pk')
+        self.assertEqual([u'sub1', u'sub2'],
+            [log.subscription_id for log in logs])
+        for log in logs:
+            self.assertIn('RuntimeError: database gone', log.exception)
+
+
+class ReplayTest(TestCase):
+
+    def setUp(self):
+        customer = BTCustomer(id_id=1)
+        customer.save()
+        BTCreditCard.objects.create(token=u'card1', customer=customer)
+        BTPlan.objects.create(plan_id=u'plan1')
+
+        self.notifications = {
+            u'payload1': charged(u'sub1', u'trans1'),
+            u'payload2': charged(u'sub1', u'trans2', balance=Decimal('5.00')),
+        }
+        for payload in sorted(self.notifications):
+            webhooks.handle_notifications(
+                [(self.notifications[payload], u'signature', payload)])
+
+        # A handler bug lost the second charge
+        BTTransaction.objects.filter(transaction_id=u'trans2').delete()
+        BTSubscription.objects.update(balance=Decimal('0.00'))
+
+        self.vault = FakeVault({
+            'webhook_notification.parse':
+                lambda signature, payload: self.notifications[payload],
+        })
+
+    def tearDown(self):
+        # The command made the process a background worker
+        ratelimit.set_default_priority(ratelimit.INTERACTIVE)
+
+    def test_replay(self):
+        with self.vault:
+            totals = webhooks.replay(dry_run=True)
+        self.assertEqual(2, totals['notifications'])
+        self.assertEqual(1, totals['changed'])
+        self.assertEqual(Decimal('0.00'), BTSubscription.objects.get().balance)
+
+        changes = []
+        with self.vault:
+            webhooks.replay(threads=1, report=lambda subscription_id,
+                notifications, diff, error: changes.append(diff))
+        self.assertEqual([{
+            'balance': (Decimal('0.00'), Decimal('5.00')),
+            'transactions': ([u'trans1'], [u'trans1', u'trans2']),
+        }], changes)
+        self.assertEqual(Decimal('5.00'), BTSubscription.objects.get().balance)
+
+    def test_warns_about_sampling(self):
+        stderr = StringIO()
+        with self.settings(BRAINTREE_WEBHOOK_LOG_SAMPLE_RATE=0.5), self.vault:
+            call_command('replay_webhooks', dry_run=True, stdout=StringIO(),
+                stderr=stderr)
+        self.assertIn('BRAINTREE_WEBHOOK_LOG_SAMPLE_RATE', stderr.getvalue())
+
+
+class AnalyticsTest(TestCase):
+
+    def setUp(self):
+        customers = [BTCustomer(id_id=i) for i in (1, 2)]
+        for customer in customers:
+            customer.save()
+        monthly = BTPlan.objects.create(plan_id=u'monthly', price=10,
+            currency_iso_code=u'USD', billing_frequency=1)
+        quarterly = BTPlan.objects.create(plan_id=u'quarterly', price=30,
+            currency_iso_code=u'USD', billing_frequency=3)
+
+        def subscribe(subscription_id, customer, plan, **fields):
+            return BTSubscription.objects.create(
+                subscription_id=subscription_id, customer=customer,
+                plan=plan, price=plan.price, trial_period=False, **fields)
+
+        # The add-on of sub1 is part of its next billing period amount
+        subscribe(u'sub1', customers[0], monthly, status=BTSubscription.ACTIVE,
+            next_billing_period_amount=Decimal('12.00'))
+        subscribe(u'sub2', customers[0], quarterly,
+            status=BTSubscription.ACTIVE)
+        subscribe(u'sub3', customers[1], monthly,
+            status=BTSubscription.PAST_DUE)
+        BTSubscription.objects.update(created=now() - timedelta(days=90))
+
+        # sub4 was canceled before, sub5 within the last 30 days. Both were
+        # touched locally since.
+        for subscription_id, days in ((u'sub4', 60), (u'sub5', 10)):
+            subscription = subscribe(subscription_id, customers[1], monthly,
+                status=BTSubscription.ACTIVE)
+            subscription.status = BTSubscription.CANCELED
+            subscription.save()
+            subscription.history.update(
+                recorded=now() - timedelta(days=days))
+        BTSubscription.objects.update(updated=now())
+
+    def test_report(self):
+        report = analytics.report(days=30)
+        self.assertEqual({u'USD': Decimal('32.00')}, report['mrr'])
+        self.assertEqual({u'USD': Decimal('16.00')}, report['arpu'])
+        self.assertEqual(Decimal('10.00'), report['plans'][u'quarterly']['mrr'])
+        self.assertEqual(0.25, report['churn'])
+
+    def test_churn_uses_history(self):
+        end = now()
+        self.assertEqual(0.0, analytics.churn(end - timedelta(days=5), end))
+        self.assertEqual(0.4, analytics.churn(end - timedelta(days=70), end))
+
+
+class DunningTest(TestCase):
+
+    def setUp(self):
+        customer = BTCustomer(id_id=1)
+        customer.save()
+        plan = BTPlan.objects.create(plan_id=u'plan1')
+        self.subscriptions = [
+            BTSubscription.objects.create(subscription_id=u'sub%d' % i,
+                customer=customer, plan=plan, trial_period=False,
+                status=BTSubscription.PAST_DUE, days_past_due=1,
+                paid_through_date=now() - timedelta(days=2))
+            for i in range(2)
+        ]
+        self.signals = []
+        subscription_dunning.connect(self.receive)
+
+    def tearDown(self):
+        subscription_dunning.disconnect(self.receive)
+        # The command made the process a background worker
+        ratelimit.set_default_priority(ratelimit.INTERACTIVE)
+
+    def receive(self, sender, stage, subscriptions, **kwargs):
+        self.signals.append((stage, [s.subscription_id for s in subscriptions]))
+
+    def scan(self, **options):
+        self.signals = []
+        call_command('scan_dunning', stdout=StringIO(), **options)
+        return self.signals
+
+    def test_stages_escalate_without_webhooks(self):
+        self.assertEqual([('reminder', [u'sub0', u'sub1'])], self.scan())
+        self.assertEqual([], self.scan())
+
+        # Six days later, without any webhook updating the subscriptions.
+        # sub0 reached the warning stage meanwhile, sub1 was already there.
+        BTScanCursor.objects.filter(name='dunning').update(
+            completed=now() - timedelta(days=6))
+        BTSubscription.objects.filter(subscription_id=u'sub0').update(
+            paid_through_date=now() - timedelta(days=9))
+        BTSubscription.objects.filter(subscription_id=u'sub1').update(
+            paid_through_date=now() - timedelta(days=15))
+        self.assertEqual([('warning', [u'sub0'])], self.scan())
+
+    def test_resume_from_cursor(self):
+        self.assertEqual([('reminder', [u'sub0'])], self.scan(limit=1))
+        self.assertEqual([('reminder', [u'sub1'])], self.scan(limit=1))
+        self.assertEqual([], self.scan(limit=1))
+
+
+@override_settings(BRAINTREE_PUSH_MODE='outbox')
+class PushOutboxTest(TestCase):
+
+    def setUp(self):
+        customer = BTCustomer(id_id=1)
+        customer.save()
+        self.address = BTAddress.objects.create(code=u'a1',
+            customer=customer, street_address=u'Main Street 1')
+
+    def tearDown(self):
+        # The command made the process a background worker
+        ratelimit.set_default_priority(ratelimit.INTERACTIVE)
+
+    def change(self, **fields):
+        for key, value in fields.items():
+            setattr(self.address, key, value)
+        self.assertIsNone(self.address.push_or_defer())
+        self.address.save()
+
+    def push(self, vault=None):
+        with vault or FakeVault():
+            call_command('push_outbox', stdout=StringIO())
+
+    def test_coalesce(self):
+        self.change(street_address=u'Main Street 2')
+        entry = BTPushOutbox.objects.get()
+        self.assertIsNotNone(BTAddress.objects.get().updated)
+
+        # A failed push backs off, later changes don't reset that
+        BTPushOutbox.objects.update(attempts=2,
+            next_attempt=now() + timedelta(minutes=4))
+        self.change(locality=u'Springfield')
+        coalesced = BTPushOutbox.objects.get()
+        self.assertEqual(entry.pk, coalesced.pk)
+        self.assertEqual(2, coalesced.attempts)
+        self.assertGreater(coalesced.next_attempt, now())
+        self.assertGreater(coalesced.scheduled, entry.scheduled)
+
+    def test_claim(self):
+        self.change(street_address=u'Main Street 2')
+        entry = BTPushOutbox.objects.get()
+        stale = BTPushOutbox.objects.get()
+        self.assertTrue(entry.claim())
+        self.assertFalse(stale.claim())
+        self.assertEqual([], list(BTPushOutbox.objects.due(5)))
+
+    def test_backoff(self):
+        self.change(street_address=u'Main Street 2')
+
+        def fail(*args, **kwargs):
+            raise ValueError('vault down')
+        vault = FakeVault({'address.update': fail})
+        self.push(vault)
+        entry = BTPushOutbox.objects.get()
+        self.assertEqual(1, entry.attempts)
+        self.assertEqual(u'vault down', entry.last_error)
+        self.assertGreater(entry.next_attempt,
+            now() + timedelta(seconds=110))
+
+        # Not retried before the backoff expired
+        self.push(vault)
+        self.assertEqual(1, len(vault.vault_calls))
+
+        BTPushOutbox.objects.update(next_attempt=now())
+        vault = FakeVault({'address.update': lambda *args, **kwargs: success(
+            address=resource(id=u'a1'))})
+        self.push(vault)
+        self.assertEqual([u'address.update'],
+            [name for name, args, kwargs in vault.vault_calls])
+        self.assertFalse(BTPushOutbox.objects.exists())
+
+    def test_tenant(self):
+        gateways.activate(u'acme')
+        try:
+            self.change(street_address=u'Main Street 2')
+        finally:
+            gateways.deactivate()
+        self.assertEqual(u'acme', BTPushOutbox.objects.get().tenant)
+
+        pushed = lambda *args, **kwargs: success(address=resource(id=u'a1'))
+        default = FakeVault({'address.update': pushed})
+        acme = FakeVault({'address.update': pushed}, tenant=u'acme')
+        with default:
+            self.push(acme)
+        self.assertEqual([], default.vault_calls)
+        self.assertEqual([u'address.update'],
+            [name for name, args, kwargs in acme.vault_calls])
+        self.assertEqual(u'default', gateways.get_tenant())
+
+
+class SnapshotTest(TestCase):
+
+    def setUp(self):
+        locking.customer_model()._default_manager.create(pk=1)
+        customer = BTCustomer(id_id=1, first_name=u'Jane')
+        customer.save()
+        BTAddress.objects.create(code=u'a1', customer=customer)
+        plan = BTPlan.objects.create(plan_id=u'plan1', price=Decimal('9.99'))
+        subscription = BTSubscription.objects.create(
+            subscription_id=u'sub1', customer=customer, plan=plan,
+            status=BTSubscription.ACTIVE, trial_period=False)
+        BTTransaction.objects.create(transaction_id=u'trans1',
+            subscription=subscription, created_at=now())
+
+        handle, self.path = tempfile.mkstemp(suffix='.jsonl.gz')
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def state(self):
+        return dict((model_label(model), list(model.objects.order_by('pk')
+            .values_list(*columns(model)))) for model in MODELS)
+
+    def test_round_trip(self):
+        state = self.state()
+        counts = snapshots.dump(self.path, chunk_size=1)
+        self.assertEqual(1, counts['BTSubscriptionHistory'])
+
+        snapshots.clear()
+        self.assertFalse(BTSubscription.objects.exists())
+        self.assertEqual(counts, snapshots.load(self.path, chunk_size=1))
+        self.assertEqual(state, self.state())
+
+    def test_missing_customers(self):
+        snapshots.dump(self.path)
+        snapshots.clear()
+        locking.customer_model()._default_manager.all().delete()
+
+        with self.assertRaises(ValueError):
+            snapshots.load(self.path)
+        self.assertFalse(BTPlan.objects.exists())
+
+
+class ForecastTest(TestCase):
+
+    def setUp(self):
+        customer = BTCustomer(id_id=1)
+        customer.save()
+        plan = BTPlan.objects.create(plan_id=u'plan1', price=Decimal('7.00'),
+            billing_frequency=1, currency_iso_code=u'USD')
+
+        # Two charges left, the first including the balance
+        self.limited = BTSubscription.objects.create(subscription_id=u'sub1',
+            customer=customer, plan=plan, status=BTSubscription.ACTIVE,
+            trial_period=False, price=Decimal('10.00'),
+            number_of_billing_cycles=3, current_billing_cycle=1,
+            next_billing_period_amount=Decimal('20.00'),
+            balance=Decimal('5.00'), billing_day_of_month=31,
+            next_billing_date=datetime(2014, 1, 31, 12, tzinfo=utc))
+        add_on = BTAddOn.objects.create(addon_id=u'addon1',
+            amount=Decimal('2.00'))
+        BTSubscribedAddOn.objects.create(subscription=self.limited,
+            add_on=add_on, quantity=2)
+        discount = BTDiscount.objects.create(discount_id=u'discount1',
+            amount=Decimal('1.00'))
+        BTSubscribedDiscount.objects.create(subscription=self.limited,
+            discount=discount)
+
+        # Endless, charged the plan price
+        BTSubscription.objects.create(subscription_id=u'sub2',
+            customer=customer, plan=plan, status=BTSubscription.ACTIVE,
+            trial_period=False, billing_day_of_month=15,
+            next_billing_date=datetime(2014, 1, 15, 12, tzinfo=utc))
+
+    def test_add_months(self):
+        self.assertEqual(date(2014, 2, 28),
+            forecast.add_months(date(2014, 1, 31), 1))
+        self.assertEqual(date(2016, 2, 29),
+            forecast.add_months(date(2016, 1, 31), 1))
+        self.assertEqual(date(2014, 3, 31),
+            forecast.add_months(date(2014, 1, 31), 2, 31))
+        self.assertEqual(date(2014, 4, 30),
+            forecast.add_months(date(2014, 1, 31), 3, 31))
+        self.assertEqual(date(2015, 1, 31),
+            forecast.add_months(date(2014, 12, 31), 1))
+        self.assertEqual(date(2016, 2, 29),
+            forecast.add_months(date(2014, 12, 31), 14))
+
+    def test_charge_events(self):
+        events = list(forecast.charge_events(days=120,
+            start=date(2014, 1, 1), chunk_size=1))
+        self.assertEqual([
+            (date(2014, 1, 31), u'sub1', u'USD', Decimal('25.00')),
+            (date(2014, 2, 28), u'sub1', u'USD', Decimal('13.00')),
+        ] + [
+            (date(2014, month, 15), u'sub2', u'USD', Decimal('7.00'))
+            for month in range(1, 5)
+        ], events)
+
+    def test_daily_totals(self):
+        self.limited.next_billing_date = datetime(2014, 1, 15, 12, tzinfo=utc)
+        self.limited.billing_day_of_month = 15
+        self.limited.save()
+        self.assertEqual([
+            (date(2014, 1, 15), u'USD', 2, Decimal('32.00')),
+            (date(2014, 2, 15), u'USD', 2, Decimal('20.00')),
+        ], forecast.daily_totals(days=50, start=date(2014, 1, 1)))
+
+    @override_settings(TIME_ZONE='Europe/Berlin')
+    def test_local_billing_date(self):
+        # Local midnight of the vault date, 2014-03-30 22:00 UTC in Berlin
+        self.limited.next_billing_date = make_aware(datetime(2014, 3, 31),
+            get_default_timezone())
+        self.limited.save()
+        self.assertEqual([
+            (date(2014, 3, 31), u'USD', 1, Decimal('25.00')),
+        ], forecast.daily_totals(days=10, start=date(2014, 3, 25)))
+
+
+def local_midnight(*args):
+    """ A vault date as stored by the sync """
+    return make_aware(datetime(*args), get_default_timezone())
+
+
+class ExpiringCardTest(TestCase):
+
+    def setUp(self):
+        customer = BTCustomer(id_id=1)
+        customer.save()
+        self.card = BTCreditCard.objects.create(token=u'card1',
+            customer=customer, default=True, expiration_month=12,
+            expiration_year=2014)
+        self.subscription = BTSubscription.objects.create(
+            subscription_id=u'sub1', customer=customer,
+            plan=BTPlan.objects.create(plan_id=u'plan1'),
+            status=BTSubscription.ACTIVE, trial_period=False,
+            next_billing_date=local_midnight(2014, 12, 31))
+
+    def test_expiring_before_next_charge(self):
+        card = self.card
+        subscription = self.subscription
+        self.assertEqual(date(2015, 1, 1), card.expires_on)
+
+        expiring = BTCreditCard.objects.expiring_before_next_charge
+        self.assertEqual([], list(expiring()))
+
+        subscription.next_billing_date = local_midnight(2015, 1, 1)
+        subscription.save()
+        self.assertEqual([card], list(expiring()))
+        self.assertEqual([], list(
+            expiring(until=datetime(2014, 12, 1, tzinfo=utc))))
+
+        # A canceled subscription billing soon doesn't make it match
+        BTSubscription.objects.create(subscription_id=u'sub2',
+            customer=subscription.customer, plan=subscription.plan,
+            status=BTSubscription.CANCELED, trial_period=False,
+            next_billing_date=datetime(2014, 11, 1, tzinfo=utc))
+        self.assertEqual([], list(
+            expiring(until=datetime(2014, 12, 1, tzinfo=utc))))
+        self.assertEqual([card], list(
+            expiring(until=datetime(2015, 2, 1, tzinfo=utc))))
+        self.assertEqual(1, str(expiring(until=now()).query).count(
+            'JOIN "btsubscriptions_btsubscription"'))
+
+    @override_settings(TIME_ZONE='Europe/Berlin')
+    def test_local_charge_day(self):
+        # Charged on the day the card expires, 2014-12-31 23:00 UTC
+        self.subscription.next_billing_date = local_midnight(2015, 1, 1)
+        self.subscription.save()
+        expiring = BTCreditCard.objects.expiring_before_next_charge
+        self.assertEqual([self.card], list(expiring()))
+
+        self.subscription.next_billing_date = local_midnight(2014, 12, 31)
+        self.subscription.save()
+        self.assertEqual([], list(expiring()))
+
+    def test_scan_signals_once(self):
+        signalled = []
+
+        def receiver(sender, cards, **kwargs):
+            signalled.extend(cards)
+
+        def scan():
+            call_command('scan_expiring_cards', stdout=StringIO())
+
+        self.subscription.next_billing_date = local_midnight(2015, 1, 1)
+        self.subscription.save()
+        cards_expiring.connect(receiver)
+        try:
+            scan()
+            scan()
+            self.assertEqual([self.card], signalled)
+
+            # Until the card or a subscription of its customer changes
+            self.subscription.updated = now()
+            self.subscription.save()
+            scan()
+            self.assertEqual([self.card] * 2, signalled)
+        finally:
+            cards_expiring.disconnect(receiver)
+
+
+class FakeClock(object):
+    """ Stands in for the time module of ratelimit """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@override_settings(
+    CACHES={
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+        'ratelimit': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'btsubscriptions-ratelimit-test',
+        },
+    },
+    BRAINTREE_RATE_LIMIT=2,
+    BRAINTREE_RATE_LIMIT_CACHE='ratelimit',
+)
+class RateLimitTest(TestCase):
+
+    def setUp(self):
+        ratelimit.get_bucket_cache().clear()
+        ratelimit.set_default_priority(ratelimit.INTERACTIVE)
+        self.clock = ratelimit.time = FakeClock()
+
+    def tearDown(self):
+        ratelimit.time = time
+
+    def test_refill(self):
+        self.assertEqual(0, ratelimit.take('tenant'))
+        self.assertEqual(0, ratelimit.take('tenant'))
+        self.assertEqual(0.5, ratelimit.take('tenant'))
+
+        self.clock.now += 0.5
+        self.assertEqual(0, ratelimit.take('tenant'))
+        # Tenants have their own buckets
+        self.assertEqual(0, ratelimit.take('other'))
+
+    @override_settings(BRAINTREE_RATE_LIMIT_BURST=5)
+    def test_background_leaves_reserve(self):
+        for i in range(4):
+            self.assertEqual(0, ratelimit.take('tenant', ratelimit.BACKGROUND))
+        self.assertEqual(0.5, ratelimit.take('tenant', ratelimit.BACKGROUND))
+        self.assertEqual(0, ratelimit.take('tenant', ratelimit.INTERACTIVE))
+
+        with ratelimit.background():
+            self.assertEqual(ratelimit.BACKGROUND, ratelimit.get_priority())
+        self.assertEqual(ratelimit.INTERACTIVE, ratelimit.get_priority())
+
+    def test_acquire_waits(self):
+        for i in range(3):
+            ratelimit.acquire('tenant')
+        self.assertEqual([0.5], self.clock.sleeps)
+
+    @override_settings(BRAINTREE_RATE_LIMIT=0.5)
+    def test_slow_rate(self):
+        # The burst is at least one call, without a reserve
+        self.assertEqual(0, ratelimit.take('tenant', ratelimit.BACKGROUND))
+        self.assertEqual(2, ratelimit.take('tenant', ratelimit.BACKGROUND))
+        ratelimit.acquire('tenant', ratelimit.BACKGROUND)
+        self.assertEqual([2], self.clock.sleeps)
+
+
+class JobTest(TestCase):
+
+    def setUp(self):
+        customer = BTCustomer(id_id=1)
+        customer.save()
+        plan = BTPlan.objects.create(plan_id=u'plan1')
+        for i in range(5):
+            BTSubscription.objects.create(subscription_id=u'sub%d' % i,
+                customer=customer, plan=plan, trial_period=False,
+                status=BTSubscription.ACTIVE)
+        self.job = BTJob.objects.enqueue('cancel',
+            BTSubscription.objects.order_by('-pk'), reason=u'test')
+
+    def tearDown(self):
+        # The command made the process a background worker
+        ratelimit.set_default_priority(ratelimit.INTERACTIVE)
+
+    def canceled(self, vault):
+        return [args[0] for name, args, kwargs in vault.vault_calls]
+
+    def test_enqueue(self):
+        self.assertEqual(5, self.job.total)
+        self.assertEqual(BTJob.PENDING, self.job.status)
+        self.assertEqual(list(BTSubscription.objects.order_by('pk')
+            .values_list('pk', flat=True)), decode(self.job.object_ids))
+        self.assertEqual({u'reason': u'test'}, decode(self.job.params))
+        self.assertEqual([self.job], list(BTJob.objects.due()))
+
+    def test_claim(self):
+        stale = BTJob.objects.get()
+        self.assertTrue(self.job.claim())
+        self.assertFalse(stale.claim())
+        self.assertEqual([], list(BTJob.objects.due()))
+
+    def test_resume(self):
+        with FakeVault() as vault:
+            self.assertTrue(self.job.process_chunk(chunk_size=2))
+        self.assertEqual([u'sub0', u'sub1'], self.canceled(vault))
+
+        # The worker died, another one continues after the lease expired
+        BTJob.objects.update(next_attempt=now())
+        with FakeVault() as vault:
+            # Threads would not see the test database
+            call_command('run_jobs', chunk_size=2, concurrency=1,
+                stdout=StringIO())
+        self.assertEqual([u'sub2', u'sub3', u'sub4'], self.canceled(vault))
+
+        job = BTJob.objects.get()
+        self.assertEqual((BTJob.DONE, 5, 0), (job.status, job.position,
+            job.failed))
+
+    def test_cancel(self):
+        with FakeVault():
+            self.job.process_chunk(chunk_size=2)
+
+        # Canceled in the admin while the worker processes the next chunk
+        BTJob.objects.update(status=BTJob.CANCELED)
+        with FakeVault():
+            self.assertFalse(self.job.process_chunk(chunk_size=2))
+        job = BTJob.objects.get()
+        self.assertEqual((BTJob.CANCELED, 2), (job.status, job.position))
+        self.assertEqual([], list(BTJob.objects.due()))
+
+
+class EstimatedCountTest(TestCase):
+
+    def test_only_unfiltered_counts_are_estimated(self):
+        estimated = []
+
+        def estimated_count(queryset):
+            estimated.append(queryset)
+            return 20000
+
+        queryset = BTWebhookLog.objects.all()._clone(
+            klass=EstimatedCountQuerySet)
+        original = EstimatedCountQuerySet.estimated_count
+        EstimatedCountQuerySet.estimated_count = estimated_count
+        try:
+            self.assertEqual(20000, queryset.count())
+            self.assertEqual(0, queryset.filter(kind=u'check').count())
+        finally:
+            EstimatedCountQuerySet.estimated_count = original
+        self.assertEqual(1, len(estimated))
+
+
+class PushConcurrentlyTest(TestCase):
+
+    def setUp(self):
+        customer = BTCustomer(id_id=1)
+        customer.save()
+        BTCreditCard.objects.create(token=u'card1', customer=customer,
+            default=True)
+        plan = BTPlan.objects.create(plan_id=u'plan1')
+        self.subscriptions = [
+            BTSubscription.objects.create(subscription_id=u'sub%d' % i,
+                customer=customer, plan=plan, trial_period=False,
+                status=BTSubscription.ACTIVE)
+            for i in range(4)
+        ]
+        self.threads = []
+
+    def tearDown(self):
+        gateways.deactivate()
+
+    def update(self, subscription_id, params):
+        self.threads.append((threading.current_thread(),
+            gateways.get_tenant()))
+        if subscription_id == u'sub0':
+            # Finishes last
+            time.sleep(0.05)
+        elif subscription_id == u'sub2':
+            return resource(is_success=False, message=u'Declined')
+        elif subscription_id == u'sub3':
+            raise RuntimeError('Connection reset')
+        return success(subscription=resource(id=subscription_id,
+            status=BTSubscription.ACTIVE))
+
+    def test_push_concurrently(self):
+        gateways.activate(u'other')
+        errors = []
+        with FakeVault({'subscription.update': self.update}, tenant=u'other'):
+            pushed = push_concurrently(self.subscriptions, errors)
+
+        self.assertEqual([u'sub0', u'sub1'],
+            [subscription.subscription_id for subscription in pushed])
+        self.assertEqual([(u'sub2', ValidationError),
+            (u'sub3', RuntimeError)],
+            [(subscription.subscription_id, type(error))
+                for subscription, error in errors])
+
+        # The updates ran in worker threads of the active tenant
+        self.assertEqual(4, len(self.threads))
+        for thread, tenant in self.threads:
+            self.assertNotEqual(threading.current_thread(), thread)
+            self.assertEqual(u'other', tenant)
+        self.assertEqual(u'other', gateways.get_tenant())
+
+    def test_first_error_is_raised(self):
+        with FakeVault({'subscription.update': self.update}):
+            with self.assertRaises(ValidationError):
+                push_concurrently(self.subscriptions)
+
+
+class ShardingTest(TestCase):
+
+    def test_ring_moves_few_keys(self):
+        before = HashRing([u'a', u'b', u'c'])
+        after = HashRing([u'a', u'b', u'c', u'd'])
+        moved = [key for key in range(1000)
+            if before.owner(key) != after.owner(key)]
+        # Only keys of the new worker change hands
+        self.assertEqual(set([u'd']), set(after.owner(key) for key in moved))
+        self.assertLess(len(moved), 400)
+
+    def test_unicode_workers(self):
+        self.assertEqual(position(u'w\xf6rker'.encode('utf-8')),
+            position(u'w\xf6rker'))
+        ring = HashRing([u'w\xf6rker', u'b'])
+        self.assertEqual(set([u'w\xf6rker', u'b']),
+            set(ring.owner(key) for key in range(100)))
+
+    def test_expired_leases_are_deleted(self):
+        BTWorkerLease.objects.create(worker=u'gone',
+            expires=now() - timedelta(seconds=1))
+        shard = Shard(u'worker')
+        shard.refresh()
+        self.assertEqual([u'worker'], shard.ring.workers)
+        self.assertEqual([u'worker'], list(BTWorkerLease.objects
+            .values_list('worker', flat=True)))
+
+    def test_shards_are_disjoint(self):
+        for i in range(1, 21):
+            BTCustomer(id_id=i).save()
+
+        shards = [Shard(u'worker%d' % i) for i in range(3)]
+        for shard in shards:
+            shard.refresh()
+        owned = [
+            [customer.pk for chunk in shard.chunks(BTCustomer.objects.all(),
+                chunk_size=7) for customer in chunk]
+            for shard in shards
+        ]
+        self.assertEqual(range(1, 21), sorted(sum(owned, [])))
+
+        # The customers of a leaving worker are taken over
+        shards[0].leave()
+        self.assertEqual(range(1, 21), sorted(
+            customer.pk for shard in shards[1:]
+            for chunk in shard.chunks(BTCustomer.objects.all())
+            for customer in chunk
+        ))
+
+
+class CustomerLockTest(TestCase):
+
+    urls = 'btsubscriptions.urls'
+
+    def push_customer(self, pk):
+        """ Create the records like a finished sync_customer() would """
+        bt_customer = BTCustomer(id_id=pk, first_name=u'Jane',
+            last_name=u'Doe')
+        bt_customer.updated = now()
+        bt_customer.save()
+        address = BTAddress(code=u'a%d' % pk, customer=bt_customer)
+        address.updated = now()
+        address.save()
+        return bt_customer
+
+    def test_sync_rechecks_after_waiting(self):
+        def try_lock(connection, pk):
+            # The other request pushed the customer while this one waited
+            self.push_customer(pk)
+            return True
+
+        # Loaded before the other request created its BTCustomer
+        customers = locking.customer_model()._default_manager
+        customers.create(pk=1, first_name=u'Jane', last_name=u'Doe')
+        customers.update(modified=now() - timedelta(days=1))
+        customer = customers.get()
+
+        original = locking.try_lock
+        locking.try_lock = try_lock
+        try:
+            with FakeVault() as vault:
+                sync_customer(customer)
+        finally:
+            locking.try_lock = original
+
+        self.assertEqual([], vault.calls)
+        self.assertEqual(1, BTCustomer.objects.count())
+        self.assertEqual(1, BTAddress.objects.count())
+
+    def test_sync_inside_locked_view(self):
+        locking.customer_model()._default_manager.create(pk=1)
+        bt_customer = self.push_customer(1)
+        customer = FakeCustomer(bt_customer, modified=now(),
+            street=u'Main Street 1', city=u'Springfield', state=None,
+            zip_code=u'12345', country=resource(code=u'US'))
+
+        @views.locks_customer
+        def view(request):
+            sync_customer(request.access.customer)
+            return HttpResponse()
+
+        request = RequestFactory().get('/')
+        request.access = FakeAccess(customer)
+        vault = FakeVault({'address.update': lambda *args, **kwargs: success(
+            address=resource(id=u'a1'))})
+        with self.settings(BRAINTREE_CUSTOMER_LOCK_TIMEOUT=0), vault:
+            response = view(request)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([u'customer.update', u'address.update'],
+            [name for name, args, kwargs in vault.vault_calls])
+
+    def test_index_during_first_sync(self):
+        def sync_customer(customer):
+            raise locking.CustomerLocked(customer.pk)
+
+        customer = locking.customer_model()._default_manager.create(pk=1)
+        request = RequestFactory().get('/')
+        request.access = FakeAccess(customer)
+        request.session = SessionStore()
+        request._messages = FallbackStorage(request)
+
+        original = views.sync_customer
+        views.sync_customer = sync_customer
+        try:
+            response = views.index(request)
+        finally:
+            views.sync_customer = original
+
+        self.assertEqual(302, response.status_code)
+        self.assertEqual([messages.WARNING],
+            [message.level for message in messages.get_messages(request)])
+
+
+class ProrationTest(TestCase):
+    """ Previews follow braintree's proration of plan changes """
+
+    def setUp(self):
+        self.plans = [
+            BTPlan(pk=i, plan_id=u'plan%d' % i, price=Decimal(price))
+            for i, price in enumerate(('10.00', '20.00', '4.00'))
+        ]
+        # A 30 day billing period, half of it left on the 16th
+        self.subscription = BTSubscription(plan=self.plans[0],
+            price=Decimal('10.00'), balance=Decimal('0.00'))
+        self.set_period(datetime(2014, 6, 1), datetime(2014, 6, 30))
+        self.today = date(2014, 6, 16)
+
+    def set_period(self, start, end):
+        # Vault dates are stored as local midnight and read back in UTC
+        tz = get_default_timezone()
+        self.subscription.billing_period_start_date = \
+            make_aware(start, tz).astimezone(utc)
+        self.subscription.billing_period_end_date = \
+            make_aware(end, tz).astimezone(utc)
+
+    def test_upgrade_is_charged(self):
+        preview = prorate(self.subscription, self.plans[1], self.today)
+        self.assertEqual(Decimal('5.00'), preview['amount'])
+        self.assertEqual(Decimal('5.00'), preview['charge'])
+        self.assertEqual(Decimal('0.00'), preview['balance'])
+
+    def test_upgrade_uses_credit(self):
+        self.subscription.balance = Decimal('-2.00')
+        preview = prorate(self.subscription, self.plans[1], self.today)
+        self.assertEqual(Decimal('3.00'), preview['charge'])
+        self.assertEqual(Decimal('0.00'), preview['balance'])
+
+    def test_downgrade_is_credited(self):
+        preview = prorate(self.subscription, self.plans[2], self.today)
+        self.assertEqual(Decimal('-3.00'), preview['amount'])
+        self.assertEqual(Decimal('0.00'), preview['charge'])
+        self.assertEqual(Decimal('-3.00'), preview['balance'])
+
+    def test_previews(self):
+        result = previews(self.subscription, self.plans, self.today)
+        self.assertEqual(set([u'plan1', u'plan2']), set(result))
+
+        self.subscription.billing_period_end_date = None
+        result = previews(self.subscription, self.plans, self.today)
+        self.assertEqual({u'plan1': None, u'plan2': None}, result)
+
+    @override_settings(TIME_ZONE='Europe/Berlin')
+    def test_local_billing_period(self):
+        # The period starts 2014-05-31 22:00 UTC in Berlin
+        self.set_period(datetime(2014, 6, 1), datetime(2014, 6, 30))
+
+        preview = prorate(self.subscription, self.plans[1], self.today)
+        self.assertEqual(Decimal('5.00'), preview['amount'])
+        preview = prorate(self.subscription, self.plans[1], date(2014, 6, 30))
+        self.assertEqual(Decimal('0.33'), preview['amount'])
+
+
+class ViewBudgetTest(ViewBudgetTestCase):
+    """ Every payment view must stay within its query/vault/time budget """
+
+    urls = 'btsubscriptions.urls'
+
+    def setUp(self):
+        yesterday = now() - timedelta(days=1)
+
+        bt_customer = BTCustomer(first_name=u'Jane', last_name=u'Doe')
+        bt_customer.id_id = 1
+        bt_customer.updated = now()
+        bt_customer.save()
+
+        address = BTAddress(code=u'a1', customer=bt_customer)
+        address.updated = now()
+        address.save()
+
+        self.customer = FakeCustomer(bt_customer, modified=yesterday)
+
+        self.card = BTCreditCard.objects.create(
+            token=u'card1', customer=bt_customer, default=True)
+
+        self.plans = [
+            BTPlan.objects.create(plan_id=u'plan%d' % i, price=Decimal(i))
+            for i in range(1, 4)
+        ]
+        self.add_ons = [
+            BTAddOn.objects.create(addon_id=u'addon%d' % i, amount=Decimal(i))
+            for i in range(1, 4)
+        ]
+        self.discount = BTDiscount.objects.create(discount_id=u'discount1')
+
+        self.subscription = BTSubscription.objects.create(
+            subscription_id=u'sub1',
+            customer=bt_customer,
+            plan=self.plans[0],
+            status=BTSubscription.ACTIVE,
+            trial_period=False,
+            current_billing_cycle=2,
+        )
+        BTSubscribedAddOn.objects.create(
+            subscription=self.subscription, add_on=self.add_ons[0])
+        BTSubscribedAddOn.objects.filter(subscription=self.subscription)\
+            .update(created=now() - timedelta(days=60))
+
+        for i in range(10):
+            BTTransaction.objects.create(transaction_id=u'trans%d' % i,
+                subscription=self.subscription, created_at=now())
+
+    def run_view(self, name, args=(), vault=None, **kwargs):
+        request = self.request(name, args=args, customer=self.customer,
+            **kwargs)
+        response = self.measure(name, request, vault=vault)
+        self.assertWithinBudget(name)
+        return response
+
+    def test_every_view_has_a_test(self):
+        names = set(pattern.name for pattern in urls.urlpatterns)
+        tested = set(name[5:] for name in dir(self) if name.startswith('test_'))
+        self.assertEqual(set(), names - set(
+            'payment_%s' % name for name in tested))
+
+    def test_index(self):
+        self.run_view('payment_index')
+
+    def test_add_credit_card(self):
+        self.run_view('payment_add_credit_card')
+
+    def test_confirm_credit_card(self):
+        card = resource(token=u'card2', customer_id=u'1', default=True)
+        vault = FakeVault({
+            'transparent_redirect.confirm': lambda query: success(
+                credit_card=card),
+            'credit_card.find': lambda token: card,
+        })
+        self.run_view('payment_confirm_credit_card', vault=vault)
+
+    def test_subscribe(self):
+        self.subscription.status = BTSubscription.CANCELED
+        self.subscription.save()
+        # New subscriptions aren't found in the vault
+        vault = FakeVault({'subscription.update': not_found})
+        self.run_view('payment_subscribe', args=(u'plan2',), vault=vault)
+        self.assertEqual(1,
+            BTSubscription.objects.filter(subscription_id=u'new').count())
+
+    def test_subscribe_while_locked(self):
+        try_lock = locking.try_lock
+        locking.try_lock = lambda connection, pk: False
+        try:
+            request = self.request('payment_subscribe', args=(u'plan2',),
+                customer=self.customer)
+            with self.settings(BRAINTREE_CUSTOMER_LOCK_TIMEOUT=0), \
+                    FakeVault() as vault:
+                response = resolve(request.path).func(request, u'plan2')
+        finally:
+            locking.try_lock = try_lock
+
+        self.assertEqual(302, response.status_code)
+        self.assertEqual([], vault.calls)
+
+    def test_subscription_upsert(self):
+        data = vault_subscription(plan_id=u'plan2')
+        subscription = BTSubscription.objects.upsert(data, 'webhook',
+            plan=self.plans[1])
+        self.assertEqual(self.subscription.pk, subscription.pk)
+        self.assertEqual(self.plans[1], subscription.plan)
+
+        # Unchanged data, including its dates, is not written again
+        with CaptureQueriesContext(connection) as queries:
+            BTSubscription.objects.upsert(vault_subscription(plan_id=u'plan2'),
+                'webhook', plan=self.plans[1])
+        self.assertEqual([], [query['sql'] for query in queries
+            if query['sql'].startswith(('UPDATE', 'INSERT'))])
+
+    def test_stale_upsert(self):
+        # A webhook stored newer state while the vault answered the view
+        webhook = datetime(2014, 6, 2, 12, 5)
+        BTSubscription.objects.upsert(vault_subscription(
+            status=u'Past Due', updated_at=webhook), 'webhook')
+
+        subscription = BTSubscription.objects.upsert(vault_subscription(
+            updated_at=datetime(2014, 6, 2, 12, 0)), 'push')
+        self.assertEqual(u'Past Due', subscription.status)
+        self.assertEqual(u'Past Due', BTSubscription.objects.get().status)
+
+        BTSubscription.objects.upsert(vault_subscription(updated_at=webhook),
+            'pull')
+        self.assertEqual(u'Active', BTSubscription.objects.get().status)
+
+    def test_unsubscribe(self):
+        self.run_view('payment_unsubscribe', args=(u'sub1',))
+
+    def test_multiple_subscriptions(self):
+        self.run_view('payment_multiple_subscriptions')
+
+    def test_change_to_plan(self):
+        self.run_view('payment_change_to_plan', args=(u'plan2',))
+
+    def test_downgrade_to_free_plan(self):
+        self.run_view('payment_downgrade_to_free_plan')
+
+    def test_enable_addon(self):
+        self.run_view('payment_enable_addon', args=(u'sub1', u'addon2'))
+
+    def test_disable_addon(self):
+        self.run_view('payment_disable_addon', args=(u'sub1', u'addon1'))
+
+    def test_add_discount(self):
+        self.run_view('payment_add_discount', args=(u'sub1',),
+            data={'discount_id': u'discount1'})
+
+    def test_webhook(self):
+        subscription = resource(
+            id=u'sub1',
+            status=BTSubscription.ACTIVE,
+            payment_method_token=u'card1',
+            plan_id=u'plan1',
+            transactions=[
+                resource(id=u'trans%d' % i, amount=Decimal('1.00'),
+                    credit_card={'bin': u'411111', 'last_4': u'1111'})
+                for i in range(5)
+            ],
+        )
+        vault = FakeVault({
+            'webhook_notification.parse': lambda signature, payload: resource(
+                kind=u'subscription_charged_successfully',
+                subscription=subscription,
+            )
+        })
+        self.run_view('payment_webhook', method='post', vault=vault,
+            data={'bt_signature': u'signature', 'bt_payload': u'payload'})
+
+    def test_analytics(self):
+        staff = User.objects.create_user('staff', password='staff')
+        staff.is_staff = True
+        self.run_view('payment_analytics', user=staff)
+
+        for days in ('x', '0', '99999999999'):
+            request = self.request('payment_analytics', user=staff,
+                data={'days': days})
+            response = resolve(request.path).func(request)
+            self.assertEqual(400, response.status_code)
+
+    def test_export(self):
+        staff = User.objects.create_user('staff', password='staff')
+        staff.is_staff = True
+        response = self.run_view('payment_export', args=(u'transactions',),
+            user=staff, data={'start': (now() - timedelta(days=1)).date()})
+
+        lines = ''.join(response.streaming_content).splitlines()
+        self.assertEqual(11, len(lines))
+        self.assertTrue(lines[0].startswith('id,transaction_id,'))
+
+    def test_catalogue(self):
+        response = self.run_view('payment_catalogue')
+        self.assertEqual(3, len(json.loads(response.content)['plans']))
+
+        # Revalidation neither queries nor sends the body
+        request = self.request('payment_catalogue')
+        request.META['HTTP_IF_NONE_MATCH'] = response['ETag']
+        response = self.measure('payment_catalogue', request)
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(0, self.measurements['payment_catalogue']['queries'])
+
+        # The ETag follows the content, not the cache version
+        bump_version()
+        response = self.measure('payment_catalogue', request)
+        self.assertEqual(304, response.status_code)
+
+        # Changes of the catalogue change the ETag
+        etag = response['ETag']
+        self.plans[0].price = Decimal('9.99')
+        self.plans[0].save()
+        response = self.measure('payment_catalogue', request)
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+        self.assertEqual(u'9.99',
+            json.loads(response.content)['plans'][0]['price'])
+
+    def test_error(self):
+        self.run_view('payment_error')
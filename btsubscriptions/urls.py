@@ -68,6 +68,25 @@ urlpatterns = patterns('btsubscriptions.views',
         name='payment_add_discount'
     ),
 
+    # Reporting
+    url(
+        regex=r'^analytics/$',
+        view='analytics',
+        name='payment_analytics'
+    ),
+    url(
+        regex=r'^export/(?P<name>\w+)/$',
+        view='export',
+        name='payment_export'
+    ),
+
+    # Catalogue of plans, add-ons and discounts
+    url(
+        regex=r'^catalogue/$',
+        view='catalogue',
+        name='payment_catalogue'
+    ),
+
     # Webhooks and helper views
     url(
         regex=r'^webhook/$',
@@ -1,22 +1,18 @@
 
+from .locking import customer_lock
 from .models import BTCustomer, BTAddress
 
 
-def sync_customer(customer):
-    """ Make sure the customer exists in the vault and is up to date"""
-    try:
-        bt_customer = customer.braintree
-    except BTCustomer.DoesNotExist:
-        bt_customer = BTCustomer()
-        bt_customer.id = customer
-
-    if not bt_customer.created or customer.modified > bt_customer.updated:
-        bt_customer.first_name = customer.first_name
-        bt_customer.last_name = customer.last_name
-        bt_customer.company = customer.company
-
-        bt_customer.push()
-        bt_customer.save()
+def customer_records(customer, bt_customer=None):
+    """ The BTCustomer and latest BTAddress of customer, new unsaved ones
+        if they don't exist yet
+    """
+    if bt_customer is None:
+        try:
+            bt_customer = customer.braintree
+        except BTCustomer.DoesNotExist:
+            bt_customer = BTCustomer()
+            bt_customer.id = customer
 
     try:
         bt_address = bt_customer.addresses.latest()
@@ -24,15 +20,46 @@ def sync_customer(customer):
         bt_address = BTAddress()
         bt_address.customer = bt_customer
 
-    if not bt_address.created or customer.modified > bt_address.updated:
-        bt_address.first_name = customer.first_name
-        bt_address.last_name = customer.last_name
-        bt_address.company = customer.company
-        bt_address.street_address = customer.street
-        bt_address.locality = customer.city
-        bt_address.region = customer.state
-        bt_address.postal_code = customer.zip_code
-        bt_address.country_code_alpha2 = customer.country.code
-
-        bt_address.push()
-        bt_address.save()
+    return bt_customer, bt_address
+
+
+def is_outdated(record, customer):
+    return not record.created or customer.modified > record.updated
+
+
+def sync_customer(customer):
+    """ Make sure the customer exists in the vault and is up to date.
+        Pushes happen under the lock of the customer and raise
+        CustomerLocked if another request is pushing the customer.
+    """
+    bt_customer, bt_address = customer_records(customer)
+    if not is_outdated(bt_customer, customer) \
+            and not is_outdated(bt_address, customer):
+        return
+
+    with customer_lock(customer):
+        # Another request may have pushed while this one was waiting
+        if bt_customer.created is None:
+            bt_customer = BTCustomer.objects.filter(pk=customer.pk).first()
+        bt_customer, bt_address = customer_records(customer, bt_customer)
+
+        if is_outdated(bt_customer, customer):
+            bt_customer.first_name = customer.first_name
+            bt_customer.last_name = customer.last_name
+            bt_customer.company = customer.company
+
+            bt_customer.push_or_defer()
+            bt_customer.save()
+
+        if is_outdated(bt_address, customer):
+            bt_address.first_name = customer.first_name
+            bt_address.last_name = customer.last_name
+            bt_address.company = customer.company
+            bt_address.street_address = customer.street
+            bt_address.locality = customer.city
+            bt_address.region = customer.state
+            bt_address.postal_code = customer.zip_code
+            bt_address.country_code_alpha2 = customer.country.code
+
+            bt_address.push_or_defer()
+            bt_address.save()
@@ -1,22 +1,54 @@
-from braintree import WebhookNotification
-import braintree
-import traceback
-from pprint import pformat
+import json
+from functools import wraps
 
+from django.conf import settings
 from django.contrib import messages
+from django.contrib.admin.views.decorators import staff_member_required
 from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest, Http404
+from django.http import HttpResponseNotModified, StreamingHttpResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from django.utils import formats
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
 from django.utils.translation import ugettext_lazy as _
 from django.views.decorators.csrf import csrf_exempt
 
+from .analytics import report
+from .catalogue import get_catalogue
+from .exports import EXPORTS, FORMATS, parse_day
+from .gateways import get_collection, get_gateway
+from .locking import customer_lock, CustomerLocked
+from .proration import previews
+from .sync import push_concurrently
 from .utils import sync_customer
+from .webhooks import handle_notifications
 
-from models import BTCreditCard, BTPlan, BTAddOn, BTDiscount
+from models import BTCustomer, BTCreditCard, BTPlan, BTAddOn, BTDiscount
 from models import BTSubscription, BTSubscribedAddOn, BTSubscribedDiscount
-from models import BTTransaction, BTWebhookLog
+from models import BTTransaction
+
+
+def customer_locked(request, to='payment_index'):
+    messages.warning(request, _('Another change of your account is '
+        'in progress, please try again in a moment'))
+    return redirect(to)
+
+
+def locks_customer(view):
+    """ Run view holding the lock of the customer, answering right away if
+        another request of the customer is changing the vault
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        try:
+            with customer_lock(request.access.customer):
+                return view(request, *args, **kwargs)
+        except CustomerLocked:
+            return customer_locked(request)
+    return wrapper
 
 
 def index(request):
@@ -24,6 +56,13 @@ def index(request):
 
     try:
         sync_customer(request.access.customer)
+    except CustomerLocked:
+        # Another request is pushing the customer right now. Show the last
+        # pushed state, unless this is its first push.
+        try:
+            customer.braintree
+        except BTCustomer.DoesNotExist:
+            return customer_locked(request, 'payment_error')
     except ValidationError as e:
         messages.error(request, e)
         return redirect('payment_error')
@@ -55,6 +94,9 @@ def index(request):
 
     transactions = BTTransaction.objects.for_customer(customer.braintree)
 
+    # What changing to each plan would cost, see change_to_plan
+    prorations = previews(active_sub, plans) if active_sub else {}
+
     return render(request, 'payments/index.html', {
         'card': card,
         'plans': plans,
@@ -62,7 +104,8 @@ def index(request):
         'active_subscription': active_sub,
         'subscribed_plan_ids': subscribed_plan_ids,
         'add_ons': add_ons,
-        'transactions': transactions
+        'transactions': transactions,
+        'prorations': prorations,
     })
 
 
@@ -75,7 +118,8 @@ def add_credit_card(request):
 
     #cc_token = str(uuid.uuid1())
 
-    tr_data = braintree.CreditCard.tr_data_for_create(
+    gateway = get_gateway()
+    tr_data = gateway.credit_card.tr_data_for_create(
         {
             "credit_card": {
                 "customer_id": str(customer.id),
@@ -89,7 +133,7 @@ def add_credit_card(request):
         request.build_absolute_uri(reverse('payment_confirm_credit_card'))
     )
 
-    braintree_url = braintree.TransparentRedirect.url()
+    braintree_url = gateway.transparent_redirect.url()
 
     return render(request, 'payments/add_card.html',  {
         "tr_data": tr_data,
@@ -97,6 +141,7 @@ def add_credit_card(request):
     })
 
 
+@locks_customer
 def confirm_credit_card(request):
     customer = request.access.customer
 
@@ -107,7 +152,7 @@ def confirm_credit_card(request):
         return redirect('payment_error')
 
     query_string = request.META['QUERY_STRING']
-    result = braintree.TransparentRedirect.confirm(query_string)
+    result = get_collection('transparent_redirect').confirm(query_string)
 
     if result.is_success:
         # unset default credit card
@@ -121,9 +166,16 @@ def confirm_credit_card(request):
         creditcard.save()
 
         # update subscriptions to use new card
-        for subscription in customer.braintree.subscriptions.running():
-            subscription.push()
+        subscriptions = customer.braintree.subscriptions.running()
+        errors = []
+        for subscription in push_concurrently(subscriptions, errors):
             subscription.save()
+        for subscription, error in errors:
+            messages.error(request, _('%(subscription)s could not be '
+                'switched to the new card: %(error)s') % {
+                    'subscription': subscription,
+                    'error': error,
+                })
 
         if 'subscribe_directly' in request.session:
             plan_id = request.session['subscribe_directly']
@@ -137,6 +189,7 @@ def confirm_credit_card(request):
         })
 
 
+@locks_customer
 def subscribe(request, plan_id):
     customer = request.access.customer
     plan = get_object_or_404(BTPlan, plan_id=plan_id)
@@ -156,10 +209,10 @@ def subscribe(request, plan_id):
     try:
         subscription.clean()
         result = subscription.push()
-        subscription.import_data(result.subscription)
         # Webhooks COULD have already saved this subscription
-        if customer.braintree.subscriptions.running().count() == 0:
-            subscription.save()
+        BTSubscription.objects.upsert(result.subscription, source='push',
+            customer=subscription.customer, plan=plan,
+            created=subscription.created)
 
         messages.success(request,
             _('You have been successfully subscribed to plan %(plan)s') % {
@@ -176,6 +229,7 @@ def subscribe(request, plan_id):
     return redirect('payment_index')
 
 
+@locks_customer
 def unsubscribe(request, subscription_id):
     subscription = get_object_or_404(BTSubscription,
         subscription_id=subscription_id)
@@ -201,6 +255,7 @@ def unsubscribe(request, subscription_id):
         })
 
 
+@locks_customer
 def change_to_plan(request, plan_id):
     customer = request.access.customer
     plan = get_object_or_404(BTPlan, plan_id=plan_id)
@@ -276,14 +331,14 @@ def enable_addon(request, sub_id, addon_id):
     subscription = get_object_or_404(BTSubscription, subscription_id=sub_id)
     add_on = get_object_or_404(BTAddOn, addon_id=addon_id)
 
-    result = braintree.Subscription.update(sub_id, {
+    result = subscription.collection.update(sub_id, {
         'add_ons': {'add': [{'inherited_from_id': addon_id}]}
     })
 
     save_addon = True
 
     if result.is_success:
-        subscription.import_data(result.subscription)
+        subscription.import_data(result.subscription, source='push')
         subscription.save()
     elif '91911' in (error.code for error in result.errors.deep_errors):
         # Add-on is already active! Just continue and save add-on
@@ -325,14 +380,14 @@ def disable_addon(request, sub_id, addon_id):
         )
         return redirect('payment_index')
 
-    result = braintree.Subscription.update(sub_id, {
+    result = subscription.collection.update(sub_id, {
         'add_ons': {'remove': [str(addon_id)]}
     })
 
     delete_addon = True
 
     if result.is_success:
-        subscription.import_data(result.subscription)
+        subscription.import_data(result.subscription, source='push')
         subscription.save()
     elif '92016' in (error.code for error in result.errors.deep_errors):
         # Add-On is already deleted on braintree, just delete it locally
@@ -358,7 +413,7 @@ def add_discount(request, sub_id):
         messages.error(request, _('Sorry, your discount code is invalid'))
         return redirect('payment_index')
 
-    result = braintree.Subscription.update(sub_id, {
+    result = subscription.collection.update(sub_id, {
         'discounts': {'add': [{'inherited_from_id': discount_id}]}
     })
 
@@ -369,7 +424,7 @@ def add_discount(request, sub_id):
         )
         discount.save()
 
-        subscription.import_data(result.subscription)
+        subscription.import_data(result.subscription, source='push')
         subscription.save()
         messages.success(request, u'Discount successfully added')
     else:
@@ -378,76 +433,83 @@ def add_discount(request, sub_id):
     return redirect('payment_index')
 
 
-def bt_to_dict(resource):
-    data = resource.__dict__
-    for k in data.keys():
-        if k.startswith('_'):
-            del data[k]
-    return data
-
-
 @csrf_exempt
 def webhook(request):
     if 'bt_challenge' in request.GET:
         challenge = request.GET['bt_challenge']
-        return HttpResponse(WebhookNotification.verify(challenge))
+        return HttpResponse(
+            get_gateway().webhook_notification.verify(challenge))
     elif 'bt_signature' in request.POST and 'bt_payload' in request.POST:
         bt_signature = str(request.POST['bt_signature'])
         bt_payload = str(request.POST['bt_payload'])
-        notification = WebhookNotification.parse(bt_signature, bt_payload)
-        return handle_webhook_notficiation(notification)
+        notification = get_gateway().webhook_notification.parse(
+            bt_signature, bt_payload)
+        return handle_webhook_notficiation(notification, bt_signature,
+            bt_payload)
     else:
         return HttpResponse("I don't understand you")
 
 
-def handle_webhook_notficiation(notification):
-    log = BTWebhookLog(kind=notification.kind)
-    try:
-        log.data = pformat(bt_to_dict(notification.subscription), indent=2)
+def handle_webhook_notficiation(notification, bt_signature='',
+        bt_payload=''):
+    """ Apply and log a single notification, see
+        webhooks.handle_notifications()
+    """
+    handle_notifications([(notification, bt_signature, bt_payload)])
+    return HttpResponse('Ok, thanks')
 
-        token = notification.subscription.payment_method_token
 
-        card = BTCreditCard.objects.get(token=token)
-        plan_id = notification.subscription.plan_id
-        plan = BTPlan.objects.get(plan_id=plan_id)
+@staff_member_required
+def analytics(request):
+    days = request.GET.get('days', '30')
+    if not days.isdigit() or not 0 < int(days) <= 36500:
+        return HttpResponseBadRequest('days must be between 1 and 36500')
+    days = int(days)
+    return HttpResponse(json.dumps(report(days=days), cls=DjangoJSONEncoder),
+        content_type='application/json')
 
-        # Update subscription
-        try:
-            subscription = BTSubscription.objects.get(
-                subscription_id=notification.subscription.id
-            )
-        except BTSubscription.DoesNotExist:
-            subscription = BTSubscription(
-                subscription_id=notification.subscription.id,
-                customer=card.customer,
-            )
-
-        subscription.plan = plan
-        subscription.import_data(notification.subscription)
-        subscription.save()
 
-        # Import transactions
-        if notification.kind == "subscription_charged_successfully":
-            for transaction in notification.subscription.transactions:
-                trans, created = BTTransaction.objects.get_or_create(
-                    transaction_id=transaction.id,
-                    subscription=subscription,
-                )
+@staff_member_required
+def export(request, name):
+    """ Stream all rows of an export, optionally limited to the days from
+        ?start=YYYY-MM-DD (inclusive) to ?end=YYYY-MM-DD (exclusive)
+    """
+    format = request.GET.get('format', 'csv')
+    if name not in EXPORTS:
+        raise Http404
+    if format not in FORMATS:
+        return HttpResponseBadRequest('Unknown format')
 
-                trans.import_data(transaction)
-                trans.save()
-    except BTCreditCard.DoesNotExist:
-        log.exception = 'Credit Card not present'
-    except BTPlan.DoesNotExist:
-        log.exception = 'Plan not present'
-    except:
-        log.exception = traceback.format_exc()
-        # this is bad, reraise error
-        raise
-    finally:
-        log.save()
+    try:
+        start, end = [
+            parse_day(request.GET[key]) if request.GET.get(key) else None
+            for key in ('start', 'end')
+        ]
+    except ValueError as e:
+        return HttpResponseBadRequest(unicode(e))
+
+    lines, content_type = FORMATS[format]
+    response = StreamingHttpResponse(lines(name, start, end),
+        content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename=%s.%s' % (
+        name, format)
+    return response
+
+
+def catalogue(request):
+    """ The plans, add-ons and discounts as JSON, answering conditional
+        requests for the current catalogue with 304 Not Modified
+    """
+    etag, body = get_catalogue()
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(body, content_type='application/json')
 
-    return HttpResponse('Ok, thanks')
+    response['ETag'] = quote_etag(etag)
+    patch_cache_control(response, public=True, max_age=getattr(settings,
+        'BRAINTREE_CATALOGUE_MAX_AGE', 300))
+    return response
 
 
 def error(request):
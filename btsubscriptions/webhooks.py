@@ -0,0 +1,321 @@
+""" Handling and replaying of braintree webhook notifications.
+
+    apply_notifications() updates the local mirror from a batch of parsed
+    notifications and is shared by the webhook view and replay(). Replays
+    re-run stored notifications (see BTWebhookLog.bt_payload) to rebuild
+    subscription state after a handler bug was fixed. Subscriptions are
+    distributed over threads; the notifications of one subscription are
+    always applied by the same thread, in the order they were received.
+"""
+import sys
+import time
+import traceback
+import zlib
+from multiprocessing.pool import ThreadPool
+
+from django.db import connection, transaction, IntegrityError
+
+from .gateways import activate, deactivate, get_gateway, get_tenant
+from .models import BTCreditCard, BTPlan, BTSubscription, BTTransaction
+from .models import BTWebhookLog
+
+
+def import_transactions(charges):
+    """ Create or update the transactions of (subscription, transaction data)
+        pairs, with one query to find existing and one to create new ones
+    """
+    existing = dict(
+        (trans.transaction_id, trans) for trans in BTTransaction.objects
+        .filter(transaction_id__in=set(data.id for _, data in charges))
+    )
+    fields = [field.attname for field in BTTransaction._meta.fields]
+
+    created = {}
+    for subscription, data in charges:
+        trans = existing.get(data.id) or created.get(data.id)
+        if trans is None:
+            trans = BTTransaction(transaction_id=data.id,
+                subscription=subscription)
+            created[data.id] = trans
+            trans.import_data(data)
+            continue
+
+        # Transactions are resent with every charge, skip unchanged ones.
+        # Those created in this batch are saved by bulk_create() below.
+        before = [getattr(trans, name) for name in fields]
+        trans.subscription = subscription
+        trans.import_data(data)
+        if trans.pk and before != [getattr(trans, name) for name in fields]:
+            trans.save()
+
+    if not created:
+        return
+    try:
+        with transaction.atomic():
+            BTTransaction.objects.bulk_create(created.values())
+    except IntegrityError:
+        # Some were created concurrently, fall back to one by one
+        for trans in created.values():
+            try:
+                trans.pk = BTTransaction.objects.get(
+                    transaction_id=trans.transaction_id).pk
+            except BTTransaction.DoesNotExist:
+                pass
+            trans.save()
+
+
+def apply_notifications(notifications, source='webhook'):
+    """ Import the subscriptions (and transactions) of notifications, in
+        order. Cards, plans, subscriptions and transactions are looked up
+        with one query each. Must run in a transaction, which keeps the
+        subscriptions locked. Returns the subscription, the exception if its
+        card or plan is missing, or None if the notification has no
+        subscription (e.g. check), per notification.
+    """
+    subscriptions = [
+        getattr(notification, 'subscription', None)
+        for notification in notifications
+    ]
+    present = [data for data in subscriptions if data is not None]
+    cards = dict(
+        (card.token, card) for card in BTCreditCard.objects.filter(
+            token__in=set(data.payment_method_token for data in present))
+    )
+    plans = dict(
+        (plan.plan_id, plan) for plan in BTPlan.objects.filter(
+            plan_id__in=set(data.plan_id for data in present))
+    )
+    # Locked until the end of the callers' transaction
+    existing = dict(
+        (subscription.subscription_id, subscription)
+        for subscription in BTSubscription.objects.select_for_update().filter(
+            subscription_id__in=set(data.id for data in present))
+    )
+
+    results = []
+    charges = []
+    for notification, data in zip(notifications, subscriptions):
+        if data is None:
+            results.append(None)
+            continue
+
+        card = cards.get(data.payment_method_token)
+        if card is None:
+            results.append(
+                BTCreditCard.DoesNotExist('Credit Card not present'))
+            continue
+        plan = plans.get(data.plan_id)
+        if plan is None:
+            results.append(BTPlan.DoesNotExist('Plan not present'))
+            continue
+
+        # Update subscription, unless nothing changed
+        subscription = existing.get(data.id)
+        if subscription is None:
+            # The subscribe view may be creating it concurrently
+            subscription = BTSubscription.objects.upsert(data, source,
+                customer_id=card.customer_id, plan=plan)
+            existing[data.id] = subscription
+        else:
+            subscription.apply_data(data, source, plan=plan)
+        results.append(subscription)
+
+        if notification.kind == "subscription_charged_successfully":
+            charges.extend(
+                (subscription, trans) for trans in data.transactions)
+
+    if charges:
+        import_transactions(charges)
+    return results
+
+
+def handle_notifications(notifications):
+    """ Apply a batch of (notification, bt_signature, bt_payload) in one
+        transaction and log them with a single insert. Notifications with
+        missing cards or plans are logged as failures; unexpected errors
+        roll back the batch, are logged for all notifications and reraised.
+    """
+    try:
+        with transaction.atomic():
+            results = apply_notifications(
+                [notification for notification, _, _ in notifications])
+            log_notifications(notifications, [
+                result if isinstance(result, Exception) else None
+                for result in results
+            ])
+    except:
+        exc_info = sys.exc_info()
+        failure = traceback.format_exc()
+        try:
+            log_notifications(notifications, [failure] * len(notifications))
+        except Exception:
+            # Failing to log must not hide the error itself
+            pass
+        # this is bad, reraise error
+        raise exc_info[0], exc_info[1], exc_info[2]
+    return results
+
+
+def log_notifications(notifications, failures):
+    logs = []
+    for (notification, bt_signature, bt_payload), failure in zip(
+            notifications, failures):
+        # Failures are always logged, successes only when sampled
+        if not failure and not BTWebhookLog.is_sampled():
+            continue
+        # Notifications like check don't carry a subscription
+        subscription = getattr(notification, 'subscription', None)
+        log = BTWebhookLog(
+            kind=notification.kind,
+            subscription_id=getattr(subscription, 'id', ''),
+            exception=unicode(failure or ''),
+            bt_signature=bt_signature,
+            bt_payload=bt_payload,
+        )
+        if subscription is not None:
+            try:
+                log.set_data(subscription)
+            except Exception:
+                # Log the notification even if its data can't be encoded
+                log.exception += traceback.format_exc()
+        logs.append(log)
+    BTWebhookLog.objects.bulk_create(logs)
+
+
+class DryRun(Exception):
+    """ Raised to roll back the changes of a dry run """
+
+
+def subscription_state(subscription_id):
+    """ Tracked fields and transaction ids of a local subscription """
+    try:
+        subscription = BTSubscription.objects.get(
+            subscription_id=subscription_id)
+    except BTSubscription.DoesNotExist:
+        return {}
+
+    state = subscription.history_state()
+    state['transactions'] = sorted(
+        subscription.transactions.values_list('transaction_id', flat=True))
+    return state
+
+
+def state_diff(before, after):
+    """ {field: (before, after)} of all fields which differ """
+    return dict(
+        (name, (before.get(name), after.get(name)))
+        for name in set(before) | set(after)
+        if before.get(name) != after.get(name)
+    )
+
+
+def replay_subscription(subscription_id, logs, dry_run=False):
+    """ Re-apply the stored notifications of one subscription in a
+        transaction. Returns the changes of the local state.
+    """
+    gateway = get_gateway()
+    try:
+        with transaction.atomic():
+            before = subscription_state(subscription_id)
+            notifications = [
+                gateway.webhook_notification.parse(
+                    str(log.bt_signature), str(log.bt_payload))
+                for log in logs
+            ]
+            for result in apply_notifications(notifications, source='replay'):
+                if isinstance(result, Exception):
+                    raise result
+            diff = state_diff(before, subscription_state(subscription_id))
+            if dry_run:
+                raise DryRun(diff)
+    except DryRun as e:
+        diff = e.args[0]
+    return diff
+
+
+def replay_logs(subscription_id, start=None, end=None):
+    """ Stored notifications of a subscription, in the order received """
+    logs = BTWebhookLog.objects.filter(subscription_id=subscription_id)\
+        .exclude(bt_payload='').order_by('received', 'pk')\
+        .only('bt_signature', 'bt_payload')
+    if start is not None:
+        logs = logs.filter(received__gte=start)
+    if end is not None:
+        logs = logs.filter(received__lt=end)
+    return logs
+
+
+def partition(subscription_id, partitions):
+    """ Stable partition of a subscription, independent of the process """
+    return zlib.crc32(subscription_id.encode('utf-8')) % partitions
+
+
+def replay(start=None, end=None, subscription_ids=None, threads=1,
+        dry_run=False, report=None):
+    """ Replay all stored notifications received between start and end.
+        report is called with (subscription_id, number of notifications,
+        changes, error) after each subscription. Returns a dict with the
+        numbers of subscriptions, notifications, changed subscriptions and
+        errors, and the elapsed seconds.
+    """
+    if subscription_ids is None:
+        logs = BTWebhookLog.objects.exclude(bt_payload='')\
+            .exclude(subscription_id='')
+        if start is not None:
+            logs = logs.filter(received__gte=start)
+        if end is not None:
+            logs = logs.filter(received__lt=end)
+        subscription_ids = logs.order_by('subscription_id')\
+            .values_list('subscription_id', flat=True).distinct()
+
+    partitions = [[] for i in range(max(threads, 1))]
+    for subscription_id in subscription_ids:
+        partitions[partition(subscription_id, len(partitions))].append(
+            subscription_id)
+
+    partitions = filter(None, partitions)
+    tenant = get_tenant()
+    started = time.time()
+
+    def run(subscription_ids):
+        totals = {'subscriptions': 0, 'notifications': 0, 'changed': 0,
+            'errors': 0}
+        for subscription_id in subscription_ids:
+            logs = list(replay_logs(subscription_id, start, end))
+            diff = error = None
+            try:
+                diff = replay_subscription(subscription_id, logs, dry_run)
+            except Exception as e:
+                error = e
+                totals['errors'] += 1
+
+            totals['subscriptions'] += 1
+            totals['notifications'] += len(logs)
+            totals['changed'] += bool(diff)
+            if report is not None:
+                report(subscription_id, len(logs), diff, error)
+        return totals
+
+    def run_threaded(subscription_ids):
+        # Threads don't inherit the active tenant
+        activate(tenant)
+        try:
+            return run(subscription_ids)
+        finally:
+            deactivate()
+            connection.close()
+
+    if len(partitions) < 2:
+        results = [run(subscriptions) for subscriptions in partitions or [[]]]
+    else:
+        pool = ThreadPool(len(partitions))
+        try:
+            results = pool.map(run_threaded, partitions)
+        finally:
+            pool.close()
+            pool.join()
+
+    totals = dict((key, sum(result[key] for result in results))
+        for key in results[0])
+    totals['seconds'] = time.time() - started
+    return totals